@@ -1,11 +1,17 @@
 import os,sys,socket,struct,select,time,binascii,logging
-import ping_reporter
+import ping_reporter, ping_mmsg
 
 ping_count = 0
 ping_bandwidth = 0
 log = ping_reporter.setup_log('Ping')
 server_list = ['www.google.com','172.16.2.1','10.44.0.1']
 
+# precompiled header layouts (ICMP fields are native order, as in build_ping)
+ip_header   = struct.Struct('!B3xH4BHLL')
+ip_prefix   = struct.Struct('!B8xB2xL') # version/length, protocol, source
+icmp_header = struct.Struct('=bbHL')
+echo_header = struct.Struct('=bbH')  # type, code, checksum
+
 def select_server(log,max_timeout=1):
 	server = ''
 	log.notice('selecting server')
@@ -23,6 +29,19 @@ def select_server(log,max_timeout=1):
 	log.info('selected server: %s (%.02fms)'%(server,min_delay*1000))
 	return server
 
+def select_servers(log,max_timeout=1):
+	# every responding server, fastest first (for striping across them)
+	log.notice('ranking servers')
+	delays = []
+	for x in server_list:
+		try: delay = single_ping(x,max_timeout)
+		except socket.error: delay = None
+		if delay == None: log.notice('%s: timed out'%x)
+		else:             delays.append((delay,x))
+	delays.sort()
+	log.info('selected servers: %s'%', '.join(['%s (%.02fms)'%(x,d*1000) for d,x in delays]))
+	return [x for d,x in delays]
+
 def carry_add(a, b):
 	c = a + b
 	return (c & 0xFFFF) + (c >> 16)
@@ -36,6 +55,12 @@ def checksum(msg):
 		s = carry_add(s, w)
 	return ~s & 0xFFFF
 
+def checksum_update(csum, old_word, new_word):
+	# RFC 1624 (eqn. 3): HC' = ~(~HC + ~m + m')
+	s = carry_add(~csum & 0xFFFF, ~old_word & 0xFFFF)
+	s = carry_add(s, new_word)
+	return ~s & 0xFFFF
+
 def build_ping(ID, data):
 	log.trace('ping::build_ping: ID=%d, bytes=%d'%(ID,len(data)))
 	if ID == 0: raise Exception('Invalid BlockID (0): many servers will corrupt ID=0 ICMP messages')
@@ -50,9 +75,9 @@ def build_ping(ID, data):
 #	icmp_sequence		= (ID <<  0) & 0xFFFF
 	block_id		= ID # append id & seq for 4-byte identifier
 
-	header = struct.pack("bbHL", icmp_type, icmp_code, icmp_checksum, block_id)
+	header = icmp_header.pack(icmp_type, icmp_code, icmp_checksum, block_id)
 	icmp_checksum = checksum(header+data)
-	header = struct.pack("bbHL", icmp_type, icmp_code, icmp_checksum, block_id)
+	header = icmp_header.pack(icmp_type, icmp_code, icmp_checksum, block_id)
 
 	# Return built ICMP message
 	return header+data
@@ -90,10 +115,27 @@ def data_ping(d_socket, d_addr, ID, data):
 		ping_count = ping_count + 1
 		ping_bandwidth = ping_bandwidth + len(packet)
 
+def echo_ping(d_socket, d_addr, reply):
+	# resend a received echo reply (ICMP header onwards) as an echo request;
+	# only the type changes, so the checksum is patched instead of recomputed.
+	# writable views (PingRing slots) are patched in place and sent uncopied
+	global ping_count, ping_bandwidth
+	(type, code, csum) = echo_header.unpack_from(reply)
+	csum = checksum_update(csum, (type & 0xFF) | (code & 0xFF) << 8, 8 | (code & 0xFF) << 8)
+	if isinstance(reply, memoryview) and not reply.readonly:
+		echo_header.pack_into(reply, 0, 8, code, csum)
+		packet = reply
+	else:
+		packet = echo_header.pack(8, code, csum) + reply[4:]
+	d_socket.sendto(packet, (d_addr, 1))
+	if 1:
+		ping_count = ping_count + 1
+		ping_bandwidth = ping_bandwidth + len(packet)
+
 def parse_ip(packet):
 	log.trace('ping::parse_ip: bytes=%d'%(len(packet)))
 	if len(packet) < 20: return None
-	(verlen,ID,flags,frag,ttl,protocol,csum,src,dst) = struct.unpack('!B3xH4BHLL',packet[:20])
+	(verlen,ID,flags,frag,ttl,protocol,csum,src,dst) = ip_header.unpack_from(packet)
 	ip = dict(  version= verlen >> 4,
 				length=  4*(verlen & 0xF),
 				ID=      ID,
@@ -109,7 +151,7 @@ def parse_ip(packet):
 def parse_icmp(packet,validate):
 	log.trace('ping::parse_icmp: bytes=%d'%(len(packet)))
 	if len(packet) < 8: return None
-	(type, code, csum, block_id) = struct.unpack('bbHL', packet[:8])
+	(type, code, csum, block_id) = icmp_header.unpack_from(packet)
 	log.debug('ping::parse_icmp: type=%d code=%d csum=%x ID=%d'%(type,code,csum,block_id))
 	icmp = dict(type=type,
 				code=code,
@@ -117,7 +159,7 @@ def parse_icmp(packet,validate):
 				block_id=block_id)
 
 	if validate:
-		t_header = struct.pack('bbHL',type,code,0,block_id)
+		t_header = icmp_header.pack(type,code,0,block_id)
 		t_csum = checksum(t_header+packet[8:])
 		icmp['valid'] = (t_csum == csum)
 		
@@ -158,6 +200,107 @@ def recv_ping(d_socket, timeout, validate=False):
 	log.debug('ping::recv_ping: ID=%d address=%s bytes=%d'%(parsed['ID'],addr,len(data)))
 	return parsed
 
+def as_string(data):
+	# PingRing payloads are views into a reused buffer; copy before keeping one
+	if isinstance(data, memoryview): return data.tobytes()
+	return data
+
+class PingBatch(object): # socket stand-in that queues sendto() until flush()
+	def __init__(self, d_socket, slots=64):
+		self.socket = d_socket
+		self.packets = []
+		self.sender = None
+		if ping_mmsg.available and isinstance(d_socket, socket.socket):
+			self.sender = ping_mmsg.MMsgSender(slots)
+
+	def sendto(self, packet, address):
+		self.packets.append((packet, address))
+		return len(packet)
+
+	def flush(self):
+		if not self.packets: return
+		packets,self.packets = self.packets,[]
+		if self.sender: return self.sender.send(self.socket.fileno(), packets)
+		for packet,address in packets: self.socket.sendto(packet, address)
+
+class PingRecord(object): # allocation-light stand-in for the recv_ping dict
+	__slots__ = ('ID','address','payload','reply')
+
+	def __init__(self):
+		self.ID = 0
+		self.address = None
+		self.payload = None # memoryview of the echoed data
+		self.reply = None   # memoryview of the ICMP message (header onwards)
+
+class PingRing(object):
+	# preallocated receive buffers: recvfrom_into a slot, then parse it in place.
+	# a slot (and its record) is only valid until the ring wraps back onto it
+	def __init__(self, slots=64, size=2048):
+		self.buffers = [bytearray(size) for x in range(slots)]
+		self.views = [memoryview(x) for x in self.buffers]
+		self.records = [PingRecord() for x in range(slots)]
+		self.receiver = None
+		self.sources = {} # IP source -> (address, port), as recvfrom reports it
+		self.slots = slots
+		self.index = 0
+
+	def recv(self, d_socket, timeout, validate=False):
+		index = self.index
+		self.index = (index + 1) % self.slots
+		d_socket.settimeout(timeout)
+		try:
+			length,addr = d_socket.recvfrom_into(self.buffers[index])
+		except socket.timeout:
+			return None
+		return self.parse(self.records[index], self.views[index], length, addr, validate)
+
+	def recv_batch(self, d_socket, count):
+		# drain up to count datagrams without blocking (once select says readable);
+		# the returned records are only valid until the next recv/recv_batch
+		index = self.index
+		count = min(count, self.slots - index) # keep the batch contiguous
+		if self.receiver is None:
+			self.receiver = False
+			if ping_mmsg.available: self.receiver = ping_mmsg.MMsgReceiver(self.buffers)
+		if self.receiver:
+			lengths = self.receiver.recv(d_socket.fileno(), index, count)
+		else:
+			lengths = []
+			d_socket.setblocking(0)
+			while len(lengths) < count:
+				try: length,addr = d_socket.recvfrom_into(self.buffers[index+len(lengths)])
+				except socket.error: break # EAGAIN: drained
+				lengths.append(length)
+		self.index = (index + len(lengths)) % self.slots
+		records = []
+		for x in range(len(lengths)):
+			record = self.parse(self.records[index+x], self.views[index+x], lengths[x], None)
+			if record: records.append(record)
+		return records
+
+	def parse(self, record, view, length, addr, validate=False):
+		# same acceptance rules as parse_ping, without the dicts and slices
+		if length < 20+8+1: return None # require 1 block of data
+		(verlen, protocol, source) = ip_prefix.unpack_from(view)
+		ip_length = 4*(verlen & 0xF)
+		if protocol != socket.IPPROTO_ICMP: return None # ICMP
+		if verlen >> 4 != socket.IPPROTO_IPIP: return None # IPv4
+		if ip_length+8+1 > length:          return None # invalid ICMP header
+		(type, code, csum, block_id) = icmp_header.unpack_from(view, ip_length)
+		if type != 0 or code != 0:          return None # not a valid Echo Reply packet
+		if validate:
+			t_header = icmp_header.pack(type,code,0,block_id)
+			if checksum(t_header+view[ip_length+8:length].tobytes()) != csum: return None
+		if addr is None: # batched receive: raw sockets report the IP source anyway
+			addr = self.sources.get(source)
+			if addr is None:
+				addr = self.sources[source] = (socket.inet_ntoa(struct.pack('!L', source)), 0)
+		record.ID = block_id
+		record.address = addr
+		record.reply = view[ip_length:length]
+		record.payload = view[ip_length+8:length]
+		return record
+
 def read_ping(d_socket, timeout):
 	start = time.time()
 	while time.time() - start < timeout:
@@ -177,7 +320,7 @@ def receive_ping(my_socket, ID, timeout):
                 howLongInSelect = (timeReceived - startedSelect)
                 recPacket, addr = my_socket.recvfrom(1024)
                 icmpHeader = recPacket[20:28]
-                type, code, checksum, packetID = struct.unpack("bbHL", icmpHeader)
+                type, code, checksum, packetID = struct.unpack("=bbHL", icmpHeader)
                 if packetID == ID:
                         bytesInDouble = struct.calcsize("d")
                         timeSent = struct.unpack("d", recPacket[28:28 + bytesInDouble])[0]
@@ -0,0 +1,661 @@
+#!/usr/bin/python
+
+import sys, time, math, random, threading, json, argparse, logging, socket, select, struct, functools, types, Queue
+import ping, ping_disk, ping_echo, ping_erasure, ping_extent, ping_server, ping_loop, ping_shard, ping_reporter
+import ping_filesystem
+
+log = ping_reporter.setup_log('PingBench')
+
+"""
+pingfs-bench: fio-style load generator for PingDisk
+
+	python ping_bench.py --rw randrw --bs 512,4096 --iodepth 1,8 --size 1m --runtime 10
+
+Every combination of --block-size, --bs, --iodepth and --size is run as a
+separate job against a fresh PingDisk. Without --server the disk is backed by
+an in-process ping_echo.EchoResponder, so no root or remote host is needed.
+Results are emitted as a JSON list, one object per job.
+
+	python ping_bench.py --cycle 1,16,64
+
+measures the PingServer cycling loop alone: bursts of echo replies are queued
+on a loopback socket and drained by PingServer.cycle in this thread, with
+batch=0 (one syscall per packet) and each listed batch size.
+
+	python ping_bench.py --timers 100000
+
+inserts that many outstanding timeouts into PingTimer, completes half of them
+(as arriving packets would) and expires the rest, next to the PriorityQueue
+plus threading.Event scheme PingTimer used before its timing wheel.
+
+	python ping_bench.py --codec 4,2 --codec 10,4
+
+measures ping_erasure encode and decode throughput (decoding with m data
+shards lost) for each k,m; --erasure k,m runs the disk jobs on coded stripes.
+
+	python ping_bench.py --extents 1000000
+
+fills a ping_extent.ExtentMap with that many live blocks (in file-sized runs),
+punches holes in about a fifth of them and times the deletes, best- and
+first-fit queries and collision tests on the fragmented map, then the inserts
+that refill it. Listing its free gaps is timed next to the dict walk that
+allocation did before (quadratic in runs: minutes at a million blocks).
+
+	python ping_bench.py --compress zlib:6 --content text
+
+runs the disk jobs with every block sent through ping_codec (zlib, level 6)
+and reports the compression ratio; --content picks what the jobs write:
+random bytes (incompressible), text, or sparse records among zeros.
+
+	python ping_bench.py --dedup --content copies
+
+runs the disk jobs through ping_dedup, writing the same few chunks over and
+over as a backup would, and reports logical and physical (in flight) blocks.
+
+	python ping_bench.py --dirents 10000
+
+builds a PingFS directory of that many entries, in as many buckets as its
+blocks need, and times packing and unpacking its buckets and header, next to
+the whole-directory blob with concatenated dirents (and a re-sliced buffer
+on reading) that directories were before.
+
+	python ping_bench.py --memory 100000
+
+measures the memory held per cached PingFile node and per directory entry
+(every object reachable from them, each counted once), next to the
+__dict__-backed nodes and dict-of-PingDirent buckets they replaced.
+
+	python ping_bench.py --threads 20
+
+checks PingDisk and PingFS under concurrent callers, against the simulated
+responder: that many threads merge partial writes into the same blocks (all
+must land), allocate regions at once (no block may be handed out twice), and
+write and read back a file each, timed against the same files one at a time.
+A failed check raises.
+"""
+
+patterns = ['read','write','rw','randread','randwrite','randrw']
+contents = ['random','text','sparse','copies'] # what the jobs write: how well it compresses (or dedups)
+words = ['ping','echo','block','reply','packet','fuse','inode','disk','cycle','bytes']
+
+def parse_size(text):
+	units = dict(k=1<<10,m=1<<20,g=1<<30)
+	text = text.strip().lower()
+	if text and text[-1] in units: return int(float(text[:-1]) * units[text[-1]])
+	return int(text)
+
+def parse_list(text, convert=int):
+	return [convert(x) for x in text.split(',') if x]
+
+def percentile(ordered, fraction):
+	if not ordered: return 0.0
+	index = int(math.ceil(fraction * len(ordered))) - 1
+	return ordered[max(0,min(index,len(ordered)-1))]
+
+def summarize(latencies, nbytes, elapsed):
+	ordered = sorted(latencies)
+	count = len(ordered)
+	if elapsed <= 0: elapsed = 1e-9
+	ms = lambda x: round(1000*x,3)
+	return dict(ios=count,
+				bytes=nbytes,
+				iops=round(count/elapsed,2),
+				mbps=round(nbytes/elapsed/(1<<20),4),
+				lat_ms=dict(mean=ms(sum(ordered)/count) if count else 0.0,
+							min=ms(ordered[0]) if count else 0.0,
+							p50=ms(percentile(ordered,0.50)),
+							p99=ms(percentile(ordered,0.99)),
+							p999=ms(percentile(ordered,0.999)),
+							max=ms(ordered[-1]) if count else 0.0))
+
+class BenchJob:
+	def __init__(self, disk, rw='randrw', bs=4096, iodepth=1, size=1<<20,
+			rwmixread=50, runtime=10, ios=0, seed=None, content='random'):
+		if rw not in patterns: raise Exception('BenchJob: unknown pattern (%s)'%rw)
+		if content not in contents: raise Exception('BenchJob: unknown content (%s)'%content)
+		if size < bs: raise Exception('BenchJob: working set smaller than one io')
+		self.disk = disk
+		self.rw = rw
+		self.bs = bs
+		self.iodepth = iodepth
+		self.size = size - size % bs
+		self.rwmixread = rwmixread
+		self.runtime = runtime
+		self.ios = ios # total io budget (0: limited by runtime only)
+		self.content = content
+		self.copies = {} # length -> the few chunks 'copies' content repeats
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.cursor = 0
+		self.issued = 0
+		self.results = dict(read=[],write=[])
+		self.nbytes = dict(read=0,write=0)
+		self.errors = 0
+
+	def next_io(self): # returns (op, offset) or None once the budget is spent
+		with self.lock:
+			if self.ios and self.issued >= self.ios: return None
+			if time.time() >= self.deadline: return None
+			self.issued = self.issued + 1
+			if   self.rw in ('read','randread'):   op = 'read'
+			elif self.rw in ('write','randwrite'): op = 'write'
+			elif self.random.randint(1,100) <= self.rwmixread: op = 'read'
+			else: op = 'write'
+			if self.rw.startswith('rand'):
+				offset = self.bs * self.random.randrange(self.size / self.bs)
+			else:
+				offset = self.cursor
+				self.cursor = (self.cursor + self.bs) % self.size
+			return op,offset
+
+	def worker(self, payload):
+		while True:
+			io = self.next_io()
+			if not io: return
+			op,offset = io
+			start = time.time()
+			try:
+				if op == 'read':
+					data = self.disk.read(offset,self.bs)
+					if len(data) != self.bs: raise Exception('short read (%d bytes)'%len(data))
+				else: self.disk.write(offset,payload)
+			except Exception, e:
+				log.error('PingBench::worker: %s at %d failed: %s'%(op,offset,e))
+				with self.lock: self.errors = self.errors + 1
+				continue
+			elapsed = time.time() - start
+			with self.lock:
+				self.results[op].append(elapsed)
+				self.nbytes[op] = self.nbytes[op] + self.bs
+
+	def prefill(self):
+		log.notice('prefilling %d bytes'%self.size)
+		chunk = self.disk.block_size() * self.disk.region_size()
+		for x in range(0,self.size,chunk):
+			self.disk.write(x,self.fill(min(chunk,self.size-x)))
+		self.disk.flush()
+
+	def fill(self, length):
+		if self.content == 'text':
+			text = ' '.join([self.random.choice(words) for x in range(length/4 + 1)])
+			return text[:length]
+		if self.content == 'copies': # backup-like: the same few chunks over and over
+			if length not in self.copies: self.copies[length] = [self.random_fill(length) for x in range(4)]
+			return self.random.choice(self.copies[length])
+		if self.content == 'sparse': # a random 16-byte record every 256 bytes, zeros between
+			return ''.join([''.join(chr(self.random.randint(1,255)) for y in range(16)).ljust(256,'\0')
+							for x in range(0,length,256)])[:length]
+		return self.random_fill(length)
+
+	def random_fill(self, length):
+		return ''.join(chr(self.random.randint(1,255)) for x in range(length))
+
+	def run(self):
+		self.deadline = time.time() + self.runtime
+		count,traffic = ping.ping_count,ping.ping_bandwidth
+		workers = []
+		for x in range(self.iodepth):
+			t = threading.Thread(target=self.worker,args=(self.fill(self.bs),))
+			t.daemon = True
+			workers.append(t)
+		start = time.time()
+		for t in workers: t.start()
+		for t in workers: t.join()
+		elapsed = time.time() - start
+		result = dict(elapsed=round(elapsed,3),errors=self.errors,
+					  traffic=dict(pings=ping.ping_count-count,
+								   bytes=ping.ping_bandwidth-traffic))
+		for op in ('read','write'):
+			result[op] = summarize(self.results[op],self.nbytes[op],elapsed)
+		return result
+
+def cycle_bench(batch, packets=20000, burst=1000, block_size=1024):
+	# the feeder only runs between bursts, so drain time is one core's work
+	rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4<<20)
+	rx.bind(('127.0.0.1',0))
+	tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	server = ping_server.PingServer('127.0.0.1',block_size,transport=lambda: rx)
+	server.batch = batch
+	output = server.build_output()
+	responder = ping_echo.EchoResponder()
+	replies = [responder.build_reply(('127.0.0.1',0),0,0,x,'\x5a'*block_size,True)
+			   for x in range(1,burst+1)]
+	count,busy = ping.ping_count,0.0
+	for x in range(0,packets,burst):
+		for reply in replies: tx.sendto(reply, rx.getsockname())
+		start = time.time()
+		while select.select([rx],[],[],0)[0]: server.cycle(output)
+		busy = busy + time.time() - start
+	cycled = ping.ping_count - count
+	server.timer.stop()
+	rx.close()
+	tx.close()
+	return dict(batch=batch,packets=cycled,seconds=round(busy,3),
+				pps=round(cycled/busy,1),mmsg=ping.ping_mmsg.available)
+
+def timer_bench(count, timeout=0.4):
+	noop = lambda: None
+	rate = lambda n,t: round(n/max(t,1e-9),1)
+	results = []
+
+	timer = ping_server.PingTimer(threading.Event())
+	start = time.time()
+	entries = [timer.add_callback(timeout,noop,()) for x in range(count)]
+	inserted = time.time()
+	for entry in entries[::2]: entry.set()
+	cancelled = time.time()
+	pending = len(timer.wheel)
+	del entries
+	time.sleep(timeout + 2*timer.wheel.resolution)
+	expire = time.time()
+	timer.process()
+	expired = time.time()
+	results.append(dict(timer='wheel',outstanding=count,pending_after_cancel=pending,
+						insert_per_sec=rate(count,inserted-start),
+						cancel_per_sec=rate(count/2,cancelled-inserted),
+						expire_per_sec=rate(count-count/2,expired-expire)))
+
+	queue = Queue.PriorityQueue() # the pre-wheel PingTimer, inlined
+	start = time.time()
+	entries = []
+	for x in range(count):
+		event = threading.Event()
+		queue.put((time.time()+timeout,event,noop,()))
+		entries.append(event)
+	inserted = time.time()
+	for event in entries[::2]: event.set()
+	cancelled = time.time()
+	pending = queue.qsize() # cancellation is lazy: nothing is freed
+	del entries
+	time.sleep(timeout)
+	expire = time.time()
+	while queue.qsize():
+		when,event,callback,cb_args = queue.get_nowait()
+		if event.is_set(): continue
+		callback(*cb_args)
+		event.set()
+	expired = time.time()
+	results.append(dict(timer='priorityqueue',outstanding=count,pending_after_cancel=pending,
+						insert_per_sec=rate(count,inserted-start),
+						cancel_per_sec=rate(count/2,cancelled-inserted),
+						expire_per_sec=rate(count-count/2,expired-expire)))
+	return results
+
+def codec_bench(k, m, block_size=1024, stripes=200):
+	code = ping_erasure.ErasureCode(k,m)
+	rnd = random.Random(0)
+	data = [[''.join([chr(rnd.randrange(256)) for x in range(block_size)]) for y in range(k)]
+			for z in range(8)]
+	nbytes = k*block_size*stripes
+	start = time.time()
+	for x in range(stripes): parity = code.encode(data[x%8])
+	encoded = time.time()
+	lost = range(min(k,m)) # worst case: rebuild data shards, not parity
+	for x in range(stripes):
+		shards = dict(enumerate(data[x%8] + parity))
+		for y in lost: del shards[y]
+		code.decode(shards,lost)
+	decoded = time.time()
+	rate = lambda t: round(nbytes/max(t,1e-9)/(1<<20),2)
+	return dict(k=k,m=m,block_size=block_size,stripes=stripes,lost=len(lost),
+				encode_mb_per_sec=rate(encoded-start),decode_mb_per_sec=rate(decoded-encoded))
+
+def legacy_free_blocks(blocks): # free gaps from a {block: 1} dict, as allocation found them before
+	result = {}
+	if 1 not in blocks:
+		if not blocks:         result[1] = 0
+		elif len(blocks) == 0: result[1] = 0
+		else:                  result[1] = min(blocks.keys())-1
+	for x in blocks:
+		if not x+1 in blocks: result[x+1] = 0
+		if not x-1 in blocks:
+			if not len(result): continue
+			block = max(result.keys())
+			result[block] = x-block
+	return result
+
+def extent_bench(count, ops=20000, seed=0):
+	rnd = random.Random(seed)
+	rate = lambda n,t: round(n/max(t,1e-9),1)
+	extents = ping_extent.ExtentMap()
+	start = time.time()
+	ID = 1
+	while extents.blocks < count: # files of 1-16 blocks, with holes of up to 4
+		length = min(rnd.randint(1,16),count-extents.blocks)
+		extents.add(ID,length)
+		ID = ID + length + rnd.randint(0,4)
+	extents.first_fit(1) # builds the first-fit tree, kept up to date from here on
+	filled = time.time()
+	ops = max(1,min(ops,count/40)) # deletes punch holes in about a fifth of the blocks
+	runs = [(rnd.randrange(1,ID),rnd.randint(1,16)) for x in range(ops)]
+	t0 = time.time()
+	for s,n in runs: extents.remove(s,n)
+	t1 = time.time()
+	# queries on the map as the deletes left it, holes and all
+	for s,n in runs: extents.best_fit(n)
+	t2 = time.time()
+	for s,n in runs: extents.first_fit(n)
+	t3 = time.time()
+	for s,n in runs: extents.overlaps(s,s+n)
+	t4 = time.time()
+	extents.free_blocks()
+	t5 = time.time()
+	live = dict.fromkeys(extents,1)
+	t6 = time.time()
+	legacy_free_blocks(live) # what every allocation paid before
+	t7 = time.time()
+	blocks,fragments,gaps = extents.blocks,len(extents.starts),len(extents.gaps)
+	t8 = time.time()
+	for s,n in runs: extents.add(s,n)
+	t9 = time.time()
+	return dict(live_blocks=blocks,runs=fragments,gaps=gaps,ops=ops,
+				fill_seconds=round(filled-start,3),remove_per_sec=rate(ops,t1-t0),
+				insert_per_sec=rate(ops,t9-t8),best_fit_per_sec=rate(ops,t2-t1),
+				first_fit_per_sec=rate(ops,t3-t2),overlaps_per_sec=rate(ops,t4-t3),
+				free_blocks_seconds=round(t5-t4,3),legacy_free_blocks_seconds=round(t7-t6,3))
+
+def legacy_dirents(entries): # one blob, grown entry by entry
+	data = ''
+	for x in entries: data = data + struct.pack('L',x.inode) + struct.pack('H',len(x.name)) + x.name
+	return data
+
+def legacy_load(data): # the remaining buffer is re-sliced after every entry
+	names = []
+	while data:
+		inode = struct.unpack('L',data[:struct.calcsize('L')])[0]
+		data = data[struct.calcsize('L'):]
+		size = struct.unpack('H',data[:struct.calcsize('H')])[0]
+		data = data[struct.calcsize('H'):]
+		names.append(data[:size])
+		data = data[size:]
+	return names
+
+def dirent_bench(count, block_size=1024, rounds=5):
+	rate = lambda n,t: round(n/max(t,1e-9),1)
+	pDir = ping_filesystem.PingDirectory('bench')
+	for x in range(count): pDir.add_node(ping_filesystem.PingFile('file%07d'%x,(x+1)*block_size))
+	while [x for x in range(len(pDir.buckets)) if pDir.bucket_size(x) > block_size]: pDir.grow()
+	buckets = range(len(pDir.buckets))
+	t0 = time.time()
+	for r in range(rounds):
+		blocks = [pDir.serialize_bucket(x) for x in buckets]
+		header = pDir.serialize()
+	t1 = time.time()
+	for r in range(rounds):
+		loaded = [ping_filesystem.deserialize_bucket(x) for x in blocks]
+		ping_filesystem.interpretFile(header)
+	t2 = time.time()
+	if sum(map(len,loaded)) != count: raise Exception('dirent_bench: %d of %d entries read back'%(sum(map(len,loaded)),count))
+	entries = pDir.listing()
+	t3 = time.time()
+	blob = legacy_dirents(entries)
+	t4 = time.time()
+	legacy_load(blob)
+	t5 = time.time()
+	return dict(entries=count,buckets=len(buckets),bytes=sum(map(len,blocks))+len(header),
+				serialize_per_sec=rate(count*rounds,t1-t0),deserialize_per_sec=rate(count*rounds,t2-t1),
+				legacy_serialize_per_sec=rate(count,t4-t3),legacy_deserialize_per_sec=rate(count,t5-t4))
+
+class LegacyFile: # the node before __slots__: old-style, with a __dict__
+	def __init__(self,name,inode):
+		self.parent = None
+		self.inode = inode
+		self.type = 0
+		self.mode = 0
+		self.name = name
+		self.data = ''
+		self.length = 0
+		self.extents = []
+		self.uid = 0
+		self.gid = 0
+		self.stored = None
+		self.disk_size = 0
+
+class LegacyDirent:
+	def __init__(self,name,inode):
+		self.parent = None
+		self.inode = inode
+		self.name = name
+
+def footprint(root): # bytes of every object reachable from root, each counted once
+	seen = set()
+	stack = [root]
+	total = 0
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen or obj is None or isinstance(obj,(type,types.ClassType)): continue
+		seen.add(id(obj))
+		total = total + sys.getsizeof(obj)
+		if isinstance(obj,dict): stack.extend(obj.keys() + obj.values())
+		elif isinstance(obj,(list,tuple,set)): stack.extend(obj)
+		if hasattr(obj,'__dict__'): stack.append(obj.__dict__)
+		for x in getattr(type(obj),'__slots__',()):
+			if hasattr(obj,x): stack.append(getattr(obj,x))
+	return total
+
+def memory_bench(count, block_size=1024):
+	per = lambda n: round(float(n)/count,1)
+	names = ['file%07d'%x for x in range(count)]
+	nodes = []
+	for x in range(count):
+		pFile = ping_filesystem.PingFile(names[x],(x+1)*block_size)
+		pFile.length = 3*block_size
+		pFile.extents = [(0,(x+1)*block_size + block_size,3)]
+		pFile.stored = pFile.serialize()
+		nodes.append(pFile)
+	legacy = []
+	for x in nodes:
+		node = LegacyFile(x.name,x.inode)
+		node.length,node.extents,node.stored,node.disk_size = x.length,x.extents,x.stored,x.disk_size
+		node.data = x.stored[ping_filesystem.PingFile.file_header:]
+		legacy.append(node)
+	shared = footprint([names,[x.extents for x in nodes],[x.stored for x in nodes]])
+	pDir = ping_filesystem.PingDirectory('bench')
+	for x in nodes: pDir.add_node(x)
+	while [x for x in range(len(pDir.buckets)) if pDir.bucket_size(x) > block_size]: pDir.grow()
+	table = [dict() for x in pDir.buckets]
+	for x in nodes: table[pDir.bucket_of(x.name)][x.name] = LegacyDirent(x.name,x.inode)
+	return dict(entries=count,buckets=len(pDir.buckets),
+				node_bytes=per(footprint(nodes) - shared),legacy_node_bytes=per(footprint(legacy) - shared),
+				dirent_bytes=per(footprint(pDir.table)),legacy_dirent_bytes=per(footprint(table) - footprint(names)))
+
+def run_threads(count, target, *args): # target(index, *args) on count threads at once
+	errors = []
+	def run(index):
+		try: target(index,*args)
+		except Exception,e: errors.append(e)
+	workers = [threading.Thread(target=run,args=(x,)) for x in range(count)]
+	start = time.time()
+	for x in workers: x.start()
+	for x in workers: x.join()
+	if errors: raise errors[0]
+	return time.time() - start
+
+def shared_writes(index, disk, threads, slot, blocks):
+	# every slot'th run of bytes across the shared blocks is this thread's
+	for x in range(index,blocks*disk.block_size()/slot,threads):
+		disk.write(x*slot,chr(ord('A')+index)*slot)
+
+def allocations(index, disk, rnd, regions, lock):
+	for x in range(8):
+		with lock: length = rnd.randint(1,6*disk.block_size())
+		region = disk.get_region(length)
+		with lock: regions.append((region,length))
+
+def file_io(index, FS, data, chunk):
+	pFile = FS.create('/thread%02d'%index)
+	for x in range(0,len(data),chunk): FS.write(pFile,data[x:x+chunk],x)
+	read = FS.read_file(pFile,len(data),0)
+	if read != data: raise Exception('thread_bench: /thread%02d read back wrong (%d of %d bytes)'%(index,len(read),len(data)))
+
+def thread_bench(threads, block_size=1024, rtt=0.005, seed=0):
+	# concurrency checks against the simulated responder; any failure raises
+	rnd = random.Random(seed)
+	result = dict(threads=threads)
+	responder = ping_echo.EchoResponder(rtt=rtt,seed=seed)
+	try: # partial writes into the same blocks: every merge must land
+		disk = ping_disk.PingDisk(ping_echo.local_server,block_size,transport=responder.build_socket)
+		slot,blocks = 16,4
+		try:
+			result['shared_write_seconds'] = round(run_threads(threads,shared_writes,disk,threads,slot,blocks),3)
+			data = disk.read(0,blocks*block_size)
+		finally: disk.stop()
+		expect = ''.join([chr(ord('A')+x%threads)*slot for x in range(blocks*block_size/slot)])
+		if data != expect:
+			lost = len([x for x in range(0,len(expect),slot) if data[x:x+slot] != expect[x:x+slot]])
+			raise Exception('thread_bench: %d of %d partial writes lost'%(lost,len(expect)/slot))
+
+		# concurrent allocations: no two regions may share a block
+		disk = ping_disk.PingDisk(ping_echo.local_server,block_size,transport=responder.build_socket)
+		regions,lock = [],threading.Lock()
+		try: run_threads(threads,allocations,disk,rnd,regions,lock)
+		finally: disk.stop()
+		owner = {}
+		for region,length in regions:
+			for x in range(region/block_size + 1,(region + length - 1)/block_size + 2):
+				if x in owner: raise Exception('thread_bench: block %d allocated twice (%d and %d)'%(x,owner[x],region))
+				owner[x] = region
+		result['allocations'] = len(regions)
+
+		# separate files on separate threads, next to the same files one at a time
+		FS = ping_filesystem.PingFS(ping_echo.local_server,transport=responder.build_socket)
+		try:
+			length = 4*block_size
+			data = [''.join([rnd.choice(words) for y in range(length/4)])[:length] for x in range(threads)]
+			serial = time.time()
+			for x in range(threads): file_io(threads+x,FS,data[x],block_size)
+			serial = time.time() - serial
+			parallel = run_threads(threads,lambda x: file_io(x,FS,data[x],block_size))
+		finally: FS.stop()
+		result.update(file_bytes=length,serial_seconds=round(serial,3),parallel_seconds=round(parallel,3),
+					  speedup=round(serial/max(parallel,1e-9),1))
+	finally: responder.stop()
+	return result
+
+engines = dict(thread=ping_server.PingServer,loop=ping_loop.PingLoopServer,shard=ping_shard.PingShardServer)
+
+def build_disk(options, block_size):
+	engine = engines[options.engine]
+	if options.engine == 'shard': engine = functools.partial(engine,workers=options.shards)
+	if options.server:
+		servers = options.server.split(',')
+		return ping_disk.PingDisk(servers,block_size,engine=engine,stripe_unit=options.stripe_unit,
+								  replicas=options.replicas,erasure=options.erasure,
+								  cache=options.cache,refresh=options.refresh,readahead=options.readahead,
+								  writeback=options.writeback,writeback_age=options.writeback_age,
+								  compress=options.compress,dedup=options.dedup),None
+	responder = ping_echo.EchoResponder(rtt=options.rtt,jitter=options.jitter,
+										loss=options.loss,seed=options.seed)
+	servers = ['127.0.0.%d'%x for x in range(1,options.servers+1)] # the responder answers them all
+	disk = ping_disk.PingDisk(servers,block_size,transport=responder.build_socket,
+							  engine=engine,stripe_unit=options.stripe_unit,replicas=options.replicas,
+							  erasure=options.erasure,cache=options.cache,refresh=options.refresh,
+							  readahead=options.readahead,writeback=options.writeback,
+							  writeback_age=options.writeback_age,compress=options.compress,
+							  dedup=options.dedup)
+	return disk,responder
+
+def run_suite(options):
+	results = []
+	for block_size in options.block_size:
+		for size in options.size:
+			for bs in options.bs:
+				for iodepth in options.iodepth:
+					disk,responder = build_disk(options,block_size)
+					for x in disk.servers: x.batch = options.batch
+					try:
+						job = BenchJob(disk,options.rw,bs,iodepth,size,options.rwmixread,
+									   options.runtime,options.ios,options.seed,options.content)
+						if options.prefill: job.prefill()
+						result = job.run()
+					finally:
+						disk.stop()
+						if responder: responder.stop()
+					result['job'] = dict(rw=options.rw,bs=bs,iodepth=iodepth,size=size,
+										 block_size=disk.block_size(),rwmixread=options.rwmixread,
+										 engine=options.engine,shards=options.shards,batch=options.batch,
+										 servers=len(disk.servers),stripe_unit=options.stripe_unit,
+										 replicas=options.replicas,erasure=options.erasure,cache=options.cache,
+										 readahead=options.readahead,writeback=options.writeback,
+										 compress=options.compress,dedup=options.dedup,content=options.content,
+										 server=options.server or 'simulated')
+					if responder: result['responder'] = dict(responder.stats)
+					if disk.cache: result['cache'] = disk.cache.stats()
+					if disk.readahead: result['readahead'] = disk.readahead.stats()
+					if disk.writeback: result['writeback'] = disk.writeback.stats()
+					if disk.compression: result['compression'] = disk.compression.stats()
+					if options.dedup: result['dedup'] = [x.stats() for x in disk.servers]
+					log.notice('%s bs=%d iodepth=%d size=%d: %s'%(options.rw,bs,iodepth,size,result))
+					results.append(result)
+	return results
+
+def build_parser():
+	parser = argparse.ArgumentParser(description='fio-style load generator for PingDisk')
+	parser.add_argument('--rw', default='randrw', choices=patterns)
+	parser.add_argument('--rwmixread', type=int, default=50, help='read percentage for mixed jobs')
+	parser.add_argument('--bs', type=lambda x: parse_list(x,parse_size), default=[4096], help='io size(s)')
+	parser.add_argument('--block-size', type=lambda x: parse_list(x,parse_size), default=[1024],
+						help='PingServer block size(s)')
+	parser.add_argument('--iodepth', type=parse_list, default=[1], help='outstanding io count(s)')
+	parser.add_argument('--size', type=lambda x: parse_list(x,parse_size), default=[1<<20],
+						help='working set size(s)')
+	parser.add_argument('--runtime', type=float, default=10, help='seconds per job')
+	parser.add_argument('--ios', type=int, default=0, help='io budget per job (0: runtime only)')
+	parser.add_argument('--no-prefill', dest='prefill', action='store_false')
+	parser.add_argument('--server', default=None, help='echo server(s), comma separated (default: simulated)')
+	parser.add_argument('--servers', type=int, default=1, help='simulated echo servers to stripe across')
+	parser.add_argument('--stripe-unit', type=int, default=1, help='blocks per stripe unit')
+	parser.add_argument('--replicas', type=int, default=1, help='copies of each block in flight')
+	parser.add_argument('--erasure', type=lambda x: tuple(parse_list(x)), default=None,
+						help='k,m: Reed-Solomon stripes of k data and m parity blocks')
+	parser.add_argument('--cache', type=parse_size, default=0, help='PingDisk block cache budget (bytes)')
+	parser.add_argument('--refresh', action='store_true', help='refresh cached blocks from passing packets')
+	parser.add_argument('--readahead', type=int, default=0, help='PingDisk readahead window (blocks)')
+	parser.add_argument('--writeback', type=parse_size, default=0, help='PingDisk write-back limit (dirty bytes)')
+	parser.add_argument('--writeback-age', type=float, default=1.0, help='seconds before a dirty block is flushed')
+	parser.add_argument('--compress', default=None, help='block codec, as name[:level] (e.g. zlib:6)')
+	parser.add_argument('--content', default='random', choices=contents, help='what the jobs write')
+	parser.add_argument('--dedup', action='store_true', help='one packet per unique block content')
+	parser.add_argument('--rtt', type=float, default=0.02, help='simulated round trip (seconds)')
+	parser.add_argument('--jitter', type=float, default=0.0, help='simulated jitter (seconds)')
+	parser.add_argument('--loss', type=float, default=0.0, help='simulated loss rate')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--output', default='-', help='JSON output file (default: stdout)')
+	parser.add_argument('--engine', default='thread', choices=sorted(engines),
+						help='PingServer engine: receive+timer threads, one event loop, or worker processes')
+	parser.add_argument('--shards', type=int, default=None, help='worker processes for --engine shard (default: cores)')
+	parser.add_argument('--batch', type=int, default=0, help='PingServer batch size for disk jobs')
+	parser.add_argument('--cycle', type=parse_list, default=None,
+						help='batch size(s) for the cycling-loop benchmark (replaces disk jobs)')
+	parser.add_argument('--timers', type=int, default=0,
+						help='outstanding timeouts for the PingTimer benchmark (replaces disk jobs)')
+	parser.add_argument('--codec', type=lambda x: tuple(parse_list(x)), action='append', default=[],
+						help='k,m for the erasure codec benchmark, repeatable (replaces disk jobs)')
+	parser.add_argument('--extents', type=int, default=0,
+						help='live blocks for the extent map benchmark (replaces disk jobs)')
+	parser.add_argument('--dirents', type=int, default=0,
+						help='directory entries for the serialization benchmark (replaces disk jobs)')
+	parser.add_argument('--memory', type=int, default=0,
+						help='nodes and entries for the memory footprint benchmark (replaces disk jobs)')
+	parser.add_argument('--threads', type=int, default=0,
+						help='threads for the concurrency checks (replaces disk jobs)')
+	parser.add_argument('--verbose', action='store_true')
+	return parser
+
+if __name__ == "__main__":
+	options = build_parser().parse_args()
+	if options.verbose: ping_reporter.start_log(log,logging.NOTICE)
+	if   options.cycle:  results = [cycle_bench(x) for x in [0]+options.cycle]
+	elif options.timers: results = timer_bench(options.timers)
+	elif options.codec:  results = [codec_bench(k,m) for k,m in options.codec]
+	elif options.extents: results = extent_bench(options.extents)
+	elif options.dirents: results = dirent_bench(options.dirents)
+	elif options.memory:  results = memory_bench(options.memory)
+	elif options.threads: results = thread_bench(options.threads)
+	else:                results = run_suite(options)
+	if options.output == '-': out = sys.stdout
+	else:                     out = open(options.output,'w')
+	json.dump(results,out,indent=2,sort_keys=True)
+	out.write('\n')
+	if out is not sys.stdout: out.close()
@@ -0,0 +1,276 @@
+import time, threading, collections
+
+"""
+Block caching for PingDisk. BlockCache is a byte-budgeted LRU of block
+payloads, keyed by logical block ID. PingDisk keeps it write-through (writes
+update it, deletes invalidate it) and fills it from completed reads. A read
+that races a write of the same block is not cached, since it may have
+returned the old data. Readahead posts reads ahead of sequential streams,
+and WriteBack holds dirty blocks back from the network for a while.
+LRUCache is a plain count-bounded LRU, for PingFS metadata.
+"""
+
+class BlockCache(object):
+	def __init__(self, budget=1<<20):
+		self.lock = threading.Lock()
+		self.budget = budget # bytes of payload
+		self.blocks = collections.OrderedDict() # ID -> data, least recent first
+		self.loading = {} # ID -> [reads in flight, overwritten since]
+		self.writing = {} # ID -> data put but not yet seen cycling (refresh waits for it)
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __contains__(self, ID):
+		return ID in self.blocks
+
+	def get(self, ID):
+		with self.lock:
+			data = self.blocks.pop(ID, None)
+			if data is None:
+				self.misses = self.misses + 1
+				return None
+			self.blocks[ID] = data # most recent
+			self.hits = self.hits + 1
+			return data
+
+	def store(self, ID, data): # caller holds self.lock
+		old = self.blocks.pop(ID, None)
+		if old is not None: self.bytes = self.bytes - len(old)
+		if len(data) > self.budget: return
+		self.blocks[ID] = data
+		self.bytes = self.bytes + len(data)
+		while self.bytes > self.budget:
+			evicted,old = self.blocks.popitem(last=False)
+			self.writing.pop(evicted, None)
+			self.bytes = self.bytes - len(old)
+			self.evictions = self.evictions + 1
+
+	def put(self, ID, data): # the block was just written
+		with self.lock:
+			if ID in self.loading: self.loading[ID][1] = True
+			self.store(ID, data)
+			if ID in self.blocks: self.writing[ID] = data
+
+	def invalidate(self, ID):
+		with self.lock:
+			if ID in self.loading: self.loading[ID][1] = True
+			self.writing.pop(ID, None)
+			old = self.blocks.pop(ID, None)
+			if old is not None: self.bytes = self.bytes - len(old)
+
+	def expect(self, ID): # a read of ID is going out; pair with fill
+		with self.lock:
+			self.loading.setdefault(ID, [0,False])[0] += 1
+
+	def fill(self, ID, data): # the expected read came back
+		with self.lock:
+			loading = self.loading.get(ID)
+			stale = False
+			if loading:
+				loading[0] = loading[0] - 1
+				stale = loading[1]
+				if not loading[0]: del self.loading[ID]
+			if not stale: self.store(ID, data)
+
+	def refresh(self, ID, data):
+		# passive update from a cycling packet: cached blocks only, LRU order kept.
+		# after a put, packets still carrying the old data are ignored until
+		# one carries the written data
+		with self.lock:
+			if ID in self.writing:
+				if self.writing[ID] == data: del self.writing[ID]
+				return
+			old = self.blocks.get(ID)
+			if old is None or old == data: return
+			self.blocks[ID] = data
+			self.bytes = self.bytes + len(data) - len(old)
+
+	def clear(self):
+		with self.lock:
+			self.blocks.clear()
+			self.writing.clear()
+			self.bytes = 0
+
+	def stats(self):
+		return dict(hits=self.hits,misses=self.misses,evictions=self.evictions,
+					blocks=len(self.blocks),bytes=self.bytes,budget=self.budget)
+
+class LRUCache(object):
+	# up to size entries; None is a valid (negative) value, so lookups take
+	# the default to return on a miss
+	def __init__(self, size=1024):
+		self.lock = threading.Lock()
+		self.size = size
+		self.entries = collections.OrderedDict() # key -> value, least recent first
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key not in self.entries:
+				self.misses = self.misses + 1
+				return default
+			value = self.entries.pop(key)
+			self.entries[key] = value # most recent
+			self.hits = self.hits + 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.evictions = self.evictions + 1
+
+	def pop(self, key):
+		with self.lock: return self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock: self.entries.clear()
+
+	def stats(self):
+		return dict(hits=self.hits,misses=self.misses,evictions=self.evictions,
+					entries=len(self.entries),size=self.size)
+
+class Readahead(object):
+	# sequential readahead: reads continuing where an earlier one stopped form
+	# a stream, and each stream keeps read_block requests posted for a window
+	# of blocks beyond it. the window starts at twice the request and doubles
+	# on every sequential read (as the kernel's does) up to maximum blocks.
+	# posted blocks wait in a staging buffer of at most limit blocks
+	def __init__(self, disk, maximum=32, limit=None, streams=8):
+		self.lock = threading.Lock()
+		self.disk = disk
+		self.maximum = maximum
+		self.limit = limit or 2*maximum
+		self.max_streams = streams
+		self.streams = collections.OrderedDict() # next block expected -> [window, furthest posted]
+		self.staged = collections.OrderedDict()  # ID -> (event, datastore), oldest first
+		self.posted = 0
+		self.hits = 0
+		self.wasted = 0 # posted, then dropped unread
+
+	def access(self, init_block, fini_block):
+		# a read of init..fini is starting: returns its staged blocks as
+		# {ID: (event, datastore)} and posts the stream's next window
+		with self.lock:
+			stream = self.streams.pop(init_block, None) or self.streams.pop(init_block+1, None)
+			if stream: window,ahead = min(2*stream[0],self.maximum),stream[1]
+			else:      window,ahead = min(2*(fini_block-init_block+1),self.maximum),fini_block
+			found = {}
+			for x in range(init_block,fini_block+1):
+				if x in self.staged: found[x] = self.staged.pop(x)
+			self.hits = self.hits + len(found)
+			post = []
+			if stream: # sequential: fill the window past the end of this read
+				post = [x for x in range(max(ahead,fini_block)+1,fini_block+window+1) if x not in self.staged]
+				post = post[:self.limit]
+				ahead = max(ahead,fini_block+window)
+			self.streams[fini_block+1] = [window,ahead]
+			while len(self.streams) > self.max_streams: self.streams.popitem(last=False)
+			while self.staged and len(self.staged) + len(post) > self.limit:
+				self.staged.popitem(last=False)
+				self.wasted = self.wasted + 1
+			if post:
+				store = {}
+				events = self.disk.fetch_blocks(post,store)
+				for x in post: self.staged[x] = (events[x],store)
+				self.posted = self.posted + len(post)
+			return found
+
+	def invalidate(self, ID): # the block was written: a staged copy may be stale
+		with self.lock:
+			if self.staged.pop(ID, None): self.wasted = self.wasted + 1
+
+	def stats(self):
+		return dict(posted=self.posted,hits=self.hits,wasted=self.wasted,
+					staged=len(self.staged),streams=len(self.streams),maximum=self.maximum)
+
+class WriteBack(object):
+	# dirty blocks held back from the network: rewrites of a block coalesce,
+	# reads see them at once, and they go out through commit([(ID, data)])
+	# once limit bytes are dirty, once the oldest is max_age seconds old, or
+	# on flush. commit runs under the lock, so nothing overtakes a flush
+	def __init__(self, commit, limit=1<<20, max_age=1.0):
+		self.lock = threading.RLock()
+		self.cond = threading.Condition(self.lock)
+		self.commit = commit
+		self.limit = limit
+		self.max_age = max_age
+		self.dirty = collections.OrderedDict() # ID -> (data, dirtied at), oldest first
+		self.bytes = 0
+		self.writes = 0
+		self.coalesced = 0
+		self.flushed = 0
+		self.flushes = 0
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def get(self, ID):
+		with self.lock:
+			entry = self.dirty.get(ID)
+			if entry: return entry[0]
+			return None
+
+	def put(self, ID, data): # returns the events of any flush it triggers
+		with self.lock:
+			self.writes = self.writes + 1
+			entry = self.dirty.get(ID)
+			if entry: # keeps its age, and its place in line
+				self.coalesced = self.coalesced + 1
+				self.bytes = self.bytes - len(entry[0])
+				self.dirty[ID] = (data,entry[1])
+			else:
+				self.dirty[ID] = (data,time.time())
+				if len(self.dirty) == 1: self.cond.notify()
+			self.bytes = self.bytes + len(data)
+			if self.bytes >= self.limit: return self.flush()
+		return []
+
+	def discard(self, ID): # the block is being deleted
+		with self.lock:
+			entry = self.dirty.pop(ID, None)
+			if entry: self.bytes = self.bytes - len(entry[0])
+
+	def flush(self, before=None):
+		# commit every dirty block (or those dirtied before then); returns the events
+		with self.lock:
+			blocks = []
+			for ID,(data,dirtied) in self.dirty.iteritems():
+				if before is not None and dirtied > before: break
+				blocks.append((ID,data))
+			if not blocks: return []
+			for ID,data in blocks:
+				del self.dirty[ID]
+				self.bytes = self.bytes - len(data)
+			self.flushes = self.flushes + 1
+			self.flushed = self.flushed + len(blocks)
+			return self.commit(blocks)
+
+	def run(self):
+		with self.lock:
+			while self.running:
+				if not self.dirty:
+					self.cond.wait()
+					continue
+				due = next(self.dirty.itervalues())[1] + self.max_age
+				now = time.time()
+				if now >= due: self.flush(now - self.max_age)
+				else:          self.cond.wait(due - now)
+
+	def stop(self): # returns the events of the final flush
+		with self.lock:
+			self.running = False
+			self.cond.notify()
+			return self.flush()
+
+	def stats(self):
+		return dict(writes=self.writes,coalesced=self.coalesced,flushes=self.flushes,
+					flushed=self.flushed,dirty=len(self.dirty),bytes=self.bytes,
+					limit=self.limit,max_age=self.max_age)
@@ -0,0 +1,109 @@
+import zlib, struct, threading
+
+"""
+Block payload compression for PingServer. Capacity is bandwidth x RTT, so
+every byte a block doesn't put on the wire is capacity (and throughput)
+gained. A BlockFrame sits between an engine and the network: each payload
+goes out as a one-byte tag naming its codec, then the block as that codec
+packed it. Blocks that don't shrink go out as they are, tagged raw, so
+random data costs one byte per packet and no decode.
+
+	frame = ping_codec.build('zlib:9') # or BlockFrame(ZlibCodec(9))
+	disk = ping_disk.PingDisk(server,compress=frame)
+
+Codecs are pluggable: anything with a unique tag (1-255) and encode/decode
+will do. Decoding knows every codec in the codecs table, whatever a frame
+was built to encode with.
+"""
+
+RAW = 0 # tag of a block sent as it is
+
+class Codec(object): # the codec interface
+	tag = None
+	name = None
+
+	def encode(self, data):
+		raise NotImplementedError
+
+	def decode(self, data):
+		raise NotImplementedError
+
+class ZlibCodec(Codec):
+	# raw deflate: the frame tag already says what follows, so no zlib header
+	tag = 1
+	name = 'zlib'
+
+	def __init__(self, level=6):
+		if not 0 <= level <= 9: raise Exception('ZlibCodec: invalid level (%d)'%level)
+		self.level = level
+
+	def encode(self, data):
+		packer = zlib.compressobj(self.level,zlib.DEFLATED,-zlib.MAX_WBITS)
+		return packer.compress(data) + packer.flush()
+
+	def decode(self, data):
+		return zlib.decompress(data,-zlib.MAX_WBITS)
+
+codecs = dict([(x.name,x) for x in [ZlibCodec]]) # name -> codec class
+
+class BlockFrame(object):
+	header = struct.Struct('B') # codec tag
+	overhead = header.size
+
+	def __init__(self, codec):
+		self.lock = threading.Lock()
+		self.codec = codec
+		self.decoders = dict([(x.tag,x()) for x in codecs.values()])
+		self.decoders[codec.tag] = codec
+		self.raw_tag = BlockFrame.header.pack(RAW)
+		self.tag = BlockFrame.header.pack(codec.tag)
+		self.blocks = 0
+		self.packed = 0  # sent compressed
+		self.skipped = 0 # sent raw: they didn't shrink
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.errors = 0
+
+	def encode(self, data):
+		packed = self.codec.encode(data)
+		if len(packed) < len(data): frame = self.tag + packed
+		else:                       frame = self.raw_tag + data
+		with self.lock:
+			self.blocks = self.blocks + 1
+			if len(packed) < len(data): self.packed = self.packed + 1
+			else:                       self.skipped = self.skipped + 1
+			self.bytes_in = self.bytes_in + len(data)
+			self.bytes_out = self.bytes_out + len(frame)
+		return frame
+
+	def decode(self, frame): # the block, or None if frame is not one
+		if not frame: return None
+		tag = BlockFrame.header.unpack_from(frame)[0]
+		if tag == RAW: return frame[BlockFrame.overhead:]
+		codec = self.decoders.get(tag)
+		try:
+			if codec: return codec.decode(frame[BlockFrame.overhead:])
+		except zlib.error: pass
+		with self.lock: self.errors = self.errors + 1
+		return None
+
+	def stats(self):
+		ratio = 1.0
+		if self.bytes_out: ratio = round(float(self.bytes_in)/self.bytes_out,3)
+		return dict(codec=self.codec.name,blocks=self.blocks,packed=self.packed,skipped=self.skipped,
+					bytes_in=self.bytes_in,bytes_out=self.bytes_out,ratio=ratio,errors=self.errors)
+
+def build(spec): # 'name' or 'name:level' -> BlockFrame
+	name,_,level = spec.partition(':')
+	if name not in codecs: raise Exception('ping_codec: unknown codec (%s)'%name)
+	if level: return BlockFrame(codecs[name](int(level)))
+	return BlockFrame(codecs[name]())
+
+if __name__ == "__main__":
+	import random
+	frame = build('zlib')
+	blocks = ['text block %d '%x * 40 for x in range(100)]
+	blocks = blocks + [''.join([chr(random.getrandbits(8)) for y in range(1024)]) for x in range(100)]
+	for x in blocks:
+		if frame.decode(frame.encode(x)) != x: raise Exception('ping_codec: round trip failed')
+	print frame.stats()
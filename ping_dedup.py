@@ -0,0 +1,185 @@
+import threading, hashlib, collections, logging
+import ping_server, ping_reporter
+
+log = ping_reporter.setup_log('PingDedup')
+
+"""
+Content-addressed deduplication for PingDisk. A DedupServer wraps a
+PingServer engine and keeps one packet in flight per unique block content:
+logical block IDs map onto physical ones (the IDs the engine cycles), and
+a write whose content is already in flight just points its ID at that
+packet. A physical block is deleted once the last ID referring to it is
+rewritten or deleted; one that a single ID refers to is rewritten in
+place. Reads resolve through the map, and an ID mapped to nothing reads
+back empty at once instead of waiting out a timeout.
+
+	disk = ping_disk.PingDisk(server,dedup=True)
+	engine = functools.partial(ping_dedup.DedupServer,engine=ping_loop.PingLoopServer)
+
+Blocks are keyed by the SHA-1 of their content, plus domain(ID) when given:
+PingDisk passes the replica (or shard) number, so the copies that exist for
+redundancy are never merged into one.
+"""
+
+def inner(name): # an attribute of the wrapped engine, read and written through
+	return property(lambda self: getattr(self.engine,name),
+					lambda self,value: setattr(self.engine,name,value))
+
+class DedupServer(object):
+	block_size = inner('block_size')
+	empty_block = inner('empty_block')
+	batch = inner('batch')
+	rtt = inner('rtt')
+	server = inner('server')
+
+	def __init__(self, d_addr, block_size=1024, initial_timeout=2, transport=None, engine=None, domain=None):
+		if not engine: engine = ping_server.PingServer
+		self.engine = engine(d_addr,block_size,initial_timeout,transport)
+		self.domain = domain
+		self.lock = threading.Lock()
+		self.blocks = {}   # logical ID -> physical ID
+		self.contents = {} # content key -> physical ID
+		self.refs = {}     # physical ID -> [content key, logical IDs, event of its write]
+		self.next_id = 1
+		self.free = collections.deque() # released physical IDs, reused oldest first
+		self.writes = 0
+		self.hits = 0 # writes that found their content already in flight
+		self.done = threading.Event() # for ops that need no packet
+		self.done.set()
+
+	# the engine interface, as PingServer
+	def setup(self):               return self.engine.setup()
+	def start(self):               return self.engine.start()
+	def stop(self):                return self.engine.stop()
+	def timeout(self):             return self.engine.timeout()
+	def safe_timeout(self):        return self.engine.safe_timeout()
+	def null_block(self):          return self.engine.null_block()
+	def set_frame(self, frame):    return self.engine.set_frame(frame)
+
+	@property
+	def live(self): # logical IDs written and not since deleted
+		with self.lock: return set(self.blocks)
+
+	def key(self, ID, data):
+		digest = hashlib.sha1(data).digest()
+		if self.domain: return self.domain(ID),digest
+		return digest
+
+	def allocate(self): # caller holds self.lock
+		if self.free: return self.free.popleft()
+		pID = self.next_id
+		self.next_id = self.next_id + 1
+		return pID
+
+	def release(self, ID): # drop ID's reference; caller holds self.lock. returns a physical ID to delete
+		pID = self.blocks.pop(ID,None)
+		if pID is None: return None
+		ref = self.refs[pID]
+		ref[1].discard(ID)
+		if ref[1]: return None
+		del self.refs[pID]
+		del self.contents[ref[0]]
+		self.free.append(pID)
+		return pID
+
+	def write_block(self, ID, data, blocking=False, delay=0):
+		log.trace('DedupServer::write_block: ID=%d bytes=%d blocking=%s'%(ID,len(data),blocking))
+		if ID == 0: raise Exception('write_block: invalid block ID (0)')
+		if data == '%c'%0 * len(data): return self.delete_block(ID,blocking)
+		data = data[:self.block_size]
+		key = self.key(ID,data)
+		with self.lock:
+			self.writes = self.writes + 1
+			pID = self.contents.get(key)
+			if pID is not None and self.blocks.get(ID) == pID: return self.refs[pID][2] # rewritten as it was
+			old = self.blocks.get(ID)
+			if pID is None and old is not None and len(self.refs[old][1]) == 1:
+				# new content for a block only ID refers to: rewrite it in place,
+				# as the packet passes, rather than inject a new one
+				ref = self.refs[old]
+				del self.contents[ref[0]]
+				self.contents[key] = old
+				ref[0] = key
+				event = ref[2] = self.engine.write_block(old,data,False,delay)
+			elif pID is not None: # already in flight (or on its way)
+				self.hits = self.hits + 1
+				old = self.release(ID)
+				self.blocks[ID] = pID
+				ref = self.refs[pID]
+				ref[1].add(ID)
+				event = ref[2]
+				if old is not None: self.engine.delete_block(old)
+			else:
+				self.release(ID) # shared with other IDs: they keep it
+				pID = self.allocate()
+				self.blocks[ID] = pID
+				self.contents[key] = pID
+				self.refs[pID] = [key,set([ID]),None]
+				# queued under the lock: a later delete of pID can't overtake it
+				event = self.refs[pID][2] = self.engine.write_block(pID,data,False,delay)
+		if blocking: event.wait()
+		return event
+
+	def delete_block(self, ID, blocking=False):
+		log.trace('DedupServer::delete_block: ID=%d blocking=%s'%(ID,blocking))
+		if ID == 0: raise Exception('delete_block: invalid block ID (0)')
+		with self.lock:
+			pID = self.release(ID)
+			if pID is None: return self.done # still referred to, or never there
+			event = self.engine.delete_block(pID)
+		if blocking: event.wait()
+		return event
+
+	def read_block(self, ID, callback=None, cb_args=[], blocking=False):
+		log.trace('DedupServer::read_block: ID=%d blocking=%s'%(ID,blocking))
+		if ID == 0: raise Exception('read_block: invalid block ID (0)')
+		with self.lock:
+			pID = self.blocks.get(ID)
+			# queued under the lock: a write that frees pID (and hands it to
+			# another ID) is queued after it, so this reads ID's old or new data
+			if pID is not None: event = self.engine.read_block(pID,self.__resolved,[ID,callback,cb_args])
+		if pID is None:
+			if callback: callback(ID,self.null_block(),*cb_args)
+			return self.done
+		if blocking: event.wait()
+		return event
+
+	def __resolved(self, pID, data, ID, callback, cb_args):
+		if callback: callback(ID,data,*cb_args)
+
+	def add_listener(self, handler, timeout, args):
+		# every logical ID is reported whenever its physical block passes
+		self.engine.add_listener(self.__heard,timeout,[handler,args])
+
+	def __heard(self, pID, addr, data, handler, args):
+		with self.lock:
+			ref = self.refs.get(pID)
+			if not ref: return
+			IDs = list(ref[1])
+		for x in IDs: handler(x,addr,data,*args)
+
+	def stats(self):
+		with self.lock:
+			logical,physical = len(self.blocks),len(self.refs)
+		ratio = 1.0
+		if physical: ratio = round(float(logical)/physical,3)
+		return dict(logical=logical,physical=physical,ratio=ratio,writes=self.writes,hits=self.hits)
+
+if __name__ == "__main__":
+	import ping_echo
+	ping_reporter.start_log(log,logging.DEBUG)
+	responder = ping_echo.EchoResponder(rtt=0.02)
+	PS = DedupServer(ping_echo.local_server,transport=responder.build_socket)
+	try:
+		PS.setup()
+		PS.start()
+		writes = [PS.write_block(x,'block %d'%(x%10)) for x in range(1,1001)]
+		for x in writes: x.wait()
+		store = {}
+		reads = [PS.read_block(x,lambda ID,data: store.__setitem__(ID,data)) for x in range(1,1001)]
+		for x in reads: x.wait()
+		log.info('%d of 1000 blocks read back'%len([x for x in range(1,1001) if store[x].rstrip('\0') == 'block %d'%(x%10)]))
+		log.info('dedup: %s'%PS.stats())
+	finally:
+		PS.stop()
+		responder.stop()
@@ -1,17 +1,229 @@
 import ping, threading, time, socket, select, sys, struct, logging
-import binascii, threading, collections, math, random
-import ping, ping_server, ping_reporter
+import binascii, threading, collections, math, random, functools
+import ping, ping_server, ping_erasure, ping_cache, ping_extent, ping_codec, ping_dedup, ping_reporter
 
 log = ping_reporter.setup_log('PingDisk')
 
+replica_shift = 28 # replica number lives in the top bits of a server block ID
+replica_mask = (1<<replica_shift) - 1
+
+def replica_of(ID): # a server block's replica (or shard) number
+	return ID >> replica_shift
+
+class EventGroup(list): # waits on several block events as one
+	def is_set(self):
+		return all([x.is_set() for x in self])
+
+	def wait(self, timeout=None):
+		for x in self: x.wait(timeout)
+		return self.is_set()
+
+class ReplicaRead: # completes on the first replica that arrives with data
+	def __init__(self, disk, ID, datastore, copies):
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.disk = disk
+		self.ID = ID
+		self.datastore = datastore
+		self.pending = copies
+		self.missing = []
+		self.data = None
+
+	def is_set(self):            return self.event.is_set()
+	def wait(self, timeout=None): return self.event.wait(timeout)
+
+	def callback(self, pID, data, replica):
+		with self.lock:
+			self.pending = self.pending - 1
+			if data.strip('\0') == '': self.missing.append(replica)
+			elif self.data == None:
+				self.data = data
+				self.datastore[self.ID] = data
+				self.event.set()
+			if self.pending: return
+			if self.data == None:
+				self.datastore[self.ID] = data
+				self.event.set()
+			elif self.missing: # lost copies: write them back from a survivor
+				log.notice('PingDisk: repairing block %d (%d lost copies)'%(self.ID,len(self.missing)))
+				for x in self.missing: self.disk.write_replica(self.ID,x,self.data)
+
+class StripeRead: # reads every live shard of a stripe; targets finish once any k are known
+	def __init__(self, disk, stripe, targets, datastore):
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.disk = disk
+		self.code = disk.code
+		self.stripe = stripe
+		self.targets = set(targets) # data shard indices wanted
+		self.datastore = datastore
+		self.shards = {} # index -> shard known: arrived with data, or never written
+		self.missing = []
+		# a data shard not in the extent map (never written, or deleted) is
+		# known zeros: it counts towards k without a read. only shards that
+		# should be in flight are read, and one of them arriving empty is lost
+		block_size = disk.block_size()
+		k,m = self.code.k,self.code.m
+		for x in range(k):
+			ID = disk.stripe_block(stripe,x)
+			if not disk.extents.overlaps(ID,ID+1): self.shards[x] = '\0'*block_size
+		if len(self.shards) == k: # no data, so no parity either
+			for x in range(m): self.shards[k+x] = '\0'*block_size
+		self.wanted = [x for x in range(k + m) if x not in self.shards]
+		self.pending = len(self.wanted)
+		for x in [x for x in self.targets if x in self.shards]: self.store(x,self.shards[x])
+		if not self.targets: self.event.set()
+
+	def is_set(self):            return self.event.is_set()
+	def wait(self, timeout=None): return self.event.wait(timeout)
+
+	def store(self, index, data):
+		self.datastore[self.disk.stripe_block(self.stripe,index)] = data
+		self.targets.discard(index)
+
+	def callback(self, pID, data, index):
+		# an empty shard is either lost or really empty: only data counts towards k
+		block_size = self.disk.block_size()
+		data = data[:block_size].ljust(block_size,'\0')
+		with self.lock:
+			self.pending = self.pending - 1
+			if data.strip('\0') == '': self.missing.append(index)
+			else:
+				self.shards[index] = data
+				if index in self.targets: self.store(index,data)
+			if self.targets and len(self.shards) >= self.code.k:
+				for x,block in self.code.decode(self.shards,list(self.targets)).items(): self.store(x,block)
+			if self.targets and not self.pending: # under k known: more shards lost than m
+				for x in list(self.targets): self.store(x,'\0'*block_size)
+			if not self.targets: self.event.set()
+			if self.pending or len(self.shards) < self.code.k or not self.missing: return
+		# lost shards: rebuild them from the survivors and inject them again
+		rebuilt = self.code.decode(self.shards,self.missing)
+		lost = [x for x in self.missing if rebuilt[x].strip('\0') != '']
+		if not lost: return
+		log.notice('PingDisk: repairing stripe %d (%d lost shards)'%(self.stripe,len(lost)))
+		for x in lost: self.disk.write_shard(self.stripe,x,rebuilt[x])
+
 class PingDisk():
-	def __init__(self, d_addr, block_size=1024, timeout=2):
-		self.server = ping_server.PingServer(d_addr,block_size,timeout)
-		self.server.setup()
-		self.server.start()
+	def __init__(self, d_addr, block_size=1024, timeout=2, transport=None, engine=None, stripe_unit=1,
+			replicas=1, spread=True, erasure=None, cache=0, refresh=False, readahead=0,
+			writeback=0, writeback_age=1.0, compress=None, dedup=False):
+		# d_addr may list several servers: blocks are striped across them
+		# (RAID-0) in runs of stripe_unit blocks. with replicas > 1 each block
+		# cycles as that many phase-offset copies (on the following servers
+		# when spread, else all on one) and reads finish on the first arrival.
+		# erasure=(k,m) instead groups blocks into stripes of k data shards
+		# plus m Reed-Solomon parity shards, rotated across the servers.
+		# cache > 0 keeps up to that many bytes of blocks in a write-through
+		# LRU; refresh also updates cached blocks from every passing packet.
+		# readahead > 0 posts reads of up to that many blocks ahead of
+		# sequential reads. writeback > 0 holds written blocks in memory until
+		# that many bytes are dirty or the oldest is writeback_age seconds old.
+		# compress (a ping_codec.BlockFrame, or a spec such as 'zlib:9') sends
+		# every block through that codec; blocks that don't shrink go out raw.
+		# dedup keeps one packet per unique block content on each server
+		# (replicas and shards of a stripe are never merged with each other)
+		if not engine: engine = ping_server.PingServer # or ping_loop.PingLoopServer
+		if dedup: engine = functools.partial(ping_dedup.DedupServer,engine=engine,domain=replica_of)
+		if not 0 < replicas <= 1 << (32 - replica_shift):
+			raise Exception('PingDisk: invalid replica count (%d)'%replicas)
+		self.code = None
+		if erasure:
+			k,m = erasure
+			if replicas > 1: raise Exception('PingDisk: erasure coding replaces replicas')
+			if k < 1 or m < 0 or k + m > 1 << (32 - replica_shift):
+				raise Exception('PingDisk: invalid erasure code (%d,%d)'%(k,m))
+			self.code = ping_erasure.ErasureCode(k,m)
+			self.stripe_lock = threading.Lock() # stripe read-modify-write
+		self.alloc_lock = threading.Lock() # region search and reservation
+		self.merge_locks = [threading.Lock() for x in range(64)] # partial block read-modify-write, by ID
+		if isinstance(d_addr,basestring): d_addr = [d_addr]
+		if not d_addr: raise Exception('PingDisk: no servers')
+		self.servers = [engine(x,block_size,timeout,transport) for x in d_addr]
+		for x in self.servers: x.setup()
+		self.compression = None
+		if compress:
+			if isinstance(compress,basestring): compress = ping_codec.build(compress)
+			self.compression = compress
+			for x in self.servers: x.set_frame(compress)
+		self.server = self.servers[0] # block size / timeout reference
+		self.stripe_unit = stripe_unit
+		self.replicas = replicas
+		self.spread = spread
+		if len(self.servers) > 1: # stripes need one block size everywhere
+			block_size = min([x.block_size for x in self.servers])
+			for x in self.servers:
+				x.block_size = block_size
+				x.empty_block = x.null_block()
+			log.notice('striping %d-byte blocks across %d servers'%(block_size,len(self.servers)))
+		self.cache = None
+		if cache: self.cache = ping_cache.BlockCache(cache)
+		self.extents = ping_extent.ExtentMap() # logical blocks reserved or written, and not deleted
+		self.readahead = None
+		if readahead: self.readahead = ping_cache.Readahead(self,readahead)
+		self.writeback = None
+		if writeback: self.writeback = ping_cache.WriteBack(self.commit_blocks,writeback,writeback_age)
+		for x in self.servers: x.start()
+		if self.cache and refresh:
+			for x in range(len(self.servers)):
+				self.servers[x].add_listener(self.__refresh_block,sys.maxint,[x])
 
 	def stop(self):
-		self.server.stop()
+		if self.writeback: # give the last dirty blocks their chance to go out
+			for x in self.writeback.stop(): x.wait(self.safe_timeout())
+		for x in self.servers: x.stop()
+
+	def flush(self, blocking=True):
+		if not self.writeback: return []
+		events = self.writeback.flush()
+		if blocking:
+			for x in events: x.wait()
+		return events
+
+	def track(self, ID, data): # keep the extent map in step with a block write
+		# only a delete frees a block: one written with zeros may still be
+		# mapped by its file, and must not be handed out again
+		if data != self.server.empty_block: self.extents.add(ID)
+
+	def stored(self, data): # data as a later read of its block returns it
+		data = data[:self.block_size()]
+		if self.code: data = data.ljust(self.block_size(),'\0')
+		if data.strip('\0') == '': return self.server.empty_block
+		return data
+
+	def route(self, ID, replica=0):
+		# logical block -> (server, block on that server); both are 1-based
+		count = len(self.servers)
+		if count == 1: server,pID = self.server,ID
+		else:
+			unit = self.stripe_unit
+			stripe,offset = divmod(ID-1,unit)
+			row,index = divmod(stripe,count)
+			if self.spread: index = (index + replica) % count
+			server,pID = self.servers[index],row*unit + offset + 1
+		return server,pID | (replica << replica_shift)
+
+	def shard(self, stripe, index):
+		# shard index of a stripe -> (server, block on that server); the
+		# shard index takes the replica bits and rotates over the servers
+		server = self.servers[(stripe + index) % len(self.servers)]
+		return server,(stripe + 1) | (index << replica_shift)
+
+	def stripe_block(self, stripe, index): # data shard -> logical block
+		return stripe*self.code.k + index + 1
+
+	def logical(self, index, ID):
+		# inverse of route (or shard) for block ID on self.servers[index]
+		replica,ID = ID >> replica_shift,ID & replica_mask
+		if self.code: # parity shards hold no logical block
+			if replica >= self.code.k: return None
+			return self.stripe_block(ID - 1,replica)
+		count = len(self.servers)
+		if count == 1: return ID
+		if self.spread: index = (index - replica) % count
+		unit = self.stripe_unit
+		row,offset = divmod(ID-1,unit)
+		return (row*count + index)*unit + offset + 1
 
 	def size(self):
 		return self.server.block_size * (1<<28)
@@ -23,30 +235,92 @@ class PingDisk():
 		return max(2,4096/self.block_size())
 
 	def read_block(self, ID, datastore, blocking=False):
-		event = self.server.read_block(ID, self.__read_callback, datastore, False)
+		if self.code:
+			stripe,index = divmod(ID-1,self.code.k)
+			event = self.read_stripe(stripe,[index],datastore[0])
+		elif self.replicas == 1:
+			server,pID = self.route(ID)
+			event = server.read_block(pID, self.__read_callback, datastore+[ID], False)
+		else:
+			event = ReplicaRead(self, ID, datastore[0], self.replicas)
+			for x in range(self.replicas):
+				server,pID = self.route(ID,x)
+				server.read_block(pID, event.callback, [x], False)
 		if not blocking: return event
 		event.wait()
 
+	def read_stripe(self, stripe, targets, datastore):
+		event = StripeRead(self, stripe, targets, datastore)
+		for x in event.wanted:
+			server,pID = self.shard(stripe,x)
+			server.read_block(pID, event.callback, [x], False)
+		return event
+
+	def fetch_blocks(self, blocks, datastore):
+		# post reads of blocks into datastore; returns {ID: event}, where the
+		# blocks of one stripe share the stripe's single read
+		if not self.code: return dict([(x,self.read_block(x,[datastore])) for x in blocks])
+		stripes = collections.defaultdict(list)
+		for x in blocks:
+			stripe,index = divmod(x-1,self.code.k)
+			stripes[stripe].append(index)
+		events = {}
+		for stripe,indices in stripes.items():
+			event = self.read_stripe(stripe,indices,datastore)
+			for x in indices: events[self.stripe_block(stripe,x)] = event
+		return events
+
 	def read_block_sync(self, ID):
+		if self.writeback:
+			data = self.writeback.get(ID)
+			if data is not None: return data
+		if self.cache:
+			data = self.cache.get(ID)
+			if data is not None: return data
+			self.cache.expect(ID)
 		data = {}
 		self.read_block(ID,[data],True)
+		if self.cache: self.cache.fill(ID,data[ID])
 		return data[ID]
 
 	def read_blocks(self, init_block, fini_block):
 		data = {}
-		events = []
 		result = ''
 		blocks = range(init_block,fini_block+1)
 		log.debug('PingDisk::read_blocks: blocks %d-%d'%(init_block,fini_block))
-		for x in blocks: events.append(self.read_block(x,[data]))
-		for x in events: x.wait()
+		staged = {}
+		if self.readahead: staged = self.readahead.access(init_block,fini_block)
+		if self.writeback: # read-your-writes
+			for x in blocks:
+				dirty = self.writeback.get(x)
+				if dirty is not None: data[x] = dirty
+		missing = [x for x in blocks if x not in data]
+		if self.cache:
+			for x in missing:
+				cached = self.cache.get(x)
+				if cached is not None: data[x] = cached
+			missing = [x for x in missing if x not in data]
+			for x in missing: self.cache.expect(x)
+		events = self.fetch_blocks([x for x in missing if x not in staged],data)
+		for x in missing:
+			if x not in staged: continue
+			event,store = staged[x]
+			event.wait()
+			data[x] = store[x]
+		for x in set(events.values()): x.wait()
+		if self.cache:
+			for x in missing: self.cache.fill(x,data[x])
 		for x in blocks: result = result + data[x]
 		return result
 
-	def __read_callback(self, ID, data, data_store):
+	def __read_callback(self, pID, data, data_store, ID):
 		log.trace('PingDisk::read::callback: ID=%d bytes=%d'%(ID,len(data)))
 		data_store[ID] = data
 
+	def __refresh_block(self, ID, addr, data, index):
+		ID = self.logical(index,ID)
+		if ID: self.cache.refresh(ID,data)
+
 	def read(self, index, length):
 		endex = index + length
 		init_index = (index % self.server.block_size)
@@ -68,7 +342,55 @@ class PingDisk():
 
 	def write_block(self, ID, data, blocking=False):
 		log.trace('PingDisk::write_block: ID=%d bytes=%d'%(ID,len(data)))
-		return self.server.write_block(ID,data,blocking)
+		if self.code: return self.write_stripes({ID:data},blocking)
+		if self.readahead: self.readahead.invalidate(ID)
+		self.track(ID,self.stored(data))
+		if self.cache: self.cache.put(ID,self.stored(data))
+		if self.replicas == 1:
+			server,pID = self.route(ID)
+			return server.write_block(pID,data,blocking)
+		events = EventGroup([self.write_replica(ID,x,data) for x in range(self.replicas)])
+		if blocking: events.wait()
+		return events
+
+	def write_replica(self, ID, replica, data):
+		# new copies are injected a fraction of an RTT apart, spreading them around the loop
+		server,pID = self.route(ID,replica)
+		return server.write_block(pID,data,False,replica*server.rtt/self.replicas)
+
+	def write_shard(self, stripe, index, data):
+		server,pID = self.shard(stripe,index)
+		return server.write_block(pID,data)
+
+	def write_stripes(self, blocks, blocking=False):
+		# blocks: {ID: data}. stripes only partly covered are read first so
+		# their parity can be recomputed; empty data shards are deleted
+		block_size = self.block_size()
+		k = self.code.k
+		stripes = collections.defaultdict(dict)
+		for ID,data in blocks.items():
+			stripe,index = divmod(ID-1,k)
+			stripes[stripe][index] = data[:block_size].ljust(block_size,'\0')
+		events = EventGroup()
+		with self.stripe_lock:
+			current,reads = {},[]
+			for stripe,shards in stripes.items():
+				wanted = [x for x in range(k) if x not in shards]
+				if wanted: reads.append(self.read_stripe(stripe,wanted,current))
+			for x in reads: x.wait()
+			for stripe,shards in stripes.items():
+				data = [shards.get(x) or current[self.stripe_block(stripe,x)] for x in range(k)]
+				parity = self.code.encode(data)
+				for x in range(k):
+					ID = self.stripe_block(stripe,x)
+					if ID not in blocks: continue
+					self.track(ID,self.stored(data[x]))
+					if self.cache: self.cache.put(ID,data[x])
+					if self.readahead: self.readahead.invalidate(ID)
+					events.append(self.write_shard(stripe,x,data[x]))
+				for x in range(self.code.m): events.append(self.write_shard(stripe,k+x,parity[x]))
+		if blocking: events.wait()
+		return events
 
 	def write_blocks(self, index, data):
 		endex = index + len(data)
@@ -79,26 +401,49 @@ class PingDisk():
 		fini_block = (endex / self.server.block_size) + 1
 		log.debug('PingDisk::write_blocks: blocks %d-%d'%(init_block,fini_block))
 
-		events = []
-		if init_index == 0:
+		# blocks only partly written are merged with their current data; no
+		# other merge of them may start until this write is visible to reads
+		partial = []
+		if init_index != 0 or len(data) < block_size: partial.append(init_block)
+		if init_block != fini_block and fini_index != 0: partial.append(fini_block)
+		locks = sorted(set([x % len(self.merge_locks) for x in partial]))
+		for x in locks: self.merge_locks[x].acquire()
+		try: return self.merge_blocks(index,data,init_block,fini_block)
+		finally:
+			for x in reversed(locks): self.merge_locks[x].release()
+
+	def merge_blocks(self, index, data, init_block, fini_block):
+		block_size = self.server.block_size
+		init_index = (index % block_size)
+		fini_index = ((index + len(data)) % block_size)
+		writes = []
+		if init_index == 0 and len(data) >= block_size:
 			start_block = data[:block_size]
 		else:
 			start_block = self.read_block_sync(init_block)
 			start_block = self.__block_merge(start_block,data,init_index)
-		events.append(self.write_block(init_block,start_block))
-		if init_block == fini_block: return events
-
-		data = data[self.server.block_size - init_index:]
-		for x in range(init_block+1,fini_block):
-			events.append(self.write_block(x,data[:block_size]))
-			data = data[block_size:]
-		
-		if fini_index != 0:
-			end_block = self.read_block_sync(fini_block)
-			end_block = self.__block_merge(end_block,data,0)
-			events.append(self.write_block(fini_block,end_block))
+		writes.append((init_block,start_block))
+		if init_block != fini_block:
+			data = data[self.server.block_size - init_index:]
+			for x in range(init_block+1,fini_block):
+				writes.append((x,data[:block_size]))
+				data = data[block_size:]
+
+			if fini_index != 0:
+				end_block = self.read_block_sync(fini_block)
+				end_block = self.__block_merge(end_block,data,0)
+				writes.append((fini_block,end_block))
+		if not self.writeback: return self.commit_blocks(writes)
+		events = []
+		for x,y in writes:
+			self.track(x,self.stored(y))
+			events.extend(self.writeback.put(x,self.stored(y)))
 		return events
 
+	def commit_blocks(self, writes): # [(ID, data)] onto the network
+		if self.code: return [self.write_stripes(dict(writes))] # one parity update per stripe
+		return [self.write_block(x,y) for x,y in writes]
+
 	def write(self, index, data, blocking=True):
 		events = self.write_blocks(index,data)
 		if not blocking: return events
@@ -107,12 +452,25 @@ class PingDisk():
 	def delete_blocks(self, index, length):
 		endex = index + length
 		init_block = (index / self.server.block_size) + 1 # byte 0 is in block 1
-		fini_block = (endex / self.server.block_size) + 1
+		fini_block = ((endex - 1) / self.server.block_size) + 1 # endex itself is not deleted
 		log.debug('PingDisk::delete_blocks: blocks %d-%d'%(init_block,fini_block))
+		if not self.writeback: return self.delete_range(init_block,fini_block)
+		with self.writeback.lock: # no flush may land behind the delete
+			for x in range(init_block,fini_block+1): self.writeback.discard(x)
+			return self.delete_range(init_block,fini_block)
 
+	def delete_range(self, init_block, fini_block):
+		self.extents.remove(init_block,fini_block-init_block+1)
+		for x in range(init_block,fini_block+1):
+			if self.cache: self.cache.invalidate(x)
+			if self.readahead: self.readahead.invalidate(x)
+		if self.code: # an empty data shard is a deleted one, but parity must follow
+			return [self.write_stripes(dict([(x,'') for x in range(init_block,fini_block+1)]))]
 		events = []
 		for x in range(init_block,fini_block+1):
-			events.append(self.server.delete_block(x))
+			for y in range(self.replicas):
+				server,pID = self.route(x,y)
+				events.append(server.delete_block(pID))
 		return events
 
 	# delete operates at block-level boundaries
@@ -122,34 +480,43 @@ class PingDisk():
 		if not blocking: return events
 		for x in events: x.wait()
 
+	def live_blocks(self, timeout=None):
+		# from the extent map: no need to wait out a cycle
+		return dict.fromkeys(self.extents,1)
+
+	def scan_blocks(self, timeout=None):
+		# the blocks actually seen in flight: listen on every server at once,
+		# so striping doesn't multiply the wait
+		self.flush()
+		store = {}
+		if not timeout: timeout = self.safe_timeout()
+		for x in range(len(self.servers)):
+			self.servers[x].add_listener(self.__live_block,timeout,[store,x])
+		time.sleep(timeout)
+		return store
+
+	def __live_block(self, ID, addr, data, store, index):
+		ID = self.logical(index,ID)
+		if ID: store[ID] = 1
+
 	def free_blocks(self, timeout=None):
-		blocks = ping_server.live_blocks(self.server,timeout)
-		log.debug('live_blocks: %s'%blocks)
-		return ping_server.free_blocks(blocks)
+		return self.extents.free_blocks()
 
 	def used_blocks(self, timeout=None):
-		blocks = ping_server.live_blocks(self.server,timeout)
-		log.debug('used_blocks: %s'%blocks)
-		if blocks: return ping_server.used_blocks(blocks)
-		return {}
+		return self.extents.used_blocks()
 
 	def get_block_region(self, blocks=1, timeout=None):
-		free = self.free_blocks(timeout)
 		log.debug('get_block_region: %d blocks'%(blocks))
-		log.debug('frees -> %s'%free)
-		if not free: return None
 		max_blockid = (1<<28)
 
 		# 1) allocate an encompassing span of regions
-		top_node = max(free.keys())
+		top_node = self.extents.end()
 		reg_size = self.region_size() * int(1 + blocks/self.region_size())
 		top_node = reg_size * int(1 + top_node/reg_size)
 		if max_blockid - top_node > reg_size: return top_node
 
 		# 2)try minimal sufficiently large region
-		region = [(v,k) for (k,v) in free.iteritems() if v >= blocks]
-		if region: return min(region)[1]
-		return None
+		return self.extents.best_fit(blocks)
 
 	def timeout(self):				return self.server.timeout()
 	def safe_timeout(self):			return self.server.safe_timeout()
@@ -161,30 +528,42 @@ class PingDisk():
 		if not timeout: timeout = self.safe_timeout()
 		if target: return self.test_region(target,bytes,timeout)
 		block = self.byte_to_block(bytes)              # to blocks
-		region = self.get_block_region(block,timeout)  # <------>
-		if region: region = self.block_to_byte(region) # to bytes
+		with self.alloc_lock: # reserved until written, so no other caller gets it too
+			region = self.get_block_region(block,timeout)  # <------>
+			if region: self.extents.add(region,block)
+		if region: region = self.block_to_byte(region-1) # to bytes: block 1 starts at byte 0
 		log.debug('get_region: allocated region %d (%d bytes)'%(region,bytes))
 		return region
 
+	def claim_region(self, index, length):
+		# reserve bytes index..index+length-1 if none of their blocks is live
+		block_size = self.block_size()
+		init_block,fini_block = index/block_size + 1,(index + length - 1)/block_size + 1
+		with self.alloc_lock:
+			if self.extents.overlaps(init_block,fini_block + 1): return False
+			self.extents.add(init_block,fini_block - init_block + 1)
+		return True
+
 	def test_region(self, start, end, length, timeout=None):
 		if not timeout: timeout = self.safe_timeout()
 		log.debug('test_region: region=%d-%d length=%d'%(start,end,length))
 		if length < end: return start # smaller block
 		collision = [start+end-1,start+length-1]
 		collision2 = [collision[0],collision[1]]
-		collision[0] = self.byte_to_block(collision[0])
-		collision[1] = self.byte_to_block(collision[1])
+		collision[0] = collision[0]/self.block_size() + 1 # last block now, and once grown
+		collision[1] = collision[1]/self.block_size() + 1
 		if collision[0] == collision[1]: return start # same block
-		used = self.used_blocks(timeout)
-		if not used: # 0 used blocks implies no root directory...
+		if not self.extents.blocks: # 0 used blocks implies no root directory...
 			log.exception('test_region: used blocks returned nil')
 			raise Exception('test_region: used blocks returned nil')
 
-		for x in used:
-			if x <= collision[0]: continue # used block before test region (no collision)
-			if x  > collision[1]: continue # used block begins after collision space
-			log.debug('test_region: collision at node %d'%x)
-			return False
+		# any live block past the region's own, up to the end of its growth;
+		# if there is none, the growth is reserved as get_region's regions are
+		with self.alloc_lock:
+			if self.extents.overlaps(collision[0]+1,collision[1]+1):
+				log.debug('test_region: collision in blocks %d-%d'%(collision[0]+1,collision[1]))
+				return False
+			self.extents.add(collision[0]+1,collision[1]-collision[0])
 		return start
 		
 
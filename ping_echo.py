@@ -0,0 +1,205 @@
+import os, socket, struct, select, threading, heapq, random, time, errno, logging
+import ping, ping_reporter
+
+log = ping_reporter.setup_log('PingEcho')
+
+"""
+In-process echo responder: a drop-in replacement for ping.build_socket that
+answers ICMP echo requests without root or a remote host. Every destination
+address is answered, so one responder can stand in for several servers.
+
+	responder = EchoResponder(rtt=0.02,jitter=0.005,loss=0.01)
+	server = ping_server.PingServer(local_server,transport=responder.build_socket)
+
+Replies are full IPv4 packets (as a raw socket would return them) delivered
+through a loopback UDP socket, so select() and SO_RCVBUF overflow behave like
+they do on the real thing. Sockets built in a forked child (ping_shard
+workers) send their requests to the responder over loopback UDP as well.
+"""
+
+local_server = '127.0.0.1'
+distributions = ['fixed','uniform','normal','exponential']
+
+class EchoSocket(object): # socket-like endpoint handed to PingServer
+	header_offset = 8 # a socket filter sees the UDP header ahead of the IP packet
+
+	def __init__(self, responder, RCVBUF=1024*1024):
+		self.responder = responder
+		self.rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:    self.rsock.setsockopt(socket.SOL_SOCKET, 33, RCVBUF) # SO_RCVBUFFORCE
+		except: self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+		self.rsock.bind(('127.0.0.1',0))
+		self.target = self.rsock.getsockname()
+		self.local = os.getpid() == responder.pid # else: forked off the responder's process
+		self.closed = False
+
+	def __getattr__(self, name): # settimeout, setblocking, fileno, setsockopt, ...
+		return getattr(self.rsock, name)
+
+	def sendto(self, packet, address):
+		if self.closed: raise socket.error(errno.EBADF, 'EchoSocket: socket closed')
+		packet = str(ping.as_string(packet))
+		if self.local: self.responder.echo(self.target, packet, address)
+		else: # replies come back to rsock, the sender
+			self.rsock.sendto(socket.inet_aton(address[0]) + packet, self.responder.address)
+		return len(packet)
+
+	def address(self, packet): # raw sockets report the IP source, not the UDP one
+		return (socket.inet_ntoa(packet[12:16]), 0)
+
+	def recvfrom(self, size):
+		data,addr = self.rsock.recvfrom(size)
+		return data,self.address(data)
+
+	def recvfrom_into(self, buffer, nbytes=0):
+		length,addr = self.rsock.recvfrom_into(buffer,nbytes)
+		return length,self.address(str(buffer[:16]))
+
+	def close(self):
+		self.closed = True
+		if self.local: self.responder.detach(self)
+		self.rsock.close()
+
+class EchoResponder(threading.Thread):
+	def __init__(self, rtt=0.02, jitter=0.0, distribution='uniform', loss=0.0,
+			duplicate=0.0, reorder=0.0, reorder_delay=None, max_payload=None, seed=None):
+		if distribution not in distributions:
+			raise Exception('EchoResponder: unknown RTT distribution (%s)'%distribution)
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.rtt = rtt                    # mean round trip (seconds)
+		self.jitter = jitter              # spread around rtt (seconds)
+		self.distribution = distribution
+		self.loss = loss                  # probability a request is never answered
+		self.duplicate = duplicate        # probability a reply arrives twice
+		self.reorder = reorder            # probability a reply is held back
+		self.reorder_delay = reorder_delay if reorder_delay != None else rtt
+		self.max_payload = max_payload    # replies are truncated to this many bytes
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.queue = [] # heap of (deliver time, sequence, target address, packet)
+		self.sequence = 0
+		self.sockets = []
+		self.running = False
+		self.pid = os.getpid()
+		# inbound: requests from forked sockets, and wakeups; outbound: replies
+		self.inbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.inbound.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024*1024)
+		self.inbound.bind(('127.0.0.1',0))
+		self.inbound.setblocking(0)
+		self.address = self.inbound.getsockname()
+		self.outbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.outbound.setblocking(0)
+		self.stats = dict(requests=0,replies=0,lost=0,duplicated=0,reordered=0,overflow=0)
+
+	def build_socket(self, RCVBUF=1024*1024): # same signature as ping.build_socket
+		sock = EchoSocket(self, RCVBUF)
+		if not sock.local: return sock # the responder thread lives in the parent
+		with self.lock:
+			self.sockets.append(sock)
+			if not self.running and not self.is_alive():
+				self.running = True
+				self.start()
+		return sock
+
+	def detach(self, sock):
+		with self.lock:
+			if sock in self.sockets: self.sockets.remove(sock)
+
+	def wake(self):
+		try: self.outbound.sendto('', self.address)
+		except socket.error: pass # inbound full: the thread is awake anyway
+
+	def stop(self):
+		log.debug('EchoResponder terminating')
+		self.running = False
+		self.wake()
+
+	def delay(self):
+		rtt,jitter = self.rtt,self.jitter
+		if   self.distribution == 'uniform': rtt = rtt + self.random.uniform(-jitter,jitter)
+		elif self.distribution == 'normal':  rtt = self.random.gauss(rtt,jitter)
+		elif self.distribution == 'exponential' and jitter:
+			rtt = rtt + self.random.expovariate(1.0/jitter)
+		if self.reorder and self.random.random() < self.reorder:
+			self.stats['reordered'] += 1
+			rtt = rtt + self.reorder_delay
+		return max(0,rtt)
+
+	def build_reply(self, address, code, csum, block_id, payload, truncated):
+		if truncated: csum = ping.checksum(struct.pack('=bbHL',0,code,0,block_id)+payload)
+		else:         csum = ping.checksum_update(csum,8|(code&0xFF)<<8,(code&0xFF)<<8)
+		icmp = struct.pack('=bbHL',0,code,csum,block_id) + payload
+		src = socket.inet_aton(address[0])
+		ip = struct.pack('!BBHHHBBH4s4s',0x45,0,20+len(icmp),0,0,64,
+						 socket.IPPROTO_ICMP,0,src,socket.inet_aton('127.0.0.1'))
+		return ip + icmp
+
+	def echo(self, target, packet, address):
+		if len(packet) < 8: return
+		type,code,csum,block_id = struct.unpack('=bbHL',packet[:8])
+		if type != 8: return # only echo requests are answered
+		self.stats['requests'] += 1
+		if self.loss and self.random.random() < self.loss:
+			self.stats['lost'] += 1
+			return
+		payload = packet[8:]
+		truncated = self.max_payload != None and len(payload) > self.max_payload
+		if truncated: payload = payload[:self.max_payload]
+		reply = self.build_reply(address,code,csum,block_id,payload,truncated)
+		copies = 1
+		if self.duplicate and self.random.random() < self.duplicate:
+			self.stats['duplicated'] += 1
+			copies = 2
+		now = time.time()
+		wake = False
+		with self.lock:
+			for x in range(copies):
+				self.sequence = self.sequence + 1
+				item = (now+self.delay(),self.sequence,target,reply)
+				heapq.heappush(self.queue,item)
+				wake = wake or self.queue[0] is item
+		if wake and threading.current_thread() is not self: self.wake()
+
+	def receive(self):
+		while True: # drain requests from forked sockets: destination IP + ICMP message
+			try: data,sender = self.inbound.recvfrom(65536)
+			except socket.error: return
+			if len(data) > 4: self.echo(sender, data[4:], (socket.inet_ntoa(data[:4]),0))
+
+	def run(self):
+		log.debug('EchoResponder starting')
+		while self.running:
+			due = []
+			with self.lock:
+				now = time.time()
+				while self.queue and self.queue[0][0] <= now: due.append(heapq.heappop(self.queue))
+				timeout = None
+				if self.queue: timeout = self.queue[0][0] - now
+			for deliver,sequence,target,packet in due:
+				self.stats['replies'] += 1
+				try: self.outbound.sendto(packet, target)
+				except socket.error: self.stats['overflow'] += 1
+			if due: timeout = 0 # deliveries first, but keep draining requests
+			if select.select([self.inbound],[],[],timeout)[0]: self.receive()
+
+if __name__ == "__main__":
+	import ping_server
+	ping_reporter.start_log(log,logging.DEBUG)
+	responder = EchoResponder(rtt=0.05,jitter=0.01,loss=0.01,duplicate=0.01,reorder=0.01)
+	PS = ping_server.PingServer(local_server,transport=responder.build_socket)
+	try:
+		PS.setup()
+		PS.start()
+		for x in range(1,101): PS.write_block(x,'block %d'%x)
+		time.sleep(2)
+		data = {}
+		def store(ID, block, datastore): datastore[ID] = block.rstrip('\0')
+		events = [PS.read_block(x,store,[data]) for x in range(1,101)]
+		for x in events: x.wait()
+		log.info('%d of 100 blocks survived'%len([x for x in data if data[x] == 'block %d'%x]))
+		log.info('responder: %s'%responder.stats)
+	finally:
+		PS.stop()
+		responder.stop()
+		responder.join()
@@ -0,0 +1,105 @@
+import binascii
+
+"""
+Systematic Reed-Solomon erasure code over GF(256) for PingDisk stripes.
+
+A stripe is k equal-size data blocks plus m parity blocks; any k of the k+m
+rebuild the rest. Parity rows come from a Cauchy matrix, so every k x k
+submatrix of the generator is invertible.
+
+Block arithmetic stays in C: multiplying a block by a constant is one
+str.translate through a 256-byte table, and adding blocks is a XOR of the
+blocks read as (long) integers.
+"""
+
+polynomial = 0x11d
+gf_exp = [0] * 512
+gf_log = [0] * 256
+
+x = 1
+for i in range(255):
+	gf_exp[i] = x
+	gf_log[x] = i
+	x = x << 1
+	if x & 0x100: x = x ^ polynomial
+for i in range(255,512): gf_exp[i] = gf_exp[i-255]
+del x,i
+
+def gf_mul(a, b):
+	if a == 0 or b == 0: return 0
+	return gf_exp[gf_log[a] + gf_log[b]]
+
+def gf_inv(a):
+	if a == 0: raise ZeroDivisionError('GF(256): inverse of 0')
+	return gf_exp[255 - gf_log[a]]
+
+mul_tables = [''.join([chr(gf_mul(c,x)) for x in range(256)]) for c in range(256)]
+
+def mul_block(c, data):
+	if c == 1: return data
+	return data.translate(mul_tables[c])
+
+def combine(coefficients, blocks, size):
+	# sum(c * block) over GF(256), for equal-size blocks
+	acc = 0
+	for c,block in zip(coefficients,blocks):
+		if c: acc = acc ^ int(binascii.hexlify(mul_block(c,block)) or '0',16)
+	return binascii.unhexlify('%0*x'%(2*size,acc))
+
+def invert(matrix):
+	# Gauss-Jordan over GF(256); raises if singular
+	n = len(matrix)
+	rows = [list(matrix[r]) + [int(r == c) for c in range(n)] for r in range(n)]
+	for col in range(n):
+		pivot = [r for r in range(col,n) if rows[r][col]]
+		if not pivot: raise Exception('GF(256): singular matrix')
+		rows[col],rows[pivot[0]] = rows[pivot[0]],rows[col]
+		scale = gf_inv(rows[col][col])
+		rows[col] = [gf_mul(scale,v) for v in rows[col]]
+		for r in range(n):
+			factor = rows[r][col]
+			if r == col or not factor: continue
+			rows[r] = [v ^ gf_mul(factor,p) for v,p in zip(rows[r],rows[col])]
+	return [row[n:] for row in rows]
+
+class ErasureCode:
+	def __init__(self, k, m):
+		if k < 1 or m < 0 or k + m > 256: raise Exception('ErasureCode: invalid k=%d m=%d'%(k,m))
+		self.k = k
+		self.m = m
+		identity = [[int(r == c) for c in range(k)] for r in range(k)]
+		cauchy = [[gf_inv((k+r) ^ c) for c in range(k)] for r in range(m)]
+		self.matrix = identity + cauchy
+		self.rows = {} # (wanted, present shards) -> coefficients over present
+
+	def encode(self, data):
+		# k equal-size data blocks -> m parity blocks
+		if len(data) != self.k: raise Exception('ErasureCode::encode: need %d blocks'%self.k)
+		size = len(data[0])
+		return [combine(self.matrix[self.k+r],data,size) for r in range(self.m)]
+
+	def row(self, wanted, present):
+		# coefficients rebuilding shard `wanted` from the shards in `present`
+		key = (wanted,present)
+		if key not in self.rows:
+			inverse = invert([self.matrix[x] for x in present])
+			target = self.matrix[wanted]
+			coefficients = []
+			for t in range(self.k):
+				c = 0
+				for j in range(self.k): c = c ^ gf_mul(target[j],inverse[j][t])
+				coefficients.append(c)
+			self.rows[key] = coefficients
+		return self.rows[key]
+
+	def decode(self, shards, wanted):
+		# shards: {index: block} holding at least k entries -> {index: block}
+		if len(shards) < self.k: raise Exception('ErasureCode::decode: %d of %d shards'%(len(shards),self.k))
+		present = tuple(sorted(shards)[:self.k]) # data shards first: cheapest rows
+		blocks = [shards[x] for x in present]
+		size = len(blocks[0])
+		result = {}
+		for x in wanted:
+			if x in shards: result[x] = shards[x]
+			else:           result[x] = combine(self.row(x,present),blocks,size)
+		return result
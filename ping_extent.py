@@ -0,0 +1,186 @@
+import bisect, threading
+
+"""
+Extent map of live blocks for PingDisk allocation. Live blocks are kept as
+a sorted run list: parallel arrays of run starts and (exclusive) ends, so
+lookups are a bisect and inserting or deleting a run is one list splice.
+
+The free gaps between runs are indexed twice. By size, as one sorted list of
+length<<32|start keys (plain ints compare fast), so a best fit is a bisect.
+By address, as a max tree over buckets of the ID space (each node holds the
+largest gap starting under it), so a first fit descends the tree and then
+scans one bucket. Block IDs start at 1; the space past the last run is
+unbounded and is not a gap.
+
+	extents = ExtentMap()
+	extents.add(1,8)          # blocks 1-8 live
+	extents.remove(3,2)       # blocks 3-4 free again
+	extents.best_fit(2)       # -> 3
+	extents.overlaps(5,9)     # any live block in 5..8? -> True
+"""
+
+id_bits = 32     # block IDs are ICMP echo IDs
+bucket_bits = 10 # first-fit tree leaves: 1024 IDs each
+start_mask = (1<<id_bits) - 1
+
+class ExtentMap(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.starts = [] # first block of each run, ascending
+		self.ends = []   # one past the last block of each run
+		self.gaps = []   # length<<32 | start of each gap before a run, ascending
+		self.fits = None # tree node -> largest gap starting under it; built on first use
+		self.blocks = 0
+
+	@classmethod
+	def from_blocks(cls, blocks): # any iterable of block IDs
+		extents = cls()
+		for x in sorted(blocks):
+			if extents.ends and extents.ends[-1] >= x:
+				if extents.ends[-1] == x: extents.ends[-1] = x + 1
+				else: continue # duplicate
+			else:
+				if extents.ends: extents.gaps.append((x - extents.ends[-1]) << id_bits | extents.ends[-1])
+				elif x > 1:      extents.gaps.append((x - 1) << id_bits | 1)
+				extents.starts.append(x)
+				extents.ends.append(x + 1)
+			extents.blocks = extents.blocks + 1
+		extents.gaps.sort()
+		return extents
+
+	def __contains__(self, ID):
+		i = bisect.bisect_right(self.starts, ID) - 1
+		return i >= 0 and ID < self.ends[i]
+
+	def __iter__(self):
+		with self.lock: runs = zip(self.starts,self.ends)
+		for start,end in runs:
+			for x in xrange(start,end): yield x
+
+	def runs(self): # [(start, length)] in address order
+		with self.lock: return [(s,e-s) for s,e in zip(self.starts,self.ends)]
+
+	# the gap index; callers hold self.lock
+	def gap(self, i): # the gap before run i, as length<<32 | start
+		start = 1
+		if i: start = self.ends[i-1]
+		return (self.starts[i] - start) << id_bits | start
+
+	def drop_gaps(self, i, j, touched): # the gaps before runs i..j inclusive
+		for x in range(i, min(j + 1, len(self.starts))):
+			gap = self.gap(x)
+			if not gap >> id_bits: continue
+			del self.gaps[bisect.bisect_left(self.gaps, gap)]
+			touched.add((gap & start_mask) >> bucket_bits)
+
+	def add_gaps(self, i, j, touched):
+		for x in range(i, min(j + 1, len(self.starts))):
+			gap = self.gap(x)
+			if not gap >> id_bits: continue
+			bisect.insort(self.gaps, gap)
+			touched.add((gap & start_mask) >> bucket_bits)
+
+	def bucket_gaps(self, bucket): # [(start, length)] of the gaps starting in bucket
+		lo = bucket << bucket_bits
+		hi = lo + (1 << bucket_bits)
+		result = []
+		if lo <= 1 < hi and self.starts and self.starts[0] > 1: result.append((1,self.starts[0] - 1))
+		i = bisect.bisect_left(self.ends, lo)       # the first gap starting at or after lo
+		j = bisect.bisect_left(self.ends, hi, i)    # follows run i
+		for x in range(i, min(j, len(self.starts) - 1)):
+			result.append((self.ends[x],self.starts[x+1] - self.ends[x]))
+		return result
+
+	def update_fits(self, buckets):
+		if self.fits is None: return
+		leaf = 1 << (id_bits - bucket_bits)
+		for bucket in buckets:
+			node = leaf | bucket
+			fit = max([0] + [l for s,l in self.bucket_gaps(bucket)])
+			while node:
+				if fit: self.fits[node] = fit
+				else:   self.fits.pop(node, None)
+				sibling = self.fits.get(node ^ 1, 0)
+				node = node >> 1
+				fit = max(fit, sibling)
+				if self.fits.get(node, 0) == fit: break # nothing above changes
+
+	def add(self, start, count=1): # mark start..start+count-1 live
+		end = start + count
+		with self.lock:
+			i = bisect.bisect_left(self.ends, start)  # first run ending at or after start
+			j = bisect.bisect_right(self.starts, end) # runs before j start at or before end
+			if i < j and self.starts[i] <= start and self.ends[i] >= end: return # already live
+			touched = set()
+			self.drop_gaps(i, j, touched)
+			covered = sum([self.ends[x] - self.starts[x] for x in range(i, j)])
+			if i < j:
+				start = min(start, self.starts[i])
+				end = max(end, self.ends[j-1])
+			self.starts[i:j] = [start]
+			self.ends[i:j] = [end]
+			self.blocks = self.blocks + (end - start) - covered
+			self.add_gaps(i, i + 1, touched)
+			self.update_fits(touched)
+
+	def remove(self, start, count=1): # mark start..start+count-1 free
+		end = start + count
+		with self.lock:
+			i = bisect.bisect_right(self.ends, start) # first run ending after start
+			j = bisect.bisect_left(self.starts, end)  # runs before j start before end
+			if i >= j: return # nothing live there
+			touched = set()
+			self.drop_gaps(i, j, touched)
+			covered = sum([self.ends[x] - self.starts[x] for x in range(i, j)])
+			starts,ends = [],[]
+			if self.starts[i] < start: # the first run keeps its head
+				starts.append(self.starts[i])
+				ends.append(start)
+			if self.ends[j-1] > end:   # and the last its tail
+				starts.append(end)
+				ends.append(self.ends[j-1])
+			self.blocks = self.blocks - covered + sum([e - s for s,e in zip(starts,ends)])
+			self.starts[i:j] = starts
+			self.ends[i:j] = ends
+			self.add_gaps(i, i + len(starts), touched)
+			self.update_fits(touched)
+
+	def overlaps(self, start, end): # is any block of start..end-1 live?
+		if end <= start: return False # no blocks at all
+		with self.lock:
+			i = bisect.bisect_right(self.ends, start) # first run ending after start
+			return i < len(self.starts) and self.starts[i] < end
+
+	def end(self): # one past the last live block (1 when empty)
+		with self.lock:
+			if not self.ends: return 1
+			return self.ends[-1]
+
+	def best_fit(self, count): # start of the smallest gap holding count blocks, or None
+		with self.lock:
+			i = bisect.bisect_left(self.gaps, count << id_bits)
+			if i == len(self.gaps): return None
+			return self.gaps[i] & start_mask
+
+	def first_fit(self, count): # start of the lowest gap holding count blocks, or None
+		with self.lock:
+			if self.fits is None:
+				self.fits = {}
+				self.update_fits(set([(x & start_mask) >> bucket_bits for x in self.gaps]))
+			leaf = 1 << (id_bits - bucket_bits)
+			node = 1
+			if self.fits.get(node, 0) < count: return None
+			while node < leaf: # leftmost child that still fits
+				node = node << 1
+				if self.fits.get(node, 0) < count: node = node | 1
+			for start,length in self.bucket_gaps(node ^ leaf):
+				if length >= count: return start
+
+	def used_blocks(self): # as ping_server.used_blocks: {run start: length}
+		return dict(self.runs())
+
+	def free_blocks(self): # as ping_server.free_blocks: {gap start: length}, 0 for the open end
+		with self.lock:
+			result = dict([(x & start_mask,x >> id_bits) for x in self.gaps])
+			result[self.ends[-1] if self.ends else 1] = 0
+			return result
@@ -1,5 +1,5 @@
-import time, struct, sys, stat, logging
-import ping, ping_disk, ping_reporter
+import time, struct, sys, stat, logging, itertools, binascii, bisect, threading, array
+import ping, ping_disk, ping_cache, ping_reporter
 
 log = ping_reporter.setup_log('PingFileSystem')
 
@@ -13,9 +13,20 @@ PingFS_File
 [0e: 2] reserved
 [10:__] data
 
+PingFS_Extents (the data of a regular file; its bytes live in block runs)
+[00: 4] file length
+[04: 4] extent count
+[08:__] extents: first file block, disk address, block count (4 bytes each)
+
 PingFS_Directory(PingFS_File)
-[10: 4] entry count
-[14:__] entries
+[10: 4] bucket count (data)
+[14: 4] entry count
+[18:__] bucket inodes
+
+PingFS_DirBucket (one disk block; entries hash to a bucket by crc32 of the name)
+[00: 2] marker
+[02: 2] entry count
+[04:__] entries
 
 PingFS_DirEntry
 [00: 2] name length
@@ -47,13 +58,28 @@ def interpretFile(data):
 	if pf.type == stat.S_IFDIR: return makePingDirectory(data)
 	return pf
 
+unknown = object() # cache miss; None is a cached "no such node"
+
+def locked(method): # run under the PingFS namespace lock
+	def call(self,*args,**kw):
+		with self.lock: return method(self,*args,**kw)
+	return call
+
+# every node and entry is packed with precompiled structs, into a buffer
+# sized up front, and unpacked in place at running offsets
+node_size = struct.Struct('2L') # inode, data size: the start of a file header
+
 def interpretSize(data):
-	inode,size = struct.unpack('2L',data[:struct.calcsize('2L')])
+	inode,size = node_size.unpack_from(data)
 	return size
 
-class PingNode():
+# nodes are cached by the thousand, so they carry no per-instance __dict__,
+# and a directory keeps its entries as columns (PingBucket), not as objects
+class PingNode(object):
+	__slots__ = ('parent','inode')
 	layout = 'L'
-	overhead = struct.calcsize(layout)
+	header = struct.Struct(layout)
+	overhead = header.size
 
 	def __init__(self,inode=0):
 		self.parent = None
@@ -65,149 +91,334 @@ class PingNode():
 
 	def serialize(self):
 		log.trace('%s::serialize'%self.__class__.__name__)
-		return struct.pack(PingNode.layout,self.inode)
+		return PingNode.header.pack(self.inode)
 
 	def deserialize(self,data):
 		log.trace('%s::deserialize'%self.__class__.__name__)
-		layout,overhead = PingNode.layout,PingNode.overhead
-		if len(data) < overhead: raise Exception('PingFS::node: invalid deserialize data')
-		self.inode = struct.unpack(layout,data[:overhead])[0]
-		return data[overhead:]
+		if len(data) < PingNode.overhead: raise Exception('PingFS::node: invalid deserialize data')
+		self.inode = PingNode.header.unpack_from(data)[0]
+		return data[PingNode.overhead:]
 
 class PingFile(PingNode):
+	__slots__ = ('type','mode','name','length','extents','uid','gid','stored','disk_size')
 	layout = '2L3H2x'
 	overhead = struct.calcsize(layout)
-	file_header = overhead + PingNode.overhead
+	header = struct.Struct(PingNode.layout + layout) # inode, then the file header
+	file_header = header.size
+	extent_layout = '2L' # file length, extent count
+	extent_header = struct.Struct(extent_layout)
+	extent_overhead = extent_header.size
+	extent_entry = struct.Struct('3L')
+	extent = extent_entry.size
 
 	def __init__(self,name='',inode=0):
 		PingNode.__init__(self,inode)
 		self.type = stat.S_IFREG
 		self.mode = 0666
 		self.name = name
-		self.data = ''
+		self.length = 0
+		self.extents = []  # (first file block, disk address, block count), by file block
 		self.uid = 0
 		self.gid = 0
+		self.stored = None # the node as last written
+		self.disk_size = 0 # its size then
 	
 	def get_attr(self):
 		return self.attrs
 
 	def size(self):
-		return PingFile.file_header + len(self.data)
+		return PingFile.file_header + self.payload_size()
+
+	def payload_size(self): # the data after the file header
+		return PingFile.extent_overhead + len(self.extents) * PingFile.extent
 
 	def links(self):
 		return 1
 
+	def payload(self):
+		entry,overhead = PingFile.extent_entry,PingFile.extent_overhead
+		data = bytearray(overhead + len(self.extents) * entry.size)
+		PingFile.extent_header.pack_into(data,0,self.length,len(self.extents))
+		for x in range(len(self.extents)):
+			entry.pack_into(data,overhead + x * entry.size,*self.extents[x])
+		return str(data)
+
+	def load(self,data):
+		if self.type == stat.S_IFDIR: return # to be reread as a PingDirectory
+		entry,overhead = PingFile.extent_entry,PingFile.extent_overhead
+		if len(data) < overhead: raise Exception('PingFS::file: invalid extent table')
+		self.length,count = PingFile.extent_header.unpack_from(data)
+		if len(data) < overhead + count * entry.size: raise Exception('PingFS::file: invalid extent table')
+		self.extents = [entry.unpack_from(data,x) for x in range(overhead,overhead + count * entry.size,entry.size)]
+
 	def serialize(self):
-		self.disk_size = self.size()
-		node_hdr = PingNode.serialize(self)
-		layout,overhead = PingFile.layout,PingFile.overhead
-		file_hdr = struct.pack(layout,len(self.data),self.type,self.uid,self.gid,self.mode)
-		return node_hdr + file_hdr + self.data
+		payload = self.payload()
+		self.disk_size = PingFile.file_header + len(payload)
+		data = bytearray(self.disk_size)
+		PingFile.header.pack_into(data,0,self.inode,len(payload),self.type,self.uid,self.gid,self.mode)
+		data[PingFile.file_header:] = payload
+		return str(data)
 
 	def deserialize(self,data):
-		data = PingNode.deserialize(self,data)
-		layout,overhead = PingFile.layout,PingFile.overhead
-		if len(data) < overhead: raise Exception('PingFS::file: invalid deserialize data')
-		size,self.type,self.uid,self.gid,self.mode = struct.unpack(layout,data[:overhead])
-		self.data = data[overhead:overhead+size]
-		self.disk_size = self.size()
+		if len(data) < PingFile.file_header: raise Exception('PingFS::file: invalid deserialize data')
+		self.inode,size,self.type,self.uid,self.gid,self.mode = PingFile.header.unpack_from(data)
+		end = PingFile.file_header + size
+		self.load(data[PingFile.file_header:end])
+		self.stored = self.serialize()
 		#print 'PingFile::name(',self.name,'),size,type,attr:',size,self.type,self.attr
-		return data[overhead+size:]
+		return data[end:]
 
 class PingDirent(PingNode):
+	# a directory entry as a standalone object (PingBucket stores them packed)
+	__slots__ = ('name',)
 	layout = 'H'
 	overhead = struct.calcsize(layout)
+	header = struct.Struct(PingNode.layout + layout) # inode, name length
+	entry_header = header.size
 
-	def __init__(self):
-		PingNode.__init__(self,None)
+	def __init__(self,name='',inode=None):
+		PingNode.__init__(self,inode)
+		self.name = name
 
 	def size(self):
-		return PingNode.overhead + PingDirent.overhead + len(self.name)
+		return PingDirent.entry_header + len(self.name)
 
 	def serialize(self):
-		node_hdr = PingNode.serialize(self)
-		layout,overhead = PingDirent.layout,PingDirent.overhead
-		header = struct.pack(layout,len(self.name))
-		return node_hdr + header + self.name
+		data = bytearray(self.size())
+		self.pack_into(data,0)
+		return str(data)
+
+	def pack_into(self,data,offset): # returns the offset past the entry
+		PingDirent.header.pack_into(data,offset,self.inode,len(self.name))
+		offset = offset + PingDirent.entry_header
+		data[offset:offset + len(self.name)] = self.name
+		return offset + len(self.name)
 
 	def deserialize(self,data):
-		data = PingNode.deserialize(self,data)
-		layout,overhead = PingDirent.layout,PingDirent.overhead
-		if len(data) < overhead: raise Exception('PingFS::dirent: invalid deserialize')
-		size = struct.unpack(layout,data[:overhead])[0]
-		data = data[overhead:]
-		if len(data) < size: raise Exception('PingFS::dirent: invalid directory object (%d,%d)'
-											 %(len(data),size))
-		self.name = data[:size]
+		return data[self.unpack_from(data,0):]
+
+	def unpack_from(self,data,offset): # returns the offset past the entry
+		if len(data) < offset + PingDirent.entry_header: raise Exception('PingFS::dirent: invalid deserialize')
+		self.inode,size = PingDirent.header.unpack_from(data,offset)
+		offset = offset + PingDirent.entry_header
+		if len(data) < offset + size: raise Exception('PingFS::dirent: invalid directory object (%d,%d)'
+													  %(len(data) - offset,size))
+		self.name = data[offset:offset + size]
 		#print 'PingDirent::inode,len,name',self.inode,len(self.name),self.name
-		return data[size:]
+		return offset + size
+
+class PingBucket(object):
+	# one directory bucket's entries, as columns: entry i is named
+	# names[starts[i]:starts[i+1]-1] and points at inodes[i]. names is
+	# '\0' separated ('\0' is never in a name), so a lookup is a single
+	# substring search. entries keep their order of insertion
+	__slots__ = ('inodes','starts','names')
+
+	def __init__(self):
+		self.inodes = array.array('L')
+		self.starts = array.array('L',[1])
+		self.names = '\0'
+
+	def __len__(self): # (never tested for truth: an empty bucket is still a bucket)
+		return len(self.inodes)
+
+	def find(self,name): # index of name, or -1
+		at = self.names.find('\0' + name + '\0')
+		if at < 0: return -1
+		return bisect.bisect_left(self.starts,at + 1)
+
+	def name(self,index):
+		return self.names[self.starts[index]:self.starts[index+1] - 1]
+
+	def name_bytes(self): # total length of the names
+		return len(self.names) - 1 - len(self.inodes)
+
+	def get(self,name):
+		index = self.find(name)
+		if index < 0: return None
+		return self.inodes[index]
+
+	def put(self,name,inode):
+		index = self.find(name)
+		if index >= 0:
+			self.inodes[index] = inode
+			return
+		self.names = self.names + name + '\0'
+		self.inodes.append(inode)
+		self.starts.append(len(self.names))
+
+	def pop(self,name): # its inode, or None
+		index = self.find(name)
+		if index < 0: return None
+		inode = self.inodes[index]
+		start,end = self.starts[index],self.starts[index+1]
+		self.names = self.names[:start] + self.names[end:]
+		del self.inodes[index]
+		del self.starts[index+1]
+		for x in range(index + 1,len(self.starts)): self.starts[x] = self.starts[x] - (end - start)
+		return inode
+
+	def items(self): # [(name, inode)]
+		return [(self.name(x),self.inodes[x]) for x in range(len(self.inodes))]
+
+	def pack_into(self,data,offset): # the dirents; returns the offset past them
+		header,size = PingDirent.header,PingDirent.entry_header
+		for x in range(len(self.inodes)):
+			name = self.name(x)
+			header.pack_into(data,offset,self.inodes[x],len(name))
+			data[offset + size:offset + size + len(name)] = name
+			offset = offset + size + len(name)
+		return offset
+
+	def unpack_from(self,data,offset,count): # count dirents; returns the offset past them
+		header,size = PingDirent.header,PingDirent.entry_header
+		names = []
+		for x in range(count):
+			if len(data) < offset + size: raise Exception('PingFS::dirent: invalid deserialize')
+			inode,length = header.unpack_from(data,offset)
+			offset = offset + size
+			if len(data) < offset + length: raise Exception('PingFS::dirent: invalid directory object (%d,%d)'
+															%(len(data) - offset,length))
+			names.append(data[offset:offset + length])
+			self.inodes.append(inode)
+			self.starts.append(self.starts[-1] + length + 1)
+			offset = offset + length
+		self.names = '\0' + ''.join([x + '\0' for x in names])
+		return offset
 
 class PingDirectory(PingFile):
-	layout = 'L'
-	overhead = struct.calcsize(layout)
-	
+	__slots__ = ('buckets','table','count','dirty','loader')
+	layout = '2L' # bucket count, entry count; then the inode of each bucket
+	table_header = struct.Struct(layout)
+	overhead = table_header.size
+	pointer = struct.calcsize('L')
+	bucket_layout = '2sH' # marker, entry count; then the dirents
+	bucket_header = struct.Struct(bucket_layout)
+	bucket_overhead = bucket_header.size
+	bucket_marker = 'DB' # an empty bucket is not an all-zero (deleted) block
+
 	def __init__(self,name='',inode=0):
 		PingFile.__init__(self,name,inode)
 		self.type = stat.S_IFDIR
-		self.entries = []
 		self.mode = 0766
-
-	def size(self):
-		size = PingFile.overhead + PingDirectory.overhead
-		for x in self.entries:
-			size = size + x.size()
-		return size
+		self.buckets = [0]  # inode of each bucket block (0: not allocated yet)
+		self.table = [PingBucket()] # each bucket's entries; None until loaded
+		self.count = 0
+		self.dirty = set()  # buckets changed since they were last written
+		self.loader = None  # loader(directory, bucket) -> PingBucket
 
 	def links(self):
-		return len(self.entries) + 1
-		
+		return self.count + 1
+
+	def bucket_of(self,name):
+		return (binascii.crc32(name) & 0xffffffff) % len(self.buckets)
+
+	def bucket(self,index):
+		if self.table[index] is None:
+			if not self.loader: raise Exception('PingFS::dir: bucket %d of %s not loaded'%(index,self.name))
+			self.table[index] = self.loader(self,index)
+		return self.table[index]
+
 	def add_node(self,node):
 		if node.parent: node.parent.del_node(node.name,node)
 		self.del_node(node.name)
-		dirent = PingDirent()
-		dirent.name = node.name
-		dirent.inode = node.inode
-		self.entries.append(dirent)
+		index = self.bucket_of(node.name)
+		self.bucket(index).put(node.name,node.inode)
+		self.dirty.add(index)
+		self.count = self.count + 1
 		node.parent = self
 
 	def del_node(self,name,node=None):
-		self.entries = [x for x in self.entries if x.name != name]
+		index = self.bucket_of(name)
+		if self.bucket(index).pop(name) != None:
+			self.dirty.add(index)
+			self.count = self.count - 1
 		if node: node.parent = None
 
-	def get_dirent(self,name,node=None):
-		for x in self.entries:
-			if x.name == name:
-				return x
-		return None
-
-	def serialize(self):
-		file_hdr = PingFile.serialize(self)
-		layout,overhead = PingDirectory.layout,PingDirectory.overhead
-		header = struct.pack(layout, len(self.entries))
+	def lookup(self,name): # inode of name, or None
+		return self.bucket(self.bucket_of(name)).get(name)
 
-		data = ''
-		for x in self.entries: data = data + x.serialize()
-		return file_hdr + header + data
-
-	def deserialize(self,data):
-		self.entries = []
-		data = PingFile.deserialize(self,data)
-		layout,overhead = PingDirectory.layout,PingDirectory.overhead
+	def get_dirent(self,name,node=None):
+		inode = self.lookup(name)
+		if inode == None: return None
+		return PingDirent(name,inode)
+
+	def listing(self): # every dirent (loads every bucket)
+		result = []
+		for x in range(len(self.buckets)):
+			result.extend([PingDirent(name,inode) for name,inode in self.bucket(x).items()])
+		return result
+
+	def grow(self):
+		# double the buckets and rehash; the new ones are not allocated yet
+		entries = self.listing()
+		count = 2 * len(self.buckets)
+		self.buckets = self.buckets + [0] * (count - len(self.buckets))
+		self.table = [PingBucket() for x in range(count)]
+		for x in entries: self.table[self.bucket_of(x.name)].put(x.name,x.inode)
+		self.dirty = set(range(count))
+
+	def bucket_size(self,index):
+		entries = self.bucket(index)
+		return PingDirectory.bucket_overhead + PingDirent.entry_header * len(entries) + entries.name_bytes()
+
+	def serialize_bucket(self,index):
+		entries = self.bucket(index)
+		data = bytearray(self.bucket_size(index))
+		PingDirectory.bucket_header.pack_into(data,0,PingDirectory.bucket_marker,len(entries))
+		entries.pack_into(data,PingDirectory.bucket_overhead)
+		return str(data)
+
+	def payload_size(self):
+		return PingDirectory.overhead + len(self.buckets) * PingDirectory.pointer
+
+	def payload(self):
+		count = len(self.buckets)
+		data = bytearray(PingDirectory.overhead + count * PingDirectory.pointer)
+		PingDirectory.table_header.pack_into(data,0,count,self.count)
+		struct.pack_into('%dL'%count,data,PingDirectory.overhead,*self.buckets)
+		return str(data)
+
+	def load(self,data):
+		overhead = PingDirectory.overhead
 		if len(data) < overhead: raise Exception('PingFS::dir: invalid deserialize')
-		count = struct.unpack(layout,data[:overhead])[0]
-		data = data[overhead:]
-		for x in range(0,count):
-			dirent = PingDirent()
-			data = dirent.deserialize(data)
-			self.add_node(dirent)
-		return data
+		count,self.count = PingDirectory.table_header.unpack_from(data)
+		if len(data) < overhead + count * PingDirectory.pointer: raise Exception('PingFS::dir: invalid bucket table')
+		self.buckets = list(struct.unpack_from('%dL'%count,data,overhead))
+		self.table = [None] * count
+		self.dirty = set()
+
+def deserialize_bucket(data):
+	# one directory bucket block -> PingBucket
+	if len(data) < PingDirectory.bucket_overhead: raise Exception('PingFS::dir: invalid bucket')
+	marker,count = PingDirectory.bucket_header.unpack_from(data)
+	if marker != PingDirectory.bucket_marker: raise Exception('PingFS::dir: invalid bucket marker')
+	entries = PingBucket()
+	entries.unpack_from(data,PingDirectory.bucket_overhead,count)
+	return entries
 
 class PingFS:
-	def __init__(self,server):
-		try:
-			self.disk = ping_disk.PingDisk(server)
-			self.cache = PingDirectory('/') # create root
-			self.add(self.cache,0) # and cache it
+	def __init__(self,server,transport=None,block_cache=1<<20,readahead=32,
+				 inode_cache=1024,dentry_cache=4096,compress=None,dedup=False):
+		try: # metadata blocks (the root directory above all) are re-read constantly
+			self.disk = ping_disk.PingDisk(server,transport=transport,cache=block_cache,
+										   readahead=readahead,compress=compress,dedup=dedup)
+			# parsed nodes, and directory lookups: warm paths resolve without the network.
+			# dentries are keyed by their directory's version, which every write of
+			# that inode bumps, so a rewritten (or reused) directory drops them all
+			self.inodes = ping_cache.LRUCache(inode_cache)    # inode -> node (None: no node)
+			self.dentries = ping_cache.LRUCache(dentry_cache) # (dir inode, version, name) -> inode (None: no entry)
+			self.versions = {} # inode -> version
+			self.version = itertools.count(1)
+			# safe for concurrent callers (the multithreaded FUSE). lock guards the
+			# namespace: directories, allocation and node placement. a file's data
+			# and header are under its node's file lock, taken before lock (never
+			# after: nothing holding lock waits on a file). cache_lock keeps a
+			# node read from the disk from overwriting a newer cached one
+			self.lock = threading.RLock()
+			self.file_locks = [threading.RLock() for x in range(61)] # prime: object addresses are aligned
+			self.cache_lock = threading.Lock()
+			self.add(PingDirectory('/'),0) # create root
 
 		except:
 			print 'General Exception'
@@ -236,62 +447,212 @@ class PingFS:
 		data = self.read_inode(inode)
 		pdir = makePingDirectory(data)
 		if not (pdir.type & stat.S_IFDIR):
-			raise Exception('read_as_dir: %s (%d,%d) -> %x %d'%(pdir.name,inode,len(data),pdir.type,len(pdir.entries)))
+			raise Exception('read_as_dir: %s (%d,%d) -> %x %d'%(pdir.name,inode,len(data),pdir.type,pdir.count))
+		pdir.loader = self.load_bucket
 		return pdir
 
-	def cache_hit(self,name,pFile=None):
-		if not self.cache: return False
-		if self.cache.name != name: return False
-		if pFile and self.cache.inode != pFile.inode: return False
-		return True
+	def load_bucket(self, pDir, index):
+		log.debug('PingFS::load_bucket: %s bucket %d at %d'%(pDir.name,index,pDir.buckets[index]))
+		return deserialize_bucket(self.disk.read(pDir.buckets[index],self.disk.block_size()))
+
+	def store_buckets(self, pDir):
+		# write the buckets changed since the last store: one block each.
+		# a bucket that outgrows its block doubles the table (all rewritten)
+		block_size = self.disk.block_size()
+		while True:
+			full = [x for x in pDir.dirty if pDir.bucket_size(x) > block_size]
+			if not full: break
+			if [x for x in full if len(pDir.bucket(x)) < 2]: # no table is big enough
+				raise Exception('PingFS::store_buckets: %s: an entry outgrows a %d-byte block'%(pDir.name,block_size))
+			pDir.grow()
+		for x in sorted(pDir.dirty):
+			if not pDir.buckets[x]:
+				pDir.buckets[x] = self.disk.get_region(block_size)
+				if not pDir.buckets[x]: raise Exception('PingFS::store_buckets: %s: no free block'%pDir.name)
+			self.disk.write(pDir.buckets[x],pDir.serialize_bucket(x).ljust(block_size,'\0'))
+		pDir.dirty = set()
+
+	def name_max(self): # longest name a bucket (one block) can hold
+		return self.disk.block_size() - PingDirectory.bucket_overhead - PingDirent.entry_header
+
+	def write_node(self, pNode):
+		# a node's header is rewritten only when it changes
+		header = pNode.serialize()
+		if header == pNode.stored: return
+		self.disk.write(pNode.inode,header)
+		pNode.stored = header
+
+	def node(self, inode, name=None):
+		# the parsed node at inode, from the inode cache if there
+		pNode = self.inodes.get(inode,unknown)
+		if pNode is unknown:
+			version = self.versions.get(inode,0)
+			pNode = interpretFile(self.read_inode(inode))
+			if pNode.type == stat.S_IFDIR: pNode.loader = self.load_bucket
+			with self.cache_lock: # unless it was rewritten while we read it
+				if self.versions.get(inode,0) == version: self.inodes.put(inode,pNode)
+		if pNode and name != None: pNode.name = name
+		return pNode
+
+	def entry(self, pDir, name):
+		# inode of name in pDir (None if absent), from the dentry cache if there
+		key = (pDir.inode,self.versions.get(pDir.inode,0),name)
+		inode = self.dentries.get(key,unknown)
+		if inode is unknown:
+			inode = pDir.lookup(name)
+			self.dentries.put(key,inode)
+		return inode
+
+	def written(self, inode, pNode):
+		# pNode is now at inode (None: nothing is); dentries under inode go stale
+		with self.cache_lock:
+			self.versions[inode] = self.version.next()
+			self.inodes.put(inode,pNode)
+
+	def file_lock(self, pFile):
+		# by node object, not inode: a relocation moves the inode under the lock
+		return self.file_locks[id(pFile) % len(self.file_locks)]
 
 	def get(self, path):
 		log.notice('PingFS::get %s'%path)
-		if self.cache_hit(path): return self.cache
-		if path == '/' or path == '':
-			if self.cache.inode == 0: return self.cache
-			return self.read_as_dir(0)
+		if path == '/' or path == '': return self.node(0)
 		parts = path.rsplit('/',1)
 		if len(parts) != 2: raise Exception('PingFS::get_file: invalid path: %s'%path)
-		rPath,fName = parts[0],parts[1]
-		pDir = self.get(rPath)
-		if pDir and pDir.type == stat.S_IFDIR:
-			pEntry = pDir.get_dirent(fName)
-			self.cache = pDir # cache the directory
-			self.cache.name = rPath
-			if pEntry:
-				data = self.read_inode(pEntry.inode)
-				pFile = interpretFile(data)
-				pFile.name = pEntry.name
-				return pFile
-		return None
+		return self.get_both(path)[1]
+
+	def lookup(self, path):
+		# inode of path, without reading the node itself
+		if path == '/' or path == '': return 0
+		parts = path.rsplit('/',1)
+		if len(parts) != 2: raise Exception('PingFS::lookup: invalid path: %s'%path)
+		pDir = self.get(parts[0])
+		if not pDir or pDir.type != stat.S_IFDIR: return None
+		return self.entry(pDir,parts[1])
+
+	def read(self, path, length, offset):
+		# ranged file read: only the blocks holding the requested bytes.
+		# returns (node, file size, data); node is None if missing
+		log.debug('PingFS::read %s (offset=%d len=%d)'%(path,offset,length))
+		pFile = self.get(path)
+		if not pFile: return None,0,''
+		if pFile.type == stat.S_IFDIR: return pFile,pFile.size(),''
+		data = self.read_file(pFile,length,offset)
+		return pFile,pFile.length,data
+
+	def run_at(self, pFile, block):
+		# (disk address of file block, blocks left in its extent), or for a
+		# hole (None, blocks to the next extent; None past the last one)
+		i = bisect.bisect_right(pFile.extents,(block,sys.maxint,sys.maxint)) - 1
+		if i >= 0:
+			first,address,count = pFile.extents[i]
+			if block < first + count:
+				return address + (block - first) * self.disk.block_size(),first + count - block
+		if i + 1 < len(pFile.extents): return None,pFile.extents[i+1][0] - block
+		return None,None
+
+	def allocate(self, pFile, block, count):
+		# disk blocks for file blocks block..block+count-1 (a hole): the extent
+		# ending at block grows in place when the blocks after it are free
+		block_size = self.disk.block_size()
+		i = bisect.bisect_left(pFile.extents,(block,))
+		if i:
+			first,address,blocks = pFile.extents[i-1]
+			end = address + blocks * block_size
+			if first + blocks == block and self.disk.claim_region(end,count * block_size):
+				pFile.extents[i-1] = (first,address,blocks + count)
+				return end
+		address = self.disk.get_region(count * block_size)
+		if not address: raise Exception('PingFS::allocate: %s: no free region for %d blocks'%(pFile.name,count))
+		bisect.insort(pFile.extents,(block,address,count))
+		return address
+
+	def read_file(self, pFile, length, offset):
+		log.debug('PingFS::read_file %s (offset=%d len=%d)'%(pFile.name,offset,length))
+		with self.file_lock(pFile): return self.read_extents(pFile,length,offset)
+
+	def read_extents(self, pFile, length, offset):
+		block_size = self.disk.block_size()
+		position,end = offset,min(offset + length,pFile.length)
+		data = []
+		while position < end:
+			block,inner = divmod(position,block_size)
+			address,blocks = self.run_at(pFile,block)
+			stop = end
+			if blocks: stop = min(end,(block + blocks) * block_size)
+			if address == None: data.append('\0' * (stop - position)) # a hole
+			else:               data.append(self.disk.read(address + inner,stop - position).ljust(stop - position,'\0'))
+			position = stop
+		return ''.join(data)
+
+	def write_data(self, pFile, buf, offset):
+		# only the blocks buf touches are written; holes get new extents
+		log.debug('PingFS::write_data %s (offset=%d len=%d)'%(pFile.name,offset,len(buf)))
+		with self.file_lock(pFile): self.write_extents(pFile,buf,offset)
+
+	def write_extents(self, pFile, buf, offset):
+		block_size = self.disk.block_size()
+		position,end = offset,offset + len(buf)
+		while position < end:
+			block,inner = divmod(position,block_size)
+			address,blocks = self.run_at(pFile,block)
+			stop = end
+			if blocks: stop = min(end,(block + blocks) * block_size)
+			piece = buf[position - offset:stop - offset]
+			if address != None: self.disk.write(address + inner,piece)
+			elif piece.strip('\0'): # zeros stay a hole: they need no block
+				count = (inner + len(piece) + block_size - 1) / block_size
+				address = self.allocate(pFile,block,count)
+				self.disk.write(address,('\0' * inner + piece).ljust(count * block_size,'\0'))
+			position = stop
+		pFile.length = max(pFile.length,end)
+
+	def write(self, pFile, buf, offset, pDir=None):
+		with self.file_lock(pFile):
+			self.write_data(pFile,buf,offset)
+			return self.update(pFile,pDir)
+
+	def truncate(self, pFile, size, pDir=None):
+		# blocks wholly past size are freed; growing leaves a hole
+		log.debug('PingFS::truncate %s (%d -> %d)'%(pFile.name,pFile.length,size))
+		with self.file_lock(pFile): return self.truncate_extents(pFile,size,pDir)
+
+	def truncate_extents(self, pFile, size, pDir=None):
+		block_size = self.disk.block_size()
+		keep = (size + block_size - 1) / block_size # blocks still (partly) in the file
+		extents = []
+		for first,address,count in pFile.extents:
+			if first + count <= keep:
+				extents.append((first,address,count))
+				continue
+			kept = max(0,keep - first)
+			if kept: extents.append((first,address,kept))
+			self.disk.delete(address + kept * block_size,(count - kept) * block_size)
+		pFile.extents = extents
+		if size < pFile.length and size % block_size: # zero the rest of the last block
+			address,blocks = self.run_at(pFile,size / block_size)
+			if address != None: self.disk.write(address + size % block_size,'\0' * (block_size - size % block_size))
+		pFile.length = size
+		return self.update(pFile,pDir)
 
 	def get_both(self, path):
-		log.notice('PingFS::get_both %s'%path)
-		if self.cache_hit(path):
-			if self.cache.parent:
-				return (self.cache.parent,self.cache)
+		log.debug('PingFS::get_both %s'%path)
 		if path == '/' or path == '':
-			if self.cache.inode == 0:
-				return (self.cache,self.cache)
-			return self.read_as_dir(0)
+			root = self.node(0)
+			return (root,root)
 		parts = path.rsplit('/',1)
 		if len(parts) != 2: raise Exception('PingFS::get_both: invalid path: %s'%path)
 		sPath,sName = parts[0],parts[1]
 		pDir = self.get(sPath)
 		if not pDir: return (None,None)
 		if not pDir.type == stat.S_IFDIR: return (None,None)
-		pEntry = pDir.get_dirent(sName)
-		self.cache = pDir # cache the directory
-		self.cache.name = sPath
-		if not pEntry: return (pDir,None)
-		data = self.read_inode(pEntry.inode)
-		pFile = interpretFile(data)
-		pFile.name = pEntry.name
+		inode = self.entry(pDir,sName)
+		if inode == None: return (pDir,None)
+		pFile = self.node(inode,sName)
+		if pFile: pFile.parent = pDir
 		return (pDir,pFile)
 
 	def get_parent(self, path, pFile=None):
-		if path == '/' or path == '': return self.read_as_dir(0)
+		if path == '/' or path == '': return self.node(0)
 		parts = path.rsplit('/',1)
 		if len(parts) != 2:
 			log.exception('PingFS::get_parent: invalid path: %s'%path)
@@ -304,6 +665,7 @@ class PingFS:
 		if node.inode == 0: return True
 		return False
 
+	@locked
 	def unlink(self, path, pFile=None, pDir=None):
 		log.notice('PingFS::unlink %s'%path)
 		if not pFile:             pFile = self.get(path)
@@ -314,6 +676,7 @@ class PingFS:
 		self.delete(path,pFile)
 		return True
 
+	@locked
 	def disconnect(self, path, pFile=None, pDir=None):
 		log.notice('PingFS::disconnect %s'%path)
 		if path == '/' or path == '': return False
@@ -325,25 +688,34 @@ class PingFS:
 		self.update(pDir)
 		return True
 
+	@locked
 	def delete(self, path, pFile=None): # assumes node disconnected from dir tree
 		log.notice('PingFS::delete %s'%path)
 		if not pFile: pFile = self.get(path)
 		if not pFile: return False
-		if self.cache_hit(path,pFile): self.cache = None
-		self.disk.delete(pFile.inode,pFile.size())
-
+		self.disk.delete(pFile.inode,pFile.disk_size) # as last written: an orphan's may lag its extents
+		for first,address,count in pFile.extents:
+			self.disk.delete(address,count * self.disk.block_size())
+		if pFile.type == stat.S_IFDIR:
+			for x in pFile.buckets:
+				if x: self.disk.delete(x,self.disk.block_size())
+		self.written(pFile.inode,None)
+
+	@locked
 	def move_blocks(self, path, pFile, dest, pDir=None):
 		log.debug('move_blocks: %s (%d->%d)'%(pFile.name,pFile.inode,dest))
 		if self.root_node(pFile): return False # don't move the root
 		if not pDir: pDir = self.get_parent(path,pFile)
 		if not pDir: return False
-		self.delete(pFile.name,pFile)
+		self.disk.delete(pFile.inode,pFile.disk_size) # the node only: data and buckets stay put
+		self.written(pFile.inode,None)
+		pFile.stored = None
 		self.add(pFile,dest)
-		dirent = pDir.get_dirent(pFile.name,pFile)
-		dirent.inode = dest
+		pDir.add_node(pFile) # repoint its dirent
 		self.update(pDir)
 		return True
 
+	@locked
 	def move_links(self, pFile, oDir, nDir):
 		log.notice('move_links: %s (%s -> %s)'%(pFile.name,oDir.name,nDir.name))
 		if self.root_node(pFile): raise Exception('move_link on root!')
@@ -352,11 +724,7 @@ class PingFS:
 		nDir.add_node(pFile.name,pFile); self.update(nDir)
 		return True
 
-	def cache_update(self,node):
-		if not self.cache: return
-		if self.cache.inode != node.inode: return
-		self.cache = node
-
+	@locked
 	def add(self,node,force_inode=None):
 		if force_inode != None:
 			node.inode = force_inode
@@ -364,10 +732,12 @@ class PingFS:
 			node.inode = self.disk.get_region(node.size())
 			if not node.inode: return None
 		log.notice('PingFS::add %s at %d'%(node.name,node.inode))
-		self.disk.write(node.inode,node.serialize())
-		self.cache_update(node)
+		if node.type == stat.S_IFDIR: self.store_buckets(node)
+		self.write_node(node)
+		self.written(node.inode,node)
 		return node.inode
 
+	@locked
 	def relocate(self,pFile,pDir=None):
 		log.notice('relocating %s to larger region'%pFile)
 		region = self.disk.get_region(pFile.size())
@@ -380,12 +750,19 @@ class PingFS:
 		return True
 	
 	def update(self,pFile,pDir=None):
+		# a directory's buckets are namespace; a file's header is its own
+		if pFile.type == stat.S_IFDIR: lock = self.lock
+		else:                          lock = self.file_lock(pFile)
+		with lock: return self.update_node(pFile,pDir)
+
+	def update_node(self,pFile,pDir=None):
 		log.debug('PingFS::update %s at %d [%d -> %d]'%(pFile.name,pFile.inode,pFile.disk_size,pFile.size()))
+		if pFile.type == stat.S_IFDIR: self.store_buckets(pFile) # only the touched blocks
 		if pFile.size() > pFile.disk_size:
 			region = self.disk.test_region(pFile.inode,pFile.disk_size,pFile.size())
 			if region != pFile.inode: return self.relocate(pFile,pDir) # continuing would cause collision
-		self.disk.write(pFile.inode,pFile.serialize())
-		self.cache_update(pFile)
+		self.write_node(pFile)
+		self.written(pFile.inode,pFile)
 		return True
 
 	def create(self,path,buf='',offset=0):
@@ -395,17 +772,19 @@ class PingFS:
 			log.exception('PingFS::create: invalid path: %s'%path)
 			return False
 		rPath,rName = parts[0],parts[1]
+		if len(rName) > self.name_max():
+			log.error('PingFS::create: name too long: %s'%path)
+			return False
 		pDir = self.get(rPath)
 		if not pDir:
 			log.error('PingFS::create invalid parent dir: %s'%path)
 			return False
 		pFile = PingFile(rName)
-		if not offset: offset = ''
-		else: offset = '\0'*offset
-		pFile.data = offset + buf
-		inode = self.add(pFile)
-		pDir.add_node(pFile)
-		self.update(pDir)
+		if buf: self.write_data(pFile,buf,offset) # not reachable yet: no lock
+		with self.lock:
+			inode = self.add(pFile)
+			pDir.add_node(pFile)
+			self.update(pDir)
 		return pFile
 		
 	def stop(self):
@@ -434,8 +813,8 @@ def init_fs(FS):
 	d2.add_node(f2)
 
 	log.notice('fleshing out nodes')
-	f1.data = 'delicious apples\n'
-	f2.data = 'ripe yellow bananas\n'
+	FS.write(f1,'delicious apples\n',0)
+	FS.write(f2,'ripe yellow bananas\n',0)
 
 	log.notice('updating nodes in system')
 	FS.update(d1)
@@ -486,7 +865,7 @@ if __name__ == '__main__':
 	FS = None
 	try:
 		ping_reporter.start_log(log,logging.DEBUG)
-		server = ping.select_server(log)
+		server = ping.select_servers(log)
 		FS = PingFS(server)
 		init_fs(FS)
 		test_fs(FS)
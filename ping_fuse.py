@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import os, sys, stat, errno, posix, logging, time, fuse
+import os, sys, stat, errno, posix, logging, time, threading, fuse
 import ping, ping_reporter, ping_filesystem
 from time import time
 
@@ -8,11 +8,30 @@ fuse.fuse_python_api = (0,2)
 
 log = ping_reporter.setup_log('PingFuse')
 
+class PingHandle(object):
+	# an open file, as returned by open/create and handed back to every op on
+	# it: the node is resolved once and shared by all opens of the file. data
+	# goes straight to its blocks; the header (length, extents) is written
+	# once dirty, on flush, fsync or release. a file unlinked while open is
+	# orphaned: out of its directory, but its blocks live until the last release
+	def __init__(self, pFile, pDir, flags):
+		self.pFile = pFile
+		self.pDir = pDir
+		self.flags = flags
+		self.inode = pFile.inode # key in PingFuse.opened
+		self.opens = 1
+		self.dirty = False
+		self.orphaned = False
+
 class PingFuse(fuse.Fuse):
 	def __init__(self, server):
+		# multithreaded unless mounted with -s: each op blocks for round
+		# trips, so independent files are served in parallel
 		self.FS = ping_filesystem.PingFS(server)
+		self.opened = {} # inode -> PingHandle
+		self.lock = threading.Lock() # opened
 		#ping.drop_privileges()
-		fuse.Fuse.__init__(self)
+		fuse.Fuse.__init__(self,dash_s_do='setsingle')
 		log.notice('ping::fuse: initialized (%d-byte blocks)'%self.FS.disk.block_size())
 
 	def fsinit(self):
@@ -36,9 +55,15 @@ class PingFuse(fuse.Fuse):
 
 		log.info('getattr: %s' % path)
 
-		pFile = self.FS.get(path)
+		pFile = self.node(path)
 		if not pFile: return -errno.ENOENT
+		return self.stat(pFile)
+
+	def fgetattr(self, path, fh):
+		log.info('fgetattr: %s' % path)
+		return self.stat(fh.pFile)
 
+	def stat(self, pFile):
 		st = fuse.Stat()
 		st.st_mode = pFile.type | pFile.mode
 		st.st_ino = pFile.inode
@@ -46,6 +71,7 @@ class PingFuse(fuse.Fuse):
 		st.st_uid = 1000 #pFile.uid
 		st.st_gid = 1000 #pFile.gid
 		st.st_size = pFile.size()
+		if pFile.type == stat.S_IFREG: st.st_size = pFile.length
 		#st.st_atime = time()
 		#st.st_mtime = time()
 		#st.st_ctime = time()
@@ -60,41 +86,91 @@ class PingFuse(fuse.Fuse):
 			return [fuse.Direntry(pDir.name)]
 
 		files = [fuse.Direntry('.'),fuse.Direntry('..')]
-		for e in pDir.entries:
+		for e in pDir.listing():
 			files.append(fuse.Direntry(e.name))
 		return files
 
 	def mkdir(self, path, mode):
 		log.info('mkdir: %s mode=%04o'%(path,mode))
 		if path == '/' or path == '': return -errno.EACCESS
+		if self.too_long(path): return -errno.ENAMETOOLONG
 		if self.FS.get(path): return -errno.EEXIST
 		rPath,rName = path.rsplit('/',1)
 		pDir = self.FS.get(rPath)
 		if not pDir: return -errno.ENOENT
 
 		nDir = ping_filesystem.PingDirectory(rName)
-		self.FS.add(nDir) # acquire inode
-		pDir.add_node(nDir) # add dirent
-		self.FS.update(pDir) # save
+		with self.FS.lock:
+			self.FS.add(nDir) # acquire inode
+			pDir.add_node(nDir) # add dirent
+			self.FS.update(pDir) # save
 		return 0
 
+	def too_long(self, path): # a name no directory bucket can hold
+		return len(path.rsplit('/',1)[-1]) > self.FS.name_max()
+
+	def node(self, path):
+		# the node at path; an open file's is its handle's, which may be ahead of the disk
+		pFile = self.FS.get(path)
+		if not pFile: return pFile
+		fh = self.opened.get(pFile.inode)
+		if fh: return fh.pFile
+		return pFile
+
+	def handle(self, path, pFile, flags):
+		pDir = self.FS.get_parent(path,pFile)
+		with self.lock:
+			fh = self.opened.get(pFile.inode)
+			if fh:
+				fh.opens = fh.opens + 1
+				return fh
+			fh = PingHandle(pFile,pDir,flags)
+			self.opened[fh.inode] = fh
+			return fh
+
+	def commit(self, fh):
+		# write a dirty handle's header; a relocation moves the node's inode
+		if not fh.dirty: return True
+		fh.dirty = False
+		if not self.FS.update(fh.pFile,fh.pDir): return False
+		with self.lock:
+			if fh.pFile.inode != fh.inode and self.opened.get(fh.inode) is fh:
+				del self.opened[fh.inode]
+				self.opened[fh.pFile.inode] = fh
+			fh.inode = fh.pFile.inode
+		return True
+
 	def open(self, path, flags):
 		log.info('open: %s flags=%x'%(path,flags))
-		pFile = self.FS.get(path)
+		pFile = self.node(path)
 		if not pFile: return -errno.ENOENT
-		return 0
+		if pFile.type != stat.S_IFREG: return -errno.EISDIR
+		return self.handle(path,pFile,flags)
 
-	def read(self, path, length, offset):
+	def create(self, path, flags, mode):
+		log.info('create: %s flags=%x mode=%04o'%(path,flags,mode))
+		if self.too_long(path): return -errno.ENAMETOOLONG
+		if self.FS.get(path): return -errno.EEXIST
+		pFile = self.FS.create(path)
+		if not pFile: return -errno.EINVAL
+		pFile.mode = mode & 0777
+		self.FS.update(pFile)
+		return self.handle(path,pFile,flags)
+
+	def read(self, path, length, offset, fh=None):
 		log.info('read: %s region=%d,%d'%(path,offset,length))
-		pFile = self.FS.get(path)
-		if not pFile: return -errno.ENOENT
-		if offset > len(pFile.data): return -errno.EINVAL
-		if pFile.type == stat.S_IFDIR: return -errno.EISDIR
-		return pFile.data[offset:offset+length]
+		if not fh:
+			pFile,size,data = self.FS.read(path,length,offset)
+			if not pFile: return -errno.ENOENT
+			if offset > size: return -errno.EINVAL
+			if pFile.type == stat.S_IFDIR: return -errno.EISDIR
+			return data
+		if offset > fh.pFile.length: return -errno.EINVAL
+		return self.FS.read_file(fh.pFile,length,offset)
 
 	def chmod(self, path, mode):
 		log.info('chmod: %s mode=%04o'%(path,mode))
-		pFile = self.FS.get(path)
+		pFile = self.node(path)
 		if not pFile: return -errno.ENOENT
 		pFile.mode = mode
 		self.FS.update(pFile)
@@ -102,7 +178,7 @@ class PingFuse(fuse.Fuse):
 
 	def chown(self, path, uid, gid):
 		log.info('chown: %s uid=%d gid=%d)'%(path,uid,gid))
-		pFile = self.FS.get(path)
+		pFile = self.node(path)
 		if not pFile: return -errno.ENOENT
 		pFile.uid = uid
 		pFile.gid = gid
@@ -122,38 +198,52 @@ class PingFuse(fuse.Fuse):
 		pFile = self.FS.get(path)
 		if not pFile: return -errno.ENOENT
 		if pFile.type != stat.S_IFREG: return -errno.ENOTDIR
-		if self.FS.unlink(path,pFile): return 0
+		with self.lock:
+			fh = self.opened.pop(pFile.inode,None)
+			if fh: fh.orphaned = True # release deletes it
+		if not fh:
+			if self.FS.unlink(path,pFile): return 0
+			return -errno.EINVAL
+		fh.dirty = False # no dirent to update: the header stays as it is
+		fh.pDir = None
+		if self.FS.disconnect(path,fh.pFile): return 0
 		return -errno.EINVAL
 
-	def write(self, path, buf, offset):
+	def write(self, path, buf, offset, fh=None):
 		log.info('write: %s region=%d,%d'%(path,offset,offset+len(buf)))
-		pFile = self.FS.get(path)
-		if not pFile: return -errno.ENOENT
-		pDir = self.FS.get_parent(path,pFile)
-		if not pDir: raise Exception('write failed to find parent after filding child!')
-		if offset:
-			fill = '\0' * min(0,offset - len(pFile.data)) # technically don't need to bound negatives
-			offset = pFile.data[:offset] + fill
-		else: offset = ''
-
-		pFile.data = offset + buf
-		if not self.FS.update(pFile,pDir):
-			return -errno.EINVAL
+		if not fh:
+			pFile = self.node(path)
+			if not pFile: return -errno.ENOENT
+			pDir = self.FS.get_parent(path,pFile)
+			if not pDir: raise Exception('write failed to find parent after filding child!')
+			if pFile.type != stat.S_IFREG: return -errno.EISDIR
+			if not self.FS.write(pFile,buf,offset,pDir):
+				return -errno.EINVAL
+			return len(buf)
+		self.FS.write_data(fh.pFile,buf,offset)
+		if fh.pDir: fh.dirty = True
 		return len(buf)
 
 	def truncate(self, path, size):
 		log.info('truncate: %s size=%d'%(path, size))
-		pFile = self.FS.get(path)
+		pFile = self.node(path)
 		if not pFile: return -errno.ENOENT
-		if size > len(pFile.data): return -errno.EINVAL
 		if pFile.type != stat.S_IFREG: return -errno.EINVAL
-		pFile.data = pFile.data[:size]
-		self.FS.update(pFile)
+		fh = self.opened.get(pFile.inode)
+		if fh: return self.ftruncate(path,size,fh)
+		self.FS.truncate(pFile,size)
+		return 0
+
+	def ftruncate(self, path, size, fh):
+		log.info('ftruncate: %s size=%d'%(path, size))
+		fh.dirty = False # the header goes out with the truncate
+		self.FS.truncate(fh.pFile,size,fh.pDir)
 		return 0
 
 	def mknod(self, path, mode, dev):
 		log.info('mknod: %s mode=%04o dev=%d)'%(path,mode,dev))
 		if not mode & stat.S_IFREG: return -errno.ENOSYS
+		if self.too_long(path): return -errno.ENAMETOOLONG
 		pFile = self.FS.get(path)
 		if pFile: return -errno.EEXIST
 		pFile = self.FS.create(path)
@@ -164,23 +254,29 @@ class PingFuse(fuse.Fuse):
 
 	def rename(self, old_path, new_path):
 		log.info('rename: %s -> %s'%(old_path,new_path))
-
-		(oDir,oFile) = self.FS.get_both(old_path)
-		(nDir,nFile) = self.FS.get_both(new_path)
-		new_name = new_path.rsplit('/',1)[1]
-
-		if not oFile: return -errno.ENOENT
-		if not oDir or not nDir: return -errno.ENOENT
-		if nFile: return -errno.EEXIST
-
-		oDir.del_node(oFile.name,oFile)
-		oFile.name = new_name
-		nDir.add_node(oFile)
-
-		# better to be in both than neither
-		self.FS.update(nDir)
-		self.FS.update(oFile)
-		self.FS.update(oDir)
+		if self.too_long(new_path): return -errno.ENAMETOOLONG
+
+		with self.FS.lock: # one namespace change at a time
+			(oDir,oFile) = self.FS.get_both(old_path)
+			(nDir,nFile) = self.FS.get_both(new_path)
+			new_name = new_path.rsplit('/',1)[1]
+
+			if not oFile: return -errno.ENOENT
+			if not oDir or not nDir: return -errno.ENOENT
+			if nFile: return -errno.EEXIST
+			fh = self.opened.get(oFile.inode)
+			if fh:
+				oFile = fh.pFile
+				fh.pDir = nDir
+
+			oDir.del_node(oFile.name,oFile)
+			oFile.name = new_name
+			nDir.add_node(oFile)
+
+			# better to be in both than neither
+			self.FS.update(nDir)
+			self.FS.update(oDir)
+		self.FS.update(oFile) # its file lock is never taken under the namespace lock
 		return 0
 
 	def link(self, targetPath, linkPath):
@@ -199,9 +295,20 @@ class PingFuse(fuse.Fuse):
 #		log.info('mythread')
 #		return -errno.ENOSYS
 
-	def release(self, path, flags):
+	def flush(self, path, fh):
+		log.info('flush: %s'%path)
+		if not self.commit(fh): return -errno.EIO
+		return 0
+
+	def release(self, path, flags, fh):
 		log.info('release: %s flags=%x'%(path,flags))
-		return -errno.ENOSYS
+		self.commit(fh)
+		with self.lock:
+			fh.opens = fh.opens - 1
+			if not fh.opens and self.opened.get(fh.inode) is fh: del self.opened[fh.inode]
+			orphan = fh.orphaned and not fh.opens
+		if orphan: self.FS.delete(path,fh.pFile)
+		return 0
 
 	def statf(self):
 		log.info('statfs')
@@ -211,9 +318,11 @@ class PingFuse(fuse.Fuse):
 		log.info('utime: %s times=%s'%(path,times))
 		return -errno.ENOSYS
 
-	def fsync(self, path, isFsyncFile):
+	def fsync(self, path, isFsyncFile, fh=None):
 		log.info('fsync: %s fsyncFile? %s'%(path,isFsyncFile))
-		return -errno.ENOSYS
+		if fh and not self.commit(fh): return -errno.EIO
+		self.FS.disk.flush() # write-back blocks out onto the network
+		return 0
 
 
 
@@ -223,7 +332,7 @@ if __name__ == "__main__":
 	ping_reporter.start_log(log,logging.NOTICE)
 	#ping_reporter.start_log(ping_filesystem.log,logging.DEBUG)
 	#ping_reporter.start_log(ping_disk.log,logging.DEBUG)
-	server = ping.select_server(log)
+	server = ping.select_servers(log) # blocks are striped across every one that answers
 	if len(sys.argv) < 2:
 		print 'usage: %s <mountpoint>' % sys.argv[0]
 		sys.exit(1)
@@ -234,7 +343,6 @@ if __name__ == "__main__":
 	fs.parse(errex=1)
 
 	fs.flags = 0
-	#fs.multithreaded = 0
 	ping_filesystem.init_fs(fs.FS)
 	#ping_filesystem.test_fs(fs.FS)
 
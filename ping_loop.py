@@ -0,0 +1,182 @@
+import os, time, errno, fcntl, select, threading, collections, logging
+import ping, ping_server, ping_reporter
+from ping_server import monotonic
+
+log = ping_reporter.setup_log('PingLoop')
+
+"""
+Single-threaded engine for PingServer. The stock PingServer runs a receive
+thread and a PingTimer thread that contend for queued_events; PingLoopServer
+runs the socket, the timeouts and every queued_events update on one event
+loop thread. Callers on other threads only hand work over through
+call_soon_threadsafe, and get back PingFutures (Event compatible, so
+read_block/write_block/delete_block keep their blocking semantics).
+
+PingLoop mirrors the asyncio loop API it stands in for (add_reader,
+call_soon_threadsafe, call_at, call_later, run_forever, stop), which python
+2 does not ship.
+"""
+
+class PingFuture(ping_server.TimerEntry): # an op's timeout and its result
+	__slots__ = ('value','callbacks')
+
+	def __init__(self, wheel, expire=0, handler=None, args=()):
+		ping_server.TimerEntry.__init__(self, wheel, expire, handler, args)
+		self.value = None
+		self.callbacks = None
+
+	def set_result(self, value):
+		self.value = value
+		self.set()
+
+	def result(self, timeout=None):
+		self.wait(timeout)
+		return self.value
+
+	def add_done_callback(self, fn): # fn(future), on the completing thread
+		with self.wheel.lock:
+			if not self.done:
+				if self.callbacks is None: self.callbacks = []
+				self.callbacks.append(fn)
+				return
+		fn(self)
+
+	def set(self):
+		ping_server.TimerEntry.set(self)
+		callbacks,self.callbacks = self.callbacks,None
+		if callbacks:
+			for fn in callbacks: fn(self)
+
+class PingLoop(object):
+	def __init__(self):
+		self.wheel = ping_server.TimingWheel()
+		self.readers = {} # fd -> (file object, callback, args)
+		self.ready = collections.deque()
+		self.wake_r,self.wake_w = os.pipe()
+		for fd in (self.wake_r,self.wake_w):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.woken = False
+		self.running = False
+		self.thread = None
+
+	def add_reader(self, fileobj, callback, *args):
+		self.readers[fileobj.fileno()] = (fileobj,callback,args)
+
+	def remove_reader(self, fileobj):
+		self.readers.pop(fileobj.fileno(),None)
+
+	def wake(self):
+		if self.woken or threading.current_thread() is self.thread: return
+		self.woken = True
+		try: os.write(self.wake_w, '\0')
+		except OSError: pass # pipe full: a wakeup is pending anyway
+
+	def call_soon_threadsafe(self, callback, *args):
+		self.ready.append((callback,args))
+		self.wake()
+
+	def call_at(self, when, callback, *args): # when: ping_server.monotonic() time
+		entry = PingFuture(self.wheel, when, callback, args)
+		if self.wheel.add(entry): self.wake()
+		return entry # entry.set() cancels
+
+	def call_later(self, delay, callback, *args):
+		return self.call_at(monotonic() + delay, callback, *args)
+
+	def stop(self):
+		self.running = False
+		self.woken = False
+		self.wake()
+
+	def run_forever(self):
+		self.thread = threading.current_thread()
+		self.running = True
+		while self.running:
+			timeout = self.wheel.next_timeout(monotonic())
+			if self.ready: timeout = 0
+			fds = self.readers.keys() + [self.wake_r]
+			try: readable = select.select(fds, [], [], timeout)[0]
+			except select.error, e:
+				if e[0] == errno.EINTR: continue
+				raise
+			for fd in readable:
+				if fd == self.wake_r:
+					try: os.read(self.wake_r, 4096)
+					except OSError: pass
+					self.woken = False
+				elif fd in self.readers:
+					fileobj,callback,args = self.readers[fd]
+					callback(*args)
+			while self.ready:
+				callback,args = self.ready.popleft()
+				callback(*args)
+			for entry in self.wheel.expire(monotonic()):
+				if entry.done: continue
+				entry.handler(*entry.args)
+				entry.set()
+		self.thread = None
+
+	def close(self):
+		os.close(self.wake_r)
+		os.close(self.wake_w)
+
+class PingLoopServer(ping_server.PingServer):
+	def __init__(self, d_addr, block_size=1024, initial_timeout=2, transport=None):
+		ping_server.PingServer.__init__(self, d_addr, block_size, initial_timeout, transport)
+		self.loop = PingLoop()
+
+	def stop(self):
+		self.running = False
+		log.info('PingLoopServer terminating')
+		self.loop.stop()
+
+	def run(self):
+		self.running = True
+		log.notice('PingLoopServer starting')
+		output = self.build_output()
+		self.loop.add_reader(self.socket, self.receive, output, 0)
+		self.loop.run_forever()
+		self.loop.remove_reader(self.socket)
+
+	def event_insert(self, ID, handler, args, delay=0, future=None):
+		if not future: future = PingFuture(self.loop.wheel, 0, handler, args)
+		future.expire = monotonic() + self.timeout() + delay
+		self.loop.call_soon_threadsafe(self.__insert, ID, future)
+		return future
+
+	def __insert(self, ID, future): # loop thread
+		if future.done: return
+		self.loop.wheel.add(future)
+		self.queued_events[ID].append((future.handler,future,future.args))
+
+	def read_block(self, ID, callback=None, cb_args=[], blocking=False):
+		# the future's result is the block (a null block on timeout)
+		log.trace('PingLoopServer::read_block: ID=%d blocking=%s'%(ID,blocking))
+		if ID == 0: raise Exception('read_block: invalid block ID (0)')
+		future = PingFuture(self.loop.wheel, 0, self.read_block_timeout, None)
+		future.args = [ID,self.__read_complete,[future,callback,cb_args]]
+		self.event_insert(ID, future.handler, future.args, 0, future)
+		if blocking: future.wait()
+		return future
+
+	def __read_complete(self, ID, data, future, callback, cb_args):
+		future.value = data
+		if callback: callback(ID,data,*cb_args)
+
+if __name__ == "__main__":
+	import ping_echo
+	ping_reporter.start_log(log,logging.DEBUG)
+	responder = ping_echo.EchoResponder(rtt=0.02)
+	PS = PingLoopServer(ping_echo.local_server,transport=responder.build_socket)
+	try:
+		PS.setup()
+		PS.start()
+		writes = [PS.write_block(x,'block %d'%x) for x in range(1,1001)]
+		for x in writes: x.wait()
+		reads = [PS.read_block(x) for x in range(1,1001)]
+		data = [x.result().rstrip('\0') for x in reads]
+		log.info('%d of 1000 blocks read back'%len([x for x in range(1000) if data[x] == 'block %d'%(x+1)]))
+	finally:
+		PS.stop()
+		responder.stop()
+		responder.join()
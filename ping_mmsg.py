@@ -0,0 +1,108 @@
+import os, socket, errno, ctypes, ctypes.util
+
+"""
+recvmmsg / sendmmsg bindings (Linux) used by ping.PingRing and ping.PingBatch
+to move many echoes per syscall. available is False where libc lacks them;
+callers fall back to one recvfrom_into / sendto per packet.
+"""
+
+MSG_DONTWAIT = 0x40
+
+class iovec(ctypes.Structure):
+	_fields_ = [('iov_base', ctypes.c_void_p),
+				('iov_len',  ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [('msg_name',       ctypes.c_void_p),
+				('msg_namelen',    ctypes.c_uint32),
+				('msg_iov',        ctypes.POINTER(iovec)),
+				('msg_iovlen',     ctypes.c_size_t),
+				('msg_control',    ctypes.c_void_p),
+				('msg_controllen', ctypes.c_size_t),
+				('msg_flags',      ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [('msg_hdr', msghdr),
+				('msg_len', ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+	_fields_ = [('sin_family', ctypes.c_ushort),
+				('sin_port',   ctypes.c_uint16),
+				('sin_addr',   ctypes.c_char * 4),
+				('sin_zero',   ctypes.c_char * 8)]
+
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	_recvmmsg = libc.recvmmsg
+	_sendmmsg = libc.sendmmsg
+	_recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+	_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	_recvmmsg.restype = _sendmmsg.restype = ctypes.c_int
+	available = True
+except (OSError, AttributeError):
+	available = False
+
+def raise_errno():
+	err = ctypes.get_errno()
+	raise socket.error(err, os.strerror(err))
+
+class MMsgReceiver(object): # scatters one datagram into each of a fixed set of buffers
+	def __init__(self, buffers):
+		count = len(buffers)
+		self.arrays = [(ctypes.c_char * len(x)).from_buffer(x) for x in buffers]
+		self.iovecs = (iovec * count)()
+		self.msgs = (mmsghdr * count)()
+		self.base = ctypes.addressof(self.msgs)
+		self.stride = ctypes.sizeof(mmsghdr)
+		for x in range(count):
+			self.iovecs[x].iov_base = ctypes.addressof(self.arrays[x])
+			self.iovecs[x].iov_len = len(buffers[x])
+			self.msgs[x].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[x])
+			self.msgs[x].msg_hdr.msg_iovlen = 1
+
+	def recv(self, fd, start, count):
+		# non-blocking; returns the lengths received into buffers[start:start+n]
+		n = _recvmmsg(fd, self.base + start*self.stride, count, MSG_DONTWAIT, None)
+		if n < 0:
+			if ctypes.get_errno() in (errno.EAGAIN, errno.EINTR): return []
+			raise_errno()
+		return [self.msgs[start+x].msg_len for x in range(n)]
+
+class MMsgSender(object):
+	def __init__(self, slots=64):
+		self.slots = slots
+		self.iovecs = (iovec * slots)()
+		self.msgs = (mmsghdr * slots)()
+		self.names = {} # address -> sockaddr_in
+		for x in range(slots):
+			self.msgs[x].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[x])
+			self.msgs[x].msg_hdr.msg_iovlen = 1
+
+	def name(self, address):
+		if address not in self.names:
+			name = sockaddr_in()
+			name.sin_family = socket.AF_INET
+			name.sin_port = socket.htons(address[1])
+			name.sin_addr = socket.inet_aton(address[0])
+			self.names[address] = name
+		return self.names[address]
+
+	def send(self, fd, packets):
+		# packets: [(data, (host, port))]; data must stay referenced until we return
+		packets = [(x.tobytes() if isinstance(x,memoryview) else x,a) for x,a in packets]
+		sent = 0
+		while sent < len(packets):
+			batch = packets[sent:sent+self.slots]
+			for x in range(len(batch)):
+				packet,address = batch[x]
+				name = self.name(address)
+				self.msgs[x].msg_hdr.msg_name = ctypes.addressof(name)
+				self.msgs[x].msg_hdr.msg_namelen = ctypes.sizeof(name)
+				self.iovecs[x].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p).value
+				self.iovecs[x].iov_len = len(packet)
+			n = _sendmmsg(fd, ctypes.addressof(self.msgs), len(batch), 0)
+			if n < 0:
+				if ctypes.get_errno() == errno.EINTR: continue
+				raise_errno()
+			sent = sent + n
+		return sent
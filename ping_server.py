@@ -1,12 +1,118 @@
-import ping, threading, time, socket, select, sys, struct, Queue
+import ping, threading, time, socket, select, sys, struct, ctypes, ctypes.util
 import binascii, collections, math, random, logging
-import ping_reporter
+import ping_reporter, ping_extent
 
 log = ping_reporter.setup_log('PingServer')
 
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+	_clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):
+	_clock_gettime = None
+
+def monotonic(): # CLOCK_MONOTONIC; timeouts must not jump with the wall clock
+	if not _clock_gettime: return time.time()
+	t = timespec()
+	_clock_gettime(1, ctypes.byref(t))
+	return t.tv_sec + t.tv_nsec * 1e-9
+
+class TimerEntry(object): # one pending timeout; also the op's completion event
+	__slots__ = ('wheel','expire','handler','args','slot','done','waiter')
+
+	def __init__(self, wheel, expire, handler, args):
+		self.wheel = wheel
+		self.expire = expire
+		self.handler = handler
+		self.args = args
+		self.slot = None
+		self.done = False
+		self.waiter = None # threading.Event, only built if someone waits
+
+	def is_set(self):
+		return self.done
+
+	def set(self): # completes the op and frees its wheel slot immediately
+		with self.wheel.lock:
+			if self.done: return
+			self.done = True
+			self.wheel.cancel(self)
+			waiter = self.waiter
+		if waiter: waiter.set()
+
+	def wait(self, timeout=None):
+		with self.wheel.lock:
+			if self.done: return True
+			if not self.waiter: self.waiter = threading.Event()
+		return self.waiter.wait(timeout)
+
+class TimingWheel(object):
+	# hashed timing wheel: O(1) insert and cancel; entries further out than one
+	# revolution share a slot with nearer ones and are skipped until due
+	def __init__(self, resolution=0.01, slots=256):
+		self.lock = threading.Lock()
+		self.resolution = resolution
+		self.slots = [set() for x in range(slots)]
+		self.size = slots
+		self.tick = int(monotonic()/resolution) # next tick to expire
+		self.wakeup = None # when the timer thread next wakes (None: idle)
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def insert(self, timeout, handler, args):
+		# returns (entry, wake) where wake means the timer thread sleeps too long
+		entry = TimerEntry(self, monotonic() + timeout, handler, args)
+		return entry,self.add(entry)
+
+	def add(self, entry): # schedule an entry built elsewhere (entry.expire is set)
+		tick = int(math.ceil(entry.expire/self.resolution))
+		with self.lock:
+			if entry.done: return False
+			entry.slot = self.slots[max(tick,self.tick) % self.size]
+			entry.slot.add(entry)
+			self.count = self.count + 1
+			return self.wakeup is None or entry.expire < self.wakeup
+
+	def cancel(self, entry): # caller holds self.lock
+		if entry.slot is None: return
+		entry.slot.discard(entry)
+		entry.slot = None
+		self.count = self.count - 1
+
+	def expire(self, now):
+		# detach every entry due by now, oldest first
+		due = []
+		now_tick = int(now/self.resolution)
+		with self.lock:
+			if not self.count: self.tick = now_tick
+			ticks = min(now_tick - self.tick + 1, self.size)
+			for x in range(self.tick, self.tick + ticks):
+				slot = self.slots[x % self.size]
+				if not slot: continue
+				ready = [e for e in slot if e.expire <= now]
+				for entry in ready: self.cancel(entry)
+				due.extend(ready)
+			self.tick = max(self.tick, now_tick + 1)
+		due.sort(key=lambda e: e.expire)
+		return due
+
+	def next_timeout(self, now):
+		# seconds until the next occupied slot (None if empty); records the wakeup
+		with self.lock:
+			self.wakeup = None
+			if not self.count: return None
+			for x in range(self.size):
+				if self.slots[(self.tick + x) % self.size]: break
+			self.wakeup = (self.tick + x) * self.resolution
+			return max(0, self.wakeup - now)
+
 class PingTimer(threading.Thread): # helper class for PingServer to manage timeouts
 	def __init__(self, event):
-		self.queue = Queue.PriorityQueue()
+		self.wheel = TimingWheel()
 		threading.Thread.__init__(self)
 		self.running = False
 		self.event = event
@@ -26,55 +132,65 @@ class PingTimer(threading.Thread): # helper class for PingServer to manage timeo
 			self.event.wait(timeout)
 
 	def process(self):
-		while self.queue.qsize() > 0:
-			try:                expire,event,callback,cb_args = item = self.queue.get_nowait()
-			except Queue.Empty: break # our qsize check isn't guaranteed to prevent this
-			if event.is_set():  continue # event was completed; ignore it
-			if expire > time.time():
-				self.queue.put(item)
-				return expire - time.time()
-			callback(*cb_args)
-			event.set() # make sure no one executes it
-		return None
+		for entry in self.wheel.expire(monotonic()):
+			if entry.done: continue # completed while we collected it
+			entry.handler(*entry.args)
+			entry.set() # make sure no one executes it
+		return self.wheel.next_timeout(monotonic())
 
 	def add_callback(self, timeout, handler, args):
-		event = threading.Event()
-		item = (time.time()+timeout,event,handler,args)
-		self.queue.put(item)
-		self.event.set()
-		return event
+		entry,wake = self.wheel.insert(timeout, handler, args)
+		if wake: self.event.set()
+		return entry
 
 
 class PingServer(threading.Thread):
-	def __init__(self, d_addr, block_size=1024, initial_timeout=2):
+	def __init__(self, d_addr, block_size=1024, initial_timeout=2, transport=None):
 		self.block_size = block_size # default; use setup for exact
 		self.server = d_addr,socket.gethostbyname(d_addr)
 		self.running_timeout = initial_timeout
+		self.rtt = self.timeout() # measured by setup_timeout
 		threading.Thread.__init__(self)
 		self.listeners = []
 		self.debug = 0
 
+		# the per-block state table (queued_events), blocks and listeners are
+		# shared by the receive and timer threads and every caller
+		self.lock = threading.Lock()
+
 		# timeout events are queued and executed in a seperate thread
 		self.timer_event = threading.Event()
 		self.timer = PingTimer(self.timer_event)
 
 
 		self.blocks = 0
+		self.live = set() # IDs of the blocks written (or seen in flight) and not since deleted
+		self.batch = 0 # >0: receive and resend up to this many echoes per syscall
+		self.frame = None # ping_codec.BlockFrame: blocks travel compressed
 		self.running = False
-		self.socket = ping.build_socket()
+		if not transport: transport = ping.build_socket # or ping_echo.EchoResponder().build_socket
+		self.socket = transport()
+		self.ring = ping.PingRing()
 		self.empty_block = self.null_block()
 		self.queued_events = collections.defaultdict(collections.deque)
 	
 	def timeout(self):		return 2.0/5.0 # self.running_timeout
 	def safe_timeout(self): return 3 * self.timeout()
 
+	def read_reply(self, ID):
+		# this server's echo of ID: a raw socket also sees every other server's replies
+		deadline = time.time() + self.timeout()
+		while True:
+			msg = ping.read_ping(self.socket,max(0,deadline - time.time()))
+			if not msg or (msg['ID'] == ID and msg['address'][0] == self.server[1]): return msg
+
 	def setup_timeout(self, ID=0):
 		Time = time.time()
 		Times = struct.pack('d',Time)
 		if ID == 0: ID = random.getrandbits(32) # ID size in bits
 
 		ping.data_ping(self.socket,self.server[1],ID,Times)
-		msg = ping.read_ping(self.socket,self.timeout())
+		msg = self.read_reply(ID)
 		if not msg:                   raise Exception('PingServer::setup_timeout: no valid response from '+self.server[0])
 		addr,rID,data = msg['address'],msg['ID'],msg['payload']
 		log.debug("Addr=%s rID=%d Data=%d bytes"%(addr[0],rID,len(data)))
@@ -83,6 +199,7 @@ class PingServer(threading.Thread):
 		if data != Times:             raise Exception('PingServer::setup_timeout: invalid response data from '+self.server[0])
 		if addr[0] != self.server[1]: raise Exception('PingServer::setup_timeout: invalid response server from '+self.server[0])
 		delay = time.time() - Time
+		self.rtt = delay
 		log.notice('echo delay: %.02fms'%(1000*delay))
 
 	def setup_block(self, ID = 0):
@@ -91,7 +208,7 @@ class PingServer(threading.Thread):
 		Filler = self.block_size * Fill
 
 		ping.data_ping(self.socket,self.server[1],ID,Filler)
-		msg = ping.read_ping(self.socket,self.timeout())
+		msg = self.read_reply(ID)
 		if not msg:                   raise Exception('PingServer::setup_block: no valid response from '+self.server[0])
 		addr,rID,data = msg['address'],msg['ID'],msg['payload']
 		log.debug("Addr=%s rID=%d Data=%d bytes"%(addr[0],rID,len(data)))
@@ -102,6 +219,21 @@ class PingServer(threading.Thread):
 		self.block_size = len(data)
 		self.empty_block = self.null_block()
 		log.notice('echo length: %d bytes'%self.block_size)
+
+	def set_frame(self, frame):
+		# after setup: a block is what fits in an echo behind the frame header
+		self.frame = frame
+		self.block_size = self.block_size - frame.overhead
+		self.empty_block = self.null_block()
+
+	def decode(self, data): # a received payload -> the block
+		data = ping.as_string(data)
+		if not self.frame: return data
+		block = self.frame.decode(data)
+		if block is None:
+			log.error('%s: undecodable block (%d bytes)'%(self.server[0],len(data)))
+			return self.null_block()
+		return block
 		
 	def setup(self):
 		log.trace('PingServer::setup: testing server "%s"'%self.server[0])
@@ -118,37 +250,57 @@ class PingServer(threading.Thread):
 		self.running = True
 		log.notice('PingServer starting')
 		self.timer.start()
+		output = self.build_output()
 		while self.running:
-			start_blocks = self.blocks # updated asynchronously
-			ready = select.select([self.socket], [], [], self.timeout())
-			if ready[0] == []: # timeout
-				if start_blocks != 0 and self.blocks != 0:
-					log.error('%s timed out'%self.server[0])
-			try:
-				msg = ping.recv_ping(self.socket,self.timeout())
-				if not msg: continue
-			except:
-				continue
-			addr,block_id,data = msg['address'],msg['ID'],msg['payload']
-			if block_id == 0:
-				import binascii
-				raise Exception('received packet w/ ID 0 packet: '+binascii.hexlify(msg['raw']))
-			self.process_block(addr[0],block_id,data)
-
-	def process_block(self, addr, ID, data):
+			self.cycle(output)
+
+	def build_output(self):
+		if self.batch: return ping.PingBatch(self.socket,self.ring.slots)
+		return self.socket
+
+	def cycle(self, output):
+		start_blocks = self.blocks # updated asynchronously
+		ready = select.select([self.socket], [], [], self.timeout())
+		if ready[0] == []: # timeout
+			if start_blocks != 0 and self.blocks != 0:
+				log.error('%s timed out'%self.server[0])
+			return
+		self.receive(output)
+
+	def receive(self, output, timeout=None): # call once the socket is readable
+		if timeout is None: timeout = self.timeout()
+		try:
+			if self.batch: msgs = self.ring.recv_batch(self.socket,self.batch)
+			else:          msgs = [self.ring.recv(self.socket,timeout)]
+		except:
+			return
+		for msg in msgs:
+			if not msg: continue
+			if msg.address[0] != self.server[1]: continue # another server's: raw sockets see every echo
+			if msg.ID == 0:
+				raise Exception('received packet w/ ID 0 packet: '+binascii.hexlify(msg.reply.tobytes()))
+			self.process_block(msg.address[0],msg.ID,msg.payload,msg.reply,output)
+		if output is not self.socket: output.flush()
+
+	def process_block(self, addr, ID, data, reply=None, output=None):
+		# reply: the received ICMP message, echoed as-is unless data changes
+		# data/reply may be PingRing views; anything handed out gets copied
+		if output is None: output = self.socket
 		if ID == 0: raise Exception('server responded with ID 0 packet')
 
-		while len(self.queued_events[ID]):
-			handler,event,args = self.queued_events[ID].popleft()
+		with self.lock: queued = self.queued_events.pop(ID,None) # ops from now on wait a cycle
+		while queued:
+			handler,event,args = queued.popleft()
 			if event.is_set(): continue
 
 			if handler == self.write_block_timeout:
 				if self.debug: log.trace('%s (block %d) updated'%(self.server[0],ID))
 				data = args[1]
+				reply = None
 			elif handler == self.read_block_timeout:
 				if self.debug: log.trace('%s (block %d) read'%(self.server[0],ID))
 				callback,cb_args = args[1],args[2]
-				if len(data) > 0: callback(ID,data,*cb_args)
+				if len(data) > 0: callback(ID,self.decode(data),*cb_args)
 				else:             callback(ID,self.null_block(),*cb_args)
 			elif handler == self.delete_block_timeout:
 				if self.debug: log.trace('%s (block %d) deleted'%(self.server[0],ID))
@@ -156,45 +308,56 @@ class PingServer(threading.Thread):
 			event.set()
 
 		if len(data) == 0:
-			self.blocks = self.blocks - 1
+			with self.lock: self.blocks = self.blocks - 1
+			self.live.discard(ID)
 		else:
-			if len(self.listeners): self.process_listeners(addr, ID, data)
+			self.live.add(ID)
+			if self.listeners: self.process_listeners(addr, ID, data)
 			#log.trace('%s: sending %d bytes from block %d'%(self.server[0],len(data),ID))
-			ping.data_ping(self.socket, addr, ID, data)
+			if reply: ping.echo_ping(output, addr, reply)
+			else:     ping.data_ping(output, addr, ID, data)
 
 	def process_listeners(self, addr, ID, data):
-		if not self.listeners: raise Exception('process_listeners invoked without valid listeners on ID=%d'%ID)
-		self.listeners = [l for l in self.listeners if l[0] >= time.time()] # clean the listeners
-		for x in self.listeners:
+		with self.lock:
+			if not self.listeners: return # expired meanwhile
+			self.listeners = [l for l in self.listeners if l[0] >= time.time()] # clean the listeners
+			listeners = self.listeners
+		data = self.decode(data)
+		for x in listeners:
 			expire,handler,cb_args = x
 			handler(ID, addr, data, *cb_args)
 
 	def add_listener(self, handler, timeout, args):
 		log.debug('add_listener: timeout=%d handler=%s'%(timeout,handler))
 		expire = time.time() + timeout
-		self.listeners.append((expire,handler,args))
+		with self.lock: self.listeners = self.listeners + [(expire,handler,args)]
 
 	def null_block(self):
 		return self.block_size * struct.pack('B',0)
 		
-	def event_insert(self, ID, handler, args):
-		event = self.timer.add_callback(self.timeout(), handler, args)
-		self.queued_events[ID].append((handler,event,args))
+	def event_insert(self, ID, handler, args, delay=0):
+		event = self.timer.add_callback(self.timeout()+delay, handler, args)
+		with self.lock: self.queued_events[ID].append((handler,event,args))
 		return event
 
 	# read / write / delete a single block
-	def write_block(self, ID, data, blocking = False):
-		# add a block to the queue (or delete if equivalent)
+	def write_block(self, ID, data, blocking = False, delay = 0):
+		# add a block to the queue (or delete if equivalent); a new block is
+		# injected delay seconds after the usual timeout (to offset its phase)
 		log.trace('PingServer::write_block: ID=%d bytes=%d blocking=%s'%(ID,len(data),blocking))
 		if ID == 0: raise Exception('write_block: invalid block ID (0)')
 		if data == '%c'%0 * len(data): return self.delete_block(ID,blocking)
-		event = self.event_insert(ID,self.write_block_timeout,[ID,data[:self.block_size]])
+		self.live.add(ID) # allocated from now on, though not yet in flight
+		data = data[:self.block_size]
+		if self.frame: data = self.frame.encode(data)
+		event = self.event_insert(ID,self.write_block_timeout,[ID,data],delay)
 		if blocking: event.wait()
 		return event
 
 	def delete_block(self, ID, blocking = False):
 		log.trace('PingServer::delete_block: ID=%d blocking=%s'%(ID,blocking))
 		if ID == 0: raise Exception('delete_block: invalid block ID (0)')
+		self.live.discard(ID)
 		t = self.event_insert(ID,self.delete_block_timeout,[ID])
 		if blocking: t.wait()
 		return t
@@ -213,11 +376,11 @@ class PingServer(threading.Thread):
 	def delete_block_timeout(self, ID):
 		log.debug('PingServer::delete_block_timeout: ID=%d'%ID)
 		# do nothing; we're marked invalid anyhow
-		pass
+		self.live.discard(ID)
 
 	def write_block_timeout(self, ID, data):
 		log.trace('PingServer::write_block_timeout: ID=%d bytes=%d'%(ID,len(data)))
-		self.blocks = self.blocks + 1
+		with self.lock: self.blocks = self.blocks + 1
 		# force update queue (as if packet arrived)
 		if ID == 0: raise Exception('write_block_timeout: ID == 0')
 		self.process_block(self.server[1], ID, data)
@@ -232,37 +395,23 @@ def __live_blocks(ID, addr, data, datastore):
 	datastore[ID] = 1
 
 def live_blocks(PServer, timeout=None):
+	# the server's index: blocks written and not since deleted. a lost echo is
+	# not detected: its block stays allocated until it is deleted
+	return dict.fromkeys(PServer.live.copy(),1) # set.copy is atomic
+
+def scan_blocks(PServer, timeout=None):
+	# the blocks actually seen in flight (waits out a full cycle)
 	store = {}
 	if not timeout: timeout = PServer.safe_timeout()
 	PServer.add_listener(__live_blocks,timeout,[store])
 	time.sleep(timeout)
 	return store
 		
-def used_blocks(blocks):
-	result,lookup = {},{}
-	for x in blocks:
-		if x-1 in lookup:
-			lookup[x] = lookup[x-1]
-			result[lookup[x]] += 1
-		else:
-			lookup[x] = x
-			result[x] = 1
-	return result
-
-
-def free_blocks(blocks):
-	result = {}
-	if 1 not in blocks:
-		if not blocks:         result[1] = 0
-		elif len(blocks) == 0: result[1] = 0
-		else:                  result[1] = min(blocks.keys())-1
-	for x in blocks:
-		if not x+1 in blocks: result[x+1] = 0
-		if not x-1 in blocks:
-			if not len(result): continue
-			block = max(result.keys())
-			result[block] = x-block
-	return result
+def used_blocks(blocks): # {run start: run length}
+	return ping_extent.ExtentMap.from_blocks(blocks).used_blocks()
+
+def free_blocks(blocks): # {gap start: gap length}; the open end past the last block has length 0
+	return ping_extent.ExtentMap.from_blocks(blocks).free_blocks()
 
 if __name__ == "__main__":
 	ping_reporter.start_log(log,logging.DEBUG)
@@ -0,0 +1,284 @@
+import os, sys, socket, struct, select, threading, itertools, multiprocessing, ctypes, logging
+import ping, ping_server, ping_loop, ping_reporter
+
+log = ping_reporter.setup_log('PingShard')
+
+"""
+Multi-process engine for PingDisk. A single PingServer cycles every block on
+one thread, so checksums and parsing are bounded by one core; PingShardServer
+forks one worker per core instead. Each worker runs a PingLoopServer on its
+own raw socket, with a classic BPF filter attached so the kernel only hands
+it the echo replies whose block ID falls in its range (of the low ID byte,
+so runs of consecutive blocks spread over the workers).
+
+	disk = ping_disk.PingDisk(server,engine=ping_shard.PingShardServer)
+
+The parent keeps the PingServer interface: each block op is forwarded over a
+SOCK_SEQPACKET socketpair to the worker that owns the block, and completes
+when the worker reports back.
+"""
+
+SO_ATTACH_FILTER = 26
+request = struct.Struct('!BIId')  # op, tag, ID, delay; then the block
+response = struct.Struct('!BII4s') # kind, tag, ID, source; then the block
+OP_READ, OP_WRITE, OP_DELETE, OP_LISTEN, DONE, HEARD = range(6)
+id_byte = 4 if sys.byteorder == 'little' else 7 # ICMP block IDs are native order
+
+def shard_range(index, count): # worker index -> [lo,hi) of the low ID byte
+	return (256*index + count - 1)/count,(256*(index+1) + count - 1)/count
+
+def shard_owner(ID, count):
+	return ((ID & 0xFF) * count) >> 8
+
+def bpf(code, jt, jf, k):
+	return struct.pack('HBBI', code, jt, jf, k)
+
+def id_filter(lo, hi, offset=0):
+	# accept echo replies with lo <= (ID & 0xFF) < hi; offset: bytes ahead of the IP header
+	return ''.join([
+		bpf(0xb1, 0, 0, offset),           # ldxb 4*([offset]&0xf)   X = IP header length
+		bpf(0x50, 0, 0, offset),           # ldb [x+offset]          ICMP type
+		bpf(0x15, 0, 4, 0),                # jeq #0 (echo reply)
+		bpf(0x50, 0, 0, offset + id_byte), # ldb [x+offset+id_byte]  low byte of the ID
+		bpf(0x35, 0, 2, lo),               # jge #lo
+		bpf(0x35, 1, 0, hi),               # jge #hi
+		bpf(0x06, 0, 0, 0xFFFFFFFF),       # ret #-1 (accept)
+		bpf(0x06, 0, 0, 0),                # ret #0  (drop)
+	])
+
+def attach_filter(d_socket, program):
+	count = len(program)/8
+	code = ctypes.create_string_buffer(program, len(program))
+	fprog = struct.pack('HP', count, ctypes.addressof(code))
+	d_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+class ShardOp(object): # a forwarded block op; Event compatible, like TimerEntry
+	__slots__ = ('ID','callback','args','value','event')
+
+	def __init__(self, ID, callback=None, args=()):
+		self.ID = ID
+		self.callback = callback
+		self.args = args
+		self.value = None
+		self.event = threading.Event()
+
+	def is_set(self):             return self.event.is_set()
+	def wait(self, timeout=None): return self.event.wait(timeout)
+	def set(self):                self.event.set()
+
+	def result(self, timeout=None):
+		self.event.wait(timeout)
+		return self.value
+
+class ShardWorker(object): # runs in the worker process, on the server's loop thread
+	def __init__(self, server, conn):
+		self.server = server
+		self.conn = conn
+
+	def run(self):
+		self.server.loop.add_reader(self.conn, self.receive)
+		self.server.run()
+
+	def reply(self, kind, tag, ID, data='', addr='\0'*4):
+		self.conn.sendall(response.pack(kind, tag, ID, addr) + data)
+
+	def complete(self, future, tag, ID):
+		self.reply(DONE, tag, ID, future.value or '')
+
+	def heard(self, ID, addr, data, tag):
+		self.reply(HEARD, tag, ID, data, socket.inet_aton(addr))
+
+	def receive(self):
+		while True:
+			try: msg = self.conn.recv(65536, socket.MSG_DONTWAIT)
+			except socket.error: return
+			if not msg: return self.server.stop() # parent closed the channel
+			op,tag,ID,delay = request.unpack_from(msg)
+			data = msg[request.size:]
+			if   op == OP_READ:   future = self.server.read_block(ID)
+			elif op == OP_WRITE:  future = self.server.write_block(ID, data, False, delay)
+			elif op == OP_DELETE: future = self.server.delete_block(ID)
+			elif op == OP_LISTEN:
+				self.server.add_listener(self.heard, delay, [tag])
+				continue
+			future.add_done_callback(lambda f, tag=tag, ID=ID: self.complete(f, tag, ID))
+
+def run_worker(conn, d_addr, block_size, rtt, batch, index, count, transport):
+	server = ping_loop.PingLoopServer(d_addr, block_size, 2, transport)
+	lo,hi = shard_range(index, count)
+	attach_filter(server.socket, id_filter(lo, hi, getattr(server.socket, 'header_offset', 0)))
+	server.empty_block = server.null_block()
+	server.rtt = rtt
+	server.batch = batch
+	log.debug('PingShard: worker %d (pid %d) owns IDs %d-%d (mod 256)'%(index,os.getpid(),lo,hi-1))
+	ShardWorker(server, conn).run()
+
+class PingShardServer(threading.Thread):
+	def __init__(self, d_addr, block_size=1024, initial_timeout=2, transport=None, workers=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.block_size = block_size # default; use setup for exact
+		self.server = d_addr,socket.gethostbyname(d_addr)
+		self.initial_timeout = initial_timeout
+		self.transport = transport
+		self.workers = workers or multiprocessing.cpu_count()
+		self.rtt = self.timeout()
+		self.empty_block = self.null_block()
+		self.batch = 0
+		self.frame = None   # ping_codec.BlockFrame, applied here: workers see frames
+		self.listeners = {} # tag -> (expire, handler, args)
+		self.pending = {}   # tag -> ShardOp
+		self.live = set()   # as PingServer: blocks written and not since deleted
+		self.tags = itertools.count(1)
+		self.conns = []
+		self.processes = []
+		self.running = False
+
+	def timeout(self):      return 2.0/5.0 # as PingServer
+	def safe_timeout(self): return 3 * self.timeout()
+
+	def null_block(self):
+		return self.block_size * struct.pack('B',0)
+
+	def set_frame(self, frame): # as PingServer, after setup
+		self.frame = frame
+		self.block_size = self.block_size - frame.overhead
+		self.empty_block = self.null_block()
+
+	def echo_size(self): # the workers' block size: a whole frame
+		if self.frame: return self.block_size + self.frame.overhead
+		return self.block_size
+
+	def decode(self, data):
+		if not self.frame or data.strip('\0') == '': return data[:self.block_size] # lost, or never there
+		block = self.frame.decode(data)
+		if block is None:
+			log.error('%s: undecodable block (%d bytes)'%(self.server[0],len(data)))
+			return self.null_block()
+		return block
+
+	def setup(self):
+		# measure once with a throwaway PingServer; workers inherit the results
+		probe = ping_server.PingServer(self.server[0], self.block_size, self.initial_timeout, self.transport)
+		try: probe.setup()
+		finally: probe.socket.close()
+		self.block_size = probe.block_size
+		self.empty_block = self.null_block()
+		self.rtt = probe.rtt
+
+	def start(self):
+		log.notice('PingShardServer starting %d workers'%self.workers)
+		for x in range(self.workers):
+			parent,child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+			for s in (parent,child): s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024*1024)
+			process = multiprocessing.Process(target=run_worker, args=(child, self.server[0],
+					self.echo_size(), self.rtt, self.batch, x, self.workers, self.transport))
+			process.daemon = True
+			process.start()
+			child.close()
+			self.conns.append(parent)
+			self.processes.append(process)
+		threading.Thread.start(self)
+
+	def stop(self):
+		self.running = False
+		log.info('PingShardServer terminating')
+		for x in self.conns:
+			try: x.shutdown(socket.SHUT_RDWR) # workers see EOF and stop
+			except socket.error: pass
+		for x in self.processes: x.join(1)
+		for x in self.processes:
+			if x.is_alive(): x.terminate()
+		if self.is_alive() and threading.current_thread() is not self: self.join(1)
+		pending,self.pending = self.pending,{}
+		for op in pending.values(): op.set() # nothing more will arrive
+
+	def run(self):
+		self.running = True
+		while self.running:
+			try: readable = select.select(self.conns, [], [], self.timeout())[0]
+			except select.error: continue
+			for conn in readable: self.receive(conn)
+
+	def receive(self, conn):
+		while True:
+			try: msg = conn.recv(65536, socket.MSG_DONTWAIT)
+			except socket.error: return
+			if not msg: return
+			kind,tag,ID,addr = response.unpack_from(msg)
+			data = msg[response.size:]
+			if kind == HEARD:
+				if tag not in self.listeners: continue
+				expire,handler,args = self.listeners[tag]
+				handler(ID, socket.inet_ntoa(addr), self.decode(data), *args)
+				continue
+			op = self.pending.pop(tag, None)
+			if not op: continue
+			if data: # reads always return a block (a null one on timeout)
+				data = self.decode(data)
+				op.value = data
+				if op.callback: op.callback(ID, data, *op.args)
+			op.set()
+
+	def forward(self, op, code, ID, data='', delay=0): # to the worker owning ID
+		tag = self.tags.next()
+		self.pending[tag] = op
+		conn = self.conns[shard_owner(ID, self.workers)]
+		conn.sendall(request.pack(code, tag, ID, delay) + data)
+
+	# read / write / delete a single block, as PingServer
+	def write_block(self, ID, data, blocking=False, delay=0):
+		log.trace('PingShardServer::write_block: ID=%d bytes=%d blocking=%s'%(ID,len(data),blocking))
+		if ID == 0: raise Exception('write_block: invalid block ID (0)')
+		if data.strip('\0') == '': self.live.discard(ID) # the worker deletes it
+		else:                      self.live.add(ID)
+		op = ShardOp(ID)
+		data = data[:self.block_size]
+		if self.frame: data = self.frame.encode(data)
+		self.forward(op, OP_WRITE, ID, data, delay)
+		if blocking: op.wait()
+		return op
+
+	def delete_block(self, ID, blocking=False):
+		log.trace('PingShardServer::delete_block: ID=%d blocking=%s'%(ID,blocking))
+		if ID == 0: raise Exception('delete_block: invalid block ID (0)')
+		self.live.discard(ID)
+		op = ShardOp(ID)
+		self.forward(op, OP_DELETE, ID)
+		if blocking: op.wait()
+		return op
+
+	def read_block(self, ID, callback=None, cb_args=[], blocking=False):
+		log.trace('PingShardServer::read_block: ID=%d blocking=%s'%(ID,blocking))
+		if ID == 0: raise Exception('read_block: invalid block ID (0)')
+		op = ShardOp(ID, callback, cb_args)
+		self.forward(op, OP_READ, ID)
+		if blocking: op.wait()
+		return op
+
+	def add_listener(self, handler, timeout, args):
+		# every worker reports the blocks it cycles until the timeout
+		log.debug('add_listener: timeout=%d handler=%s'%(timeout,handler))
+		tag = self.tags.next()
+		self.listeners[tag] = (ping_server.monotonic()+timeout,handler,args)
+		now = ping_server.monotonic()
+		for x in [t for t,l in self.listeners.items() if l[0] < now]: del self.listeners[x]
+		for conn in self.conns: conn.sendall(request.pack(OP_LISTEN, tag, 0, timeout))
+
+if __name__ == "__main__":
+	import time, ping_echo
+	ping_reporter.start_log(log,logging.DEBUG)
+	responder = ping_echo.EchoResponder(rtt=0.02)
+	PS = PingShardServer(ping_echo.local_server,transport=responder.build_socket,workers=4)
+	try:
+		PS.setup()
+		PS.start()
+		writes = [PS.write_block(x,'block %d'%x) for x in range(1,1001)]
+		for x in writes: x.wait()
+		reads = [PS.read_block(x) for x in range(1,1001)]
+		data = [x.result().rstrip('\0') for x in reads]
+		log.info('%d of 1000 blocks read back'%len([x for x in range(1000) if data[x] == 'block %d'%(x+1)]))
+		log.info('%d blocks live, %d seen in flight'%(len(ping_server.live_blocks(PS)),len(ping_server.scan_blocks(PS))))
+	finally:
+		PS.stop()
+		responder.stop()